@@ -0,0 +1,172 @@
+"""
+Benchmarks compiling and executing relationship queries against the database
+configured by DATABASE_URL, as for the tests:
+
+    PYTHONPATH=. DJANGO_SETTINGS_MODULE=tests.settings python -m benchmarks \\
+        --rows 1000 --save benchmarks/baselines/sqlite-1000.json
+
+Pass --compare with a saved file to report the ratio of each timing to its
+baseline, exiting with status 1 if any case is slower than the threshold or
+makes more queries.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import django
+
+
+def measure(function, min_time, min_repeat):
+    """
+    Call function repeatedly for at least min_time seconds and min_repeat
+    times, and return the median duration of a call.
+    """
+    durations = []
+    started = time.perf_counter()
+    while len(durations) < min_repeat or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return durations[len(durations) // 2]
+
+
+def run_case(case, connection, min_time, min_repeat):
+    from django.test.utils import CaptureQueriesContext
+
+    # Count the queries while warming up.
+    with CaptureQueriesContext(connection) as queries:
+        case.run()
+    result = {"queries": len(queries)}
+    if case.queryset is not None:
+        result["compile"] = measure(
+            lambda: case.queryset().query.get_compiler(connection.alias).as_sql(),
+            min_time,
+            min_repeat,
+        )
+    result["execute"] = measure(case.run, min_time, min_repeat)
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Print each timing as a ratio of its baseline, and return whether any case
+    regressed.
+    """
+    regressed = False
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        notes = []
+        for key in ["compile", "execute"]:
+            if key in result and base.get(key):
+                ratio = result[key] / base[key]
+                if ratio > threshold:
+                    regressed = True
+                    notes.append("%s %.2fx SLOWER" % (key, ratio))
+                else:
+                    notes.append("%s %.2fx" % (key, ratio))
+        if result["queries"] > base["queries"]:
+            regressed = True
+            notes.append("queries %d -> %d" % (base["queries"], result["queries"]))
+        print("%-45s %s" % (name, ", ".join(notes)))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=1000,
+        help="Number of rows of each model to generate, e.g. 1000, 100000 or 1000000.",
+    )
+    parser.add_argument("--filter", default="", help="Only run cases containing this.")
+    parser.add_argument("--min-time", type=float, default=0.2)
+    parser.add_argument("--min-repeat", type=int, default=5)
+    parser.add_argument("--save", help="Save the results as JSON to this file.")
+    parser.add_argument("--compare", help="Compare the results to this file.")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument(
+        "--keepdb",
+        action="store_true",
+        help="Keep the benchmark database, reusing its data on the next run.",
+    )
+    args = parser.parse_args(argv)
+
+    django.setup()
+    from django.db import connection
+
+    from benchmarks.cases import get_cases
+    from benchmarks.data import generate
+    from tests.models import Page
+
+    connection.creation.create_test_db(verbosity=0, keepdb=args.keepdb)
+    try:
+        if Page.objects.count() != args.rows:
+            if Page.objects.exists():
+                sys.exit("The kept database has a different number of rows.")
+            started = time.perf_counter()
+            generate(args.rows)
+            print(
+                "Generated %d rows in %.1fs"
+                % (args.rows, time.perf_counter() - started)
+            )
+
+        results = {}
+        for case in get_cases():
+            if args.filter in case.name:
+                result = results[case.name] = run_case(
+                    case, connection, args.min_time, args.min_repeat
+                )
+                print(
+                    "%-45s compile %8s  execute %9.3fms  queries %d"
+                    % (
+                        case.name,
+                        (
+                            "%.3fms" % (result["compile"] * 1000)
+                            if "compile" in result
+                            else "-"
+                        ),
+                        result["execute"] * 1000,
+                        result["queries"],
+                    )
+                )
+    finally:
+        if not args.keepdb:
+            connection.creation.destroy_test_db(
+                connection.settings_dict["NAME"], verbosity=0
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "environment": {
+                        "vendor": connection.vendor,
+                        "rows": args.rows,
+                        "django": django.get_version(),
+                        "python": platform.python_version(),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("\nCompared to %s:" % args.compare)
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+The benchmarked operations. For each relationship there are three cases:
+
+- filter: selecting the objects of the local model related to one object.
+- accessor: the related objects of one local instance, via its manager.
+- prefetch: prefetching the relationship for a page of local instances, or
+  for relationships with a single related object, select_related.
+"""
+
+from relativity.aggregates import RelationshipCount
+from tests.models import (
+    AdjacencyPage,
+    MPTTPage,
+    Page,
+    ProductFilter,
+    SavedFilter,
+    TBMPPage,
+    TBNSPage,
+    UserGenerator,
+)
+
+PAGE_SIZE = 100
+
+
+class Case(object):
+    """
+    A benchmarked operation. queryset() returns the QuerySet to compile and
+    execute; if it's None, run() is timed instead.
+    """
+
+    def __init__(self, name, queryset=None, run=None):
+        self.name = name
+        self.queryset = queryset
+        self.run = run or (lambda: list(self.queryset()))
+
+
+def sample(model, depth=None):
+    """
+    Return a local instance to follow relationships from. In trees, this is
+    the first node of the given depth, so that it has a modest number of
+    descendants.
+    """
+    queryset = model.objects.order_by("pk")
+    if depth is not None:
+        # Nodes are numbered breadth first, with ten children each.
+        pk = 1
+        for _ in range(depth):
+            pk = pk * 10 - 8
+        return queryset.filter(pk=pk).first() or queryset.first()
+    return queryset.first()
+
+
+def page(model):
+    """
+    Return the pks of PAGE_SIZE local instances, spread over the whole table.
+    """
+    pks = list(model.objects.order_by("pk").values_list("pk", flat=True))
+    step = max(1, len(pks) // PAGE_SIZE)
+    return pks[::step][:PAGE_SIZE]
+
+
+def relationship_cases(label, model, name, depth=None):
+    field = model._meta.get_field(name)
+    local = sample(model, depth)
+    related = field.related_model.objects.order_by("-pk").first()
+    pks = page(model)
+    cases = [Case("%s.filter" % label, lambda: model.objects.filter(**{name: related}))]
+    if field.multiple:
+        cases.append(Case("%s.accessor" % label, lambda: getattr(local, name).all()))
+        cases.append(
+            Case(
+                "%s.prefetch" % label,
+                run=lambda: [
+                    list(getattr(obj, name).all())
+                    for obj in model.objects.filter(pk__in=pks).prefetch_related(name)
+                ],
+            )
+        )
+    else:
+        cases.append(Case("%s.accessor" % label, run=lambda: getattr(local, name)))
+        cases.append(
+            Case(
+                "%s.select_related" % label,
+                lambda: model.objects.filter(pk__in=pks).select_related(name),
+            )
+        )
+    return cases
+
+
+def get_cases():
+    cases = []
+    for label, model in [
+        ("page", Page),
+        ("adjacency", AdjacencyPage),
+        ("mptt", MPTTPage),
+        ("treebeard_mp", TBMPPage),
+        ("treebeard_ns", TBNSPage),
+    ]:
+        cases += relationship_cases(label + ".descendants", model, "descendants", 2)
+        cases.append(
+            Case(
+                "%s.descendants.count" % label,
+                lambda model=model, pks=page(model): model.objects.filter(
+                    pk__in=pks
+                ).annotate(RelationshipCount("descendants")),
+            )
+        )
+    cases += relationship_cases("treebeard_mp.ancestors", TBMPPage, "ancestors", 2)
+    # The accessor of a relationship which caches its compiled statement.
+    cases.append(
+        Case(
+            "treebeard_mp.statement_descendants.accessor",
+            run=lambda local=sample(TBMPPage, 2): list(
+                local.statement_descendants.all()
+            ),
+        )
+    )
+    cases += relationship_cases("regex", SavedFilter, "chemicals")
+    cases += relationship_cases("regex_exists", SavedFilter, "exists_chemicals")
+    cases += relationship_cases(
+        "regex_materialized", SavedFilter, "materialized_chemicals"
+    )
+    cases += relationship_cases("multi_hop", ProductFilter, "cartitems")
+    cases += relationship_cases("range", ProductFilter, "products")
+    cases += relationship_cases("pairs", ProductFilter, "paired_products")
+    cases += relationship_cases("concat", UserGenerator, "user")
+    return cases
@@ -0,0 +1,188 @@
+"""
+Generates the benchmark data set: a tree of the given number of nodes for each
+kind of tree model, and the same number of rows for the other models.
+"""
+
+import random
+from collections import namedtuple
+
+from treebeard.numconv import NumConv
+
+from relativity.materialized import rebuild
+from tests.models import (
+    AdjacencyPage,
+    CartItem,
+    Chemical,
+    MPTTPage,
+    Page,
+    Product,
+    ProductFilter,
+    SavedFilter,
+    TBMPPage,
+    TBNSPage,
+    User,
+    UserGenerator,
+)
+
+FANOUT = 10
+BATCH_SIZE = 5000
+
+ELEMENTS = ["C", "H", "O", "N", "Na", "Cl", "K", "Si", "S", "P", "Ca", "F"]
+REGEXES = ["Cl", "^Na", "O[0-9]", "^C[0-9]H", "Si", "K$", "S[0-9]O", "F[0-9]"]
+COLOURS = ["red", "blue", "green", "yellow"]
+SHAPES = ["circle", "triangle", "square"]
+
+
+Node = namedtuple("Node", "index parent path depth numchild lft rgt")
+
+
+def tree(rows):
+    """
+    Return a list of Nodes for a tree of rows nodes in breadth-first order, in
+    which each node has FANOUT children, except near the bottom.
+    """
+    numconv = NumConv(len(TBMPPage.alphabet), TBMPPage.alphabet)
+    children = [[] for _ in range(rows)]
+    parents, paths, depths = [None] * rows, [None] * rows, [0] * rows
+    for i in range(rows):
+        if i:
+            parents[i] = (i - 1) // FANOUT
+            children[parents[i]].append(i)
+        step = numconv.int2str(len(children[parents[i]]) if i else 1)
+        prefix = paths[parents[i]] if i else ""
+        paths[i] = prefix + step.rjust(TBMPPage.steplen, "0")
+        depths[i] = depths[parents[i]] + 1 if i else 0
+
+    # Number the nodes depth first for the nested set models.
+    lft, rgt = [0] * rows, [0] * rows
+    counter, stack = 1, [(0, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            rgt[node] = counter
+        else:
+            lft[node] = counter
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children[node]))
+        counter += 1
+
+    return [
+        Node(i, parents[i], paths[i], depths[i], len(children[i]), lft[i], rgt[i])
+        for i in range(rows)
+    ]
+
+
+def generate(rows, seed=0):
+    """
+    Fill the test models with rows objects each, or a tree of rows nodes, and
+    a smaller number of saved filters.
+    """
+    rng = random.Random(seed)
+    nodes = tree(rows)
+
+    def pages(model, fields):
+        model.objects.bulk_create(
+            [
+                model(
+                    pk=n.index + 1, name="node %d" % n.index, slug=n.path, **fields(n)
+                )
+                for n in nodes
+            ],
+            batch_size=BATCH_SIZE,
+        )
+
+    pages(Page, lambda n: {})
+    pages(
+        AdjacencyPage,
+        lambda n: {"parent_id": None if n.parent is None else n.parent + 1},
+    )
+    pages(
+        MPTTPage,
+        lambda n: {
+            "parent_id": None if n.parent is None else n.parent + 1,
+            "lft": n.lft,
+            "rght": n.rgt,
+            "tree_id": 1,
+            "level": n.depth,
+        },
+    )
+    pages(
+        TBMPPage,
+        lambda n: {"path": n.path, "depth": n.depth + 1, "numchild": n.numchild},
+    )
+    pages(
+        TBNSPage,
+        lambda n: {"lft": n.lft, "rgt": n.rgt, "tree_id": 1, "depth": n.depth + 1},
+    )
+
+    Chemical.objects.bulk_create(
+        [
+            Chemical(
+                pk=i + 1,
+                formula="".join(
+                    rng.choice(ELEMENTS) + str(rng.randint(1, 4))
+                    for _ in range(rng.randint(1, 4))
+                ),
+                chemical_name="chemical %d" % i,
+            )
+            for i in range(rows)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    filters = max(len(REGEXES), rows // 1000)
+    User.objects.bulk_create(
+        [User(username="user %d" % i) for i in range(filters)], batch_size=BATCH_SIZE
+    )
+    SavedFilter.objects.bulk_create(
+        [
+            SavedFilter(
+                pk=i + 1,
+                user_id="user %d" % i,
+                search_regex=REGEXES[i % len(REGEXES)],
+            )
+            for i in range(filters)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    rebuild(SavedFilter._meta.get_field("materialized_chemicals"), "default")
+
+    Product.objects.bulk_create(
+        [
+            Product(
+                pk=i + 1,
+                sku="%08d" % i,
+                colour=rng.choice(COLOURS),
+                shape=rng.choice(SHAPES),
+                size=rng.randint(1, 10),
+                deleted=rng.random() < 0.05,
+            )
+            for i in range(rows)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    CartItem.objects.bulk_create(
+        [
+            CartItem(
+                pk=i + 1,
+                product_code="%08d" % rng.randrange(rows),
+                description="item %d" % i,
+            )
+            for i in range(rows)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    ProductFilter.objects.bulk_create(
+        [
+            ProductFilter(pk=i + 1, fcolour=COLOURS[i % len(COLOURS)], fsize=i % 10 + 1)
+            for i in range(filters)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+    UserGenerator.objects.bulk_create(
+        [UserGenerator(pk=i + 1) for i in range(rows)], batch_size=BATCH_SIZE
+    )
+    User.objects.bulk_create(
+        [User(username="generated_for_%d" % (i + 1)) for i in range(rows)],
+        batch_size=BATCH_SIZE,
+    )
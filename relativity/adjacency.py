@@ -0,0 +1,273 @@
+"""
+Relationships for trees stored as adjacency lists, in which each node only
+refers to its parent, e.g. with parent = ForeignKey("self"). The nodes above
+or below a node are found with a recursive common table expression, which
+PostgreSQL, SQLite and MySQL 8 support, so a whole subtree is fetched in a
+single query.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import operator
+
+from django.db import connections
+from django.db.models import Expression, Q, Value
+
+from relativity.fields import L, Relationship
+from relativity.statements import InstanceParameter
+
+TREE_SQL = (
+    "WITH RECURSIVE %(tree)s (%(columns)s) AS ("
+    "SELECT %(anchor)s FROM %(table)s %(node)s WHERE %(anchor_where)s "
+    "%(union)s "
+    "SELECT %(step)s FROM %(table)s %(node)s INNER JOIN %(tree)s ON %(join)s%(where)s"
+    ") SELECT %(select)s FROM %(tree)s"
+)
+
+
+def tree_sql(connection, model, parent, descendants, start, select, **options):
+    """
+    Return the SQL and parameters of a query of the nodes of model below, or
+    above, the nodes whose pks satisfy start, e.g. "= %s" or "IN (%s, %s)".
+    Each row has the columns in select, out of root, the pk of the node it was
+    found from, and id, the pk of the node found. parent is the name of the
+    field holding the pk of each node's parent. The nodes within max_depth of
+    the root are found, including the root itself with include_self.
+
+    Without max_depth, the rows are combined with UNION, which drops those
+    already found, so that the query ends even if the parents form a cycle.
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    names = {
+        "table": qn(opts.db_table),
+        "pk": qn(opts.pk.column),
+        "parent": qn(opts.get_field(parent).column),
+        "node": qn("relativity_node"),
+        "tree": qn("relativity_tree"),
+        "root": qn("root"),
+        "id": qn("id"),
+        "depth": qn("depth"),
+    }
+    node_pk = "%(node)s.%(pk)s" % names
+    node_parent = "%(node)s.%(parent)s" % names
+    has_parent = "%s IS NOT NULL" % node_parent
+    include_self = options.get("include_self")
+    if include_self:
+        anchor = [node_pk, node_pk]
+        anchor_where = "%s %s" % (node_pk, start)
+    elif descendants:
+        anchor = [node_parent, node_pk]
+        anchor_where = "%s %s" % (node_parent, start)
+    else:
+        anchor = [node_pk, node_parent]
+        anchor_where = "%s %s AND %s" % (node_pk, start, has_parent)
+
+    columns = ["root", "id"]
+    tree_id = "%(tree)s.%(id)s" % names
+    if descendants:
+        step = ["%(tree)s.%(root)s" % names, node_pk]
+        join = "%s = %s" % (node_parent, tree_id)
+        conditions = []
+    else:
+        step = ["%(tree)s.%(root)s" % names, node_parent]
+        join = "%s = %s" % (node_pk, tree_id)
+        conditions = [has_parent]
+    params = []
+    max_depth = options.get("max_depth")
+    if max_depth is not None:
+        # The depth stops the recursion instead.
+        columns.append("depth")
+        anchor.append("0" if include_self else "1")
+        step.append("%(tree)s.%(depth)s + 1" % names)
+        conditions.append("%(tree)s.%(depth)s < %%s" % names)
+        params.append(max_depth)
+    sql = TREE_SQL % dict(
+        names,
+        columns=", ".join(names[c] for c in columns),
+        anchor=", ".join(anchor),
+        anchor_where=anchor_where,
+        union="UNION" if max_depth is None else "UNION ALL",
+        step=", ".join(step),
+        join=join,
+        where=" WHERE %s" % " AND ".join(conditions) if conditions else "",
+        select=", ".join("%s.%s" % (names["tree"], names[c]) for c in select),
+    )
+    return sql, params
+
+
+class AdjacencyTree(Expression):
+    """
+    A subquery selecting the pks of the nodes of model below, or above, the
+    node whose pk is start, for the right hand side of an IN lookup.
+    """
+
+    def __init__(self, start, model, parent, descendants, **options):
+        super(AdjacencyTree, self).__init__(output_field=model._meta.pk)
+        self.start = start
+        self.model = model
+        self.parent = parent
+        self.descendants = descendants
+        self.options = options
+
+    def __repr__(self):
+        return "%s(%r, %s)" % (
+            self.__class__.__name__,
+            self.start,
+            "descendants" if self.descendants else "ancestors",
+        )
+
+    def get_source_expressions(self):
+        return [self.start]
+
+    def set_source_expressions(self, exprs):
+        (self.start,) = exprs
+
+    def as_sql(self, compiler, connection):
+        start_sql, start_params = compiler.compile(self.start)
+        sql, params = tree_sql(
+            connection,
+            self.model,
+            self.parent,
+            self.descendants,
+            "= %s" % start_sql,
+            ["id"],
+            **self.options
+        )
+        return "(%s)" % sql, list(start_params) + params
+
+
+class AdjacencyQ(Q):
+    """
+    Selects the nodes below, or above, the local node of an adjacency list,
+    whose parents are held in the field called parent.
+    """
+
+    def __init__(self, parent="parent", descendants=True, **options):
+        super(AdjacencyQ, self).__init__()
+        self.parent = parent
+        self.descendants = descendants
+        self.options = options
+
+    def deconstruct(self):
+        path = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
+        kwargs = dict(self.options, parent=self.parent, descendants=self.descendants)
+        return path, (), kwargs
+
+    def tree(self, start, model, reverse=False):
+        """
+        Return the AdjacencyTree of model from start, in the opposite direction
+        with reverse.
+        """
+        descendants = self.descendants != reverse
+        return AdjacencyTree(start, model, self.parent, descendants, **self.options)
+
+    def translate(self, model):
+        return Q(pk__in=self.tree(L("pk"), model))
+
+    def resolve_expression(
+        self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False
+    ):
+        return self.translate(query.model).resolve_expression(
+            query, allow_joins, reuse, summarize, for_save
+        )
+
+
+class AdjacencyMixin(object):
+    """
+    Follows the relationship in reverse, and prefetches it, with the tree in
+    the opposite direction rather than a correlated subquery for every node.
+    """
+
+    descendants = True
+    include_self = False
+
+    def __init__(self, parent="parent", max_depth=None, **kwargs):
+        kwargs.setdefault("related_name", "+")
+        kwargs.update(
+            to="self",
+            predicate=AdjacencyQ(
+                parent,
+                self.descendants,
+                include_self=self.include_self,
+                max_depth=max_depth,
+            ),
+        )
+        super(AdjacencyMixin, self).__init__(**kwargs)
+        self.parent = parent
+        self.max_depth = max_depth
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(AdjacencyMixin, self).deconstruct()
+        if self.parent != "parent":
+            kwargs["parent"] = self.parent
+        if self.max_depth is not None:
+            kwargs["max_depth"] = self.max_depth
+        return name, path, args, kwargs
+
+    def get_instance_filter(self, obj):
+        if self.materialize:
+            return super(AdjacencyMixin, self).get_instance_filter(obj)
+        pk = self.model._meta.pk
+        start = Value(getattr(obj, pk.attname), output_field=pk)
+        return Q(pk__in=self.predicate.tree(start, self.model, reverse=True))
+
+    def _parameterised_predicate(self, forward):
+        if forward or self.materialize:
+            return super(AdjacencyMixin, self)._parameterised_predicate(forward)
+        pk = self.model._meta.pk
+        start = InstanceParameter(operator.attrgetter(pk.attname), pk)
+        return Q(pk__in=self.predicate.tree(start, self.model, reverse=True))
+
+    def get_prefetch_pairs(self, pks, forward, using):
+        connection = connections[using]
+        tree = self.predicate.tree(None, self.model, reverse=not forward)
+        limits = [len(pks) or 1]
+        if connection.features.max_query_params:
+            # Leave room for max_depth.
+            limits.append(max(1, connection.features.max_query_params - 1))
+        if connection.ops.max_in_list_size():
+            limits.append(connection.ops.max_in_list_size())
+        batch_size = min(limits)
+        pairs = []
+        for start in range(0, len(pks), batch_size):
+            batch = pks[start : start + batch_size]
+            sql, params = tree_sql(
+                connection,
+                self.model,
+                tree.parent,
+                tree.descendants,
+                "IN (%s)" % ", ".join(["%s"] * len(batch)),
+                ["root", "id"],
+                **tree.options
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(sql, list(batch) + params)
+                pairs.extend(cursor.fetchall())
+        if tree.options.get("max_depth") is not None:
+            # Going round a cycle finds the same nodes again.
+            pairs = list(dict.fromkeys(pairs))
+        return pairs
+
+
+class AdjacencyDescendants(AdjacencyMixin, Relationship):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("related_name", "ascendants")
+        super(AdjacencyDescendants, self).__init__(**kwargs)
+
+
+class AdjacencySubtree(AdjacencyMixin, Relationship):
+    include_self = True
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("related_name", "rootpath")
+        super(AdjacencySubtree, self).__init__(**kwargs)
+
+
+class AdjacencyAncestors(AdjacencyMixin, Relationship):
+    descendants = False
+
+
+class AdjacencyRootPath(AdjacencyMixin, Relationship):
+    descendants = False
+    include_self = True
@@ -0,0 +1,123 @@
+from django.db.models import (
+    BooleanField,
+    Count,
+    Exists,
+    Expression,
+    IntegerField,
+    Subquery,
+    Value,
+)
+
+from relativity.fields import Relationship, correlated_queryset
+
+
+class RelationshipAggregate(Expression):
+    """
+    Computes an aggregate over the objects related to each row by the relation
+    field called name, in a correlated subquery. Unlike aggregating across a
+    join, this doesn't multiply rows, so it can be combined freely with other
+    annotations.
+
+        Page.objects.annotate(total_size=RelationshipAggregate(
+            "descendants", Sum("size"), filter=Q(published=True),
+        ))
+    """
+
+    def __init__(self, name, aggregate, filter=None, output_field=None):
+        super(RelationshipAggregate, self).__init__(output_field=output_field)
+        self.name = name
+        self.aggregate = aggregate
+        self.filter = filter
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.name, self.aggregate)
+
+    @property
+    def default_alias(self):
+        return "%s__%s" % (self.name, self.aggregate.default_alias)
+
+    def get_queryset(self, query):
+        field = query.model._meta.get_field(self.name)
+        queryset = correlated_queryset(field)
+        if self.filter is not None:
+            queryset = queryset.filter(self.filter)
+        return queryset.order_by()
+
+    def get_subquery(self, queryset):
+        # Grouping by a constant makes values() aggregate over the whole
+        # subquery; the constant is left out of GROUP BY, so a single row is
+        # returned even when there are no related objects.
+        queryset = (
+            queryset.annotate(_relativity_group=Value(1))
+            .values("_relativity_group")
+            .annotate(_relativity_result=self.aggregate)
+            .values("_relativity_result")
+        )
+        output_field = self._output_field_or_none
+        if output_field is None:
+            return Subquery(queryset)
+        return Subquery(queryset, output_field=output_field)
+
+    def resolve_expression(
+        self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False
+    ):
+        subquery = self.get_subquery(self.get_queryset(query))
+        return subquery.resolve_expression(
+            query, allow_joins, reuse, summarize, for_save
+        )
+
+
+class RelationshipCount(RelationshipAggregate):
+    """
+    Counts the objects related to each row by the relation field called name.
+    """
+
+    def __init__(self, name, filter=None, distinct=False):
+        super(RelationshipCount, self).__init__(
+            name,
+            Count("pk", distinct=distinct),
+            filter=filter,
+            output_field=IntegerField(),
+        )
+
+    @property
+    def default_alias(self):
+        return "%s__count" % self.name
+
+    def resolve_expression(
+        self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False
+    ):
+        # Some relationships, such as the descendants of a nested set node,
+        # can be counted from the row's own columns.
+        field = query.model._meta.get_field(self.name)
+        if self.filter is None and isinstance(field, Relationship):
+            expression = field.get_count_expression()
+            if expression is not None:
+                return expression.resolve_expression(
+                    query, allow_joins, reuse, summarize, for_save
+                )
+        return super(RelationshipCount, self).resolve_expression(
+            query, allow_joins, reuse, summarize, for_save
+        )
+
+
+class RelationshipExists(RelationshipAggregate):
+    """
+    Whether any objects are related to each row by the relation field called
+    name.
+    """
+
+    def __init__(self, name, filter=None):
+        super(RelationshipExists, self).__init__(
+            name, None, filter=filter, output_field=BooleanField()
+        )
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+    @property
+    def default_alias(self):
+        return "%s__exists" % self.name
+
+    def get_subquery(self, queryset):
+        return Exists(queryset)
@@ -0,0 +1,310 @@
+"""
+Evaluates Relationship predicates against Python objects, so that related
+objects which are already in memory can be matched up without a query.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import bisect
+import operator
+import re
+from collections import OrderedDict, defaultdict
+
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ObjectDoesNotExist,
+    ValidationError,
+)
+from django.db.models import F, Model, Q, Value
+from django.db.models.constants import LOOKUP_SEP
+
+
+def _regex(flags=0):
+    return lambda value, pattern: re.search(pattern, value, flags) is not None
+
+
+# Functions implementing lookups in Python, taking the value of the field and
+# the value it's compared against. Lookups registered with Django can be added
+# here too, e.g. python_lookups["ne"] = operator.ne.
+python_lookups = {
+    "exact": operator.eq,
+    "iexact": lambda value, other: value.lower() == other.lower(),
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "in": lambda value, other: value in other,
+    "range": lambda value, other: other[0] <= value <= other[1],
+    "contains": lambda value, other: other in value,
+    "icontains": lambda value, other: other.lower() in value.lower(),
+    "startswith": lambda value, other: value.startswith(other),
+    "istartswith": lambda value, other: value.lower().startswith(other.lower()),
+    "endswith": lambda value, other: value.endswith(other),
+    "iendswith": lambda value, other: value.lower().endswith(other.lower()),
+    "regex": _regex(),
+    "iregex": _regex(re.IGNORECASE),
+}
+
+_range_lookups = {"gt", "gte", "lt", "lte"}
+
+_lookup_paths = {}
+
+
+class LookupPath(object):
+    """
+    A lookup on a model, split into the attributes to follow from an instance,
+    the field at the end of them and the name of the lookup.
+    """
+
+    def __init__(self, attnames, field, lookup):
+        self.attnames = attnames
+        self.field = field
+        self.lookup = lookup
+
+    @classmethod
+    def get(cls, model, lookup):
+        key = (model, lookup)
+        try:
+            return _lookup_paths[key]
+        except KeyError:
+            path = _lookup_paths[key] = cls.parse(model, lookup)
+            return path
+
+    @classmethod
+    def parse(cls, model, lookup):
+        parts = lookup.split(LOOKUP_SEP)
+        opts, field, attnames = model._meta, None, []
+        while parts and opts is not None:
+            try:
+                field = opts.pk if parts[0] == "pk" else opts.get_field(parts[0])
+            except FieldDoesNotExist:
+                break
+            parts.pop(0)
+            if not field.is_relation:
+                attnames.append(field.attname)
+                opts = None
+            elif field.concrete and (field.many_to_one or field.one_to_one):
+                if parts and parts[0] not in python_lookups:
+                    attnames.append(field.name)
+                    opts = field.related_model._meta
+                else:
+                    # Compare the foreign key's value rather than load the
+                    # related object.
+                    attnames.append(field.attname)
+                    field = field.target_field
+                    opts = None
+            else:
+                if hasattr(field, "get_accessor_name") and not field.concrete:
+                    attnames.append(field.get_accessor_name() or field.name)
+                else:
+                    attnames.append(field.name)
+                opts = field.related_model._meta
+        if opts is not None:
+            # The lookup ends at a related model, so compare primary keys.
+            field = opts.pk
+            attnames.append(field.attname)
+        if len(parts) > 1 or not attnames:
+            raise ValueError("Can't evaluate the lookup %r in Python" % lookup)
+        lookup_name = parts[0] if parts else "exact"
+        if lookup_name not in python_lookups and lookup_name != "isnull":
+            raise ValueError("Can't evaluate the lookup %r in Python" % lookup)
+        return cls(attnames, field, lookup_name)
+
+    def values(self, obj, attnames=None):
+        """
+        Yield the values at the end of the path from obj. Following a
+        multi-valued relation yields a value for each related object.
+        """
+        attnames = self.attnames if attnames is None else attnames
+        if not attnames:
+            yield obj
+            return
+        try:
+            value = getattr(obj, attnames[0])
+        except ObjectDoesNotExist:
+            value = None
+        if value is None and len(attnames) > 1:
+            yield None
+        elif hasattr(value, "all") and not isinstance(value, Model):
+            for related in value.all():
+                for v in self.values(related, attnames[1:]):
+                    yield v
+        else:
+            for v in self.values(value, attnames[1:]):
+                yield v
+
+    def prepare(self, value):
+        if self.lookup in ("in", "range"):
+            return [self._to_python(v) for v in value]
+        elif self.lookup in _range_lookups or self.lookup == "exact":
+            return self._to_python(value)
+        return value
+
+    def _to_python(self, value):
+        if isinstance(value, Model):
+            return value.pk
+        try:
+            return self.field.to_python(value)
+        except ValidationError:
+            return value
+
+    def test(self, obj, value, literal):
+        if self.lookup == "isnull":
+            values = list(self.values(obj)) or [None]
+            return any((v is None) == bool(value) for v in values)
+        if value is None:
+            # As in Django, comparing with a literal None means IS NULL, while
+            # comparing with a column that is NULL matches nothing.
+            if literal and self.lookup == "exact":
+                return any(v is None for v in self.values(obj))
+            return False
+        function = python_lookups[self.lookup]
+        value = self.prepare(value)
+        return any(v is not None and function(v, value) for v in self.values(obj))
+
+
+def evaluate_value(value, local, related):
+    """
+    Return the Python value of the right hand side of a lookup, in which L()
+    refers to local and F() to related.
+    """
+    if hasattr(value, "_relativity_resolve_for_instance"):
+        return value._relativity_resolve_for_instance(local)
+    elif isinstance(value, F):
+        path = LookupPath.get(type(related), value.name)
+        return next(path.values(related), None)
+    elif isinstance(value, Value):
+        return value.value
+    elif hasattr(value, "resolve_expression"):
+        raise ValueError("Can't evaluate %r in Python" % value)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return [evaluate_value(v, local, related) for v in value]
+    return value
+
+
+def evaluate_predicate(predicate, local, related):
+    """
+    Return whether a predicate relates the objects local and related.
+    """
+    if callable(predicate):
+        predicate = predicate()
+    if type(predicate) is not Q:
+        if hasattr(predicate, "_relativity_evaluate"):
+            return predicate._relativity_evaluate(local, related)
+        raise ValueError("Can't evaluate %r in Python" % predicate)
+
+    def evaluate_child(child):
+        if isinstance(child, Q):
+            return evaluate_predicate(child, local, related)
+        lookup, value = child
+        path = LookupPath.get(type(related), lookup)
+        literal = not hasattr(value, "resolve_expression")
+        return path.test(related, evaluate_value(value, local, related), literal)
+
+    if predicate.connector == Q.AND:
+        result = all(evaluate_child(c) for c in predicate.children)
+    else:
+        result = any(evaluate_child(c) for c in predicate.children)
+    return not result if predicate.negated else result
+
+
+class _Index(object):
+    """
+    Narrows down the candidates that might match a local object, by looking
+    up the fields the predicate compares for equality with L()s in a dict, and
+    bisecting a list sorted by a field it compares with L()s by range.
+    """
+
+    def __init__(self, predicate, model, candidates):
+        self.equal, self.bounds = [], []
+        if type(predicate) is Q and predicate.connector == Q.AND:
+            if not predicate.negated:
+                self.plan(predicate.children, model)
+
+        range_attname = self.bounds[0][0].attnames[0] if self.bounds else None
+        buckets = defaultdict(list)
+        for candidate in candidates:
+            key = tuple(getattr(candidate, p.attnames[0]) for p, _ in self.equal)
+            if range_attname is None:
+                buckets[key].append(candidate)
+            elif getattr(candidate, range_attname) is not None:
+                buckets[key].append((getattr(candidate, range_attname), candidate))
+        if range_attname is not None:
+            for key, bucket in buckets.items():
+                bucket.sort(key=operator.itemgetter(0))
+                buckets[key] = ([k for k, _ in bucket], [c for _, c in bucket])
+        self.buckets = buckets
+
+    def plan(self, children, model):
+        for child in children:
+            if type(child) is not tuple:
+                continue
+            lookup, value = child
+            if not hasattr(value, "_relativity_resolve_for_instance"):
+                continue
+            try:
+                path = LookupPath.get(model, lookup)
+            except ValueError:
+                continue
+            if len(path.attnames) != 1:
+                continue
+            if path.lookup == "exact":
+                self.equal.append((path, value))
+            elif path.lookup in _range_lookups:
+                if not self.bounds or path.attnames == self.bounds[0][0].attnames:
+                    self.bounds.append((path, value))
+
+    def candidates(self, local):
+        try:
+            key = tuple(
+                path.prepare(value._relativity_resolve_for_instance(local))
+                for path, value in self.equal
+            )
+        except (AttributeError, TypeError):
+            return None
+        bucket = self.buckets.get(key, ())
+        if not self.bounds:
+            return bucket
+        if not bucket:
+            return []
+        keys, candidates = bucket
+        start, end = 0, len(keys)
+        for path, value in self.bounds:
+            bound = path.prepare(value._relativity_resolve_for_instance(local))
+            if bound is None:
+                return []
+            if path.lookup == "gt":
+                start = max(start, bisect.bisect_right(keys, bound))
+            elif path.lookup == "gte":
+                start = max(start, bisect.bisect_left(keys, bound))
+            elif path.lookup == "lt":
+                end = min(end, bisect.bisect_left(keys, bound))
+            else:
+                end = min(end, bisect.bisect_right(keys, bound))
+        return candidates[start:end]
+
+
+def resolve_in_memory(predicate, instances, candidates, model=None):
+    """
+    Match up local instances with the candidates related to them by predicate,
+    returning an OrderedDict mapping each instance's pk to a list of its
+    related candidates.
+    """
+    if callable(predicate):
+        predicate = predicate()
+    instances, candidates = list(instances), list(candidates)
+    if model is None and candidates:
+        model = type(candidates[0])
+    index = _Index(predicate, model, candidates) if model is not None else None
+
+    result = OrderedDict()
+    for local in instances:
+        narrowed = index.candidates(local) if index is not None else None
+        if narrowed is None:
+            narrowed = candidates
+        result[local.pk] = [
+            candidate
+            for candidate in narrowed
+            if evaluate_predicate(predicate, local, candidate)
+        ]
+    return result
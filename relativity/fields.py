@@ -1,19 +1,344 @@
 from __future__ import unicode_literals, absolute_import
 
 import copy
-from collections import OrderedDict
+import functools
+import itertools
+import operator
+import time
+from collections import OrderedDict, defaultdict, deque
 
 import django
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
 from django.db import models, connections
-from django.db.models import F, ForeignObject, Value
+from django.db.models import (
+    Exists,
+    F,
+    ForeignObject,
+    Func,
+    OuterRef,
+    Value,
+)
+from django.db.backends.utils import truncate_name
+from django.db.models.expressions import Col
+from django.db.models.fields.related import lazy_related_operation
 from django.db.models.fields.related_descriptors import (
     ReverseManyToOneDescriptor,
     ReverseOneToOneDescriptor,
 )
 from django.db.models.fields.reverse_related import ForeignObjectRel
+from django.db.models.constants import LOOKUP_SEP
 from django.db.models.query_utils import PathInfo, Q
+from django.db.models.sql import Query
 from django.utils.functional import cached_property
 
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
+try:
+    from django.db.models.query import MAX_GET_RESULTS
+except ImportError:  # Django < 3.0
+    MAX_GET_RESULTS = 21
+
+from relativity import signals
+from relativity.evaluate import evaluate_predicate, resolve_in_memory
+from relativity.materialized import connect_materialized_signals
+from relativity.statements import (
+    InstanceParameter,
+    Statement,
+    StatementIterable,
+    query_key,
+)
+
+
+def _referenced_aliases(expr):
+    """
+    Return the set of table aliases referenced by a resolved expression tree,
+    or None if the tree contains anything whose aliases we can't account for
+    (e.g. a subquery or an unresolved reference).
+    """
+    if isinstance(expr, (Query, F)):
+        return None
+    aliases = set()
+    if isinstance(expr, Col):
+        aliases.add(expr.alias)
+    if hasattr(expr, "get_source_expressions"):
+        for source_expr in expr.get_source_expressions():
+            if source_expr is None:
+                continue
+            source_aliases = _referenced_aliases(source_expr)
+            if source_aliases is None:
+                return None
+            aliases |= source_aliases
+    return aliases
+
+
+def _predicate_references(q):
+    """
+    Return the sets of field names that a predicate looks up on the related
+    model and refers to with L() on the local model. Raise ValueError if the
+    predicate's lookups can't be inspected.
+    """
+    if type(q) is not Q:
+        raise ValueError("Can't inspect %r" % q)
+    lookup_names, local_names = set(), set()
+    for child in q.children:
+        if isinstance(child, Q):
+            child_lookups, child_locals = _predicate_references(child)
+            lookup_names |= child_lookups
+            local_names |= child_locals
+        else:
+            lookup, value = child
+            lookup_names.add(lookup.split(LOOKUP_SEP)[0])
+            local_names |= _local_references(value)
+    return lookup_names, local_names
+
+
+def _local_references(expr):
+    if isinstance(expr, L):
+        if type(expr) is not L:
+            raise ValueError("Can't inspect %r" % expr)
+        return {expr.name.split(LOOKUP_SEP)[0]}
+    names = set()
+    for source_expr in getattr(expr, "get_source_expressions", list)():
+        names |= _local_references(source_expr)
+    return names
+
+
+def _local_lookups(expr):
+    if isinstance(expr, L):
+        yield expr.name
+    for source_expr in getattr(expr, "get_source_expressions", list)():
+        for name in _local_lookups(source_expr):
+            yield name
+
+
+def _contains_local_reference(expr):
+    if isinstance(expr, L):
+        return True
+    return any(
+        _contains_local_reference(source_expr)
+        for source_expr in getattr(expr, "get_source_expressions", list)()
+    )
+
+
+def _contains_related_reference(expr):
+    if isinstance(expr, F):
+        return not isinstance(expr, L)
+    return any(
+        _contains_related_reference(source_expr)
+        for source_expr in getattr(expr, "get_source_expressions", list)()
+    )
+
+
+def _bind_predicate(q, model, bind):
+    """
+    Return a copy of the predicate q, whose lookups are on model, in which
+    each (lookup, value) pair is replaced by bind(lookup, value). q may be any
+    tree of Qs, combined with AND or OR and negated. Return None if q or any
+    of its lookups can't be bound.
+    """
+    if hasattr(q, "translate"):
+        q = q.translate(model)
+    if type(q) is not Q:
+        return None
+    bound = Q()
+    bound.connector, bound.negated = q.connector, q.negated
+    for child in q.children:
+        if isinstance(child, Q):
+            child = _bind_predicate(child, model, bind)
+        elif isinstance(child, tuple):
+            child = bind(*child)
+        elif _contains_local_reference(child):
+            child = None
+        if child is None:
+            return None
+        bound.children.append(child)
+    return bound
+
+
+def _predicate_lookups(q):
+    for child in q.children:
+        if isinstance(child, Q):
+            for lookup in _predicate_lookups(child):
+                yield lookup
+        elif isinstance(child, tuple):
+            yield child[0]
+
+
+def _predicate_children(q):
+    for child in q.children:
+        if isinstance(child, Q):
+            for lookup in _predicate_children(child):
+                yield lookup
+        elif isinstance(child, tuple):
+            yield child
+
+
+def _follows_many(model, lookup):
+    """
+    Return whether lookup follows a relation which can have many objects, so
+    that filtering on it can select the same object more than once.
+    """
+    for name in lookup.split(LOOKUP_SEP)[:-1]:
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return False
+        if not field.is_relation:
+            return False
+        if not field.concrete:
+            return True
+        model = field.related_model
+    return False
+
+
+def _followed_relations(model, lookup):
+    """
+    Yield the path and model of each relation that lookup follows from model
+    to read a field of the related model.
+    """
+    names = lookup.split(LOOKUP_SEP)
+    for i, name in enumerate(names[:-1]):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return
+        if not field.is_relation:
+            return
+        model = field.related_model
+        try:
+            model._meta.get_field(names[i + 1])
+        except FieldDoesNotExist:
+            if names[i + 1] != "pk":
+                return
+        yield LOOKUP_SEP.join(names[: i + 1]), model
+
+
+def _filter_arguments(model, q):
+    """
+    Return the keyword arguments to filter() equivalent to q, which need a
+    subquery unless q is a plain AND of lookups.
+    """
+    if q.connector == Q.AND and not q.negated:
+        if all(type(c) == tuple for c in q.children):
+            return dict(q.children)
+    return {"pk__in": model._base_manager.filter(q).values("pk")}
+
+
+def _bind_to_instance(value, obj):
+    if isinstance(value, L):
+        return value._relativity_resolve_for_instance(obj)
+    elif _contains_local_reference(value):
+        return InstanceBoundExpression(value, obj)
+    else:
+        return value
+
+
+class InstanceBoundExpression(object):
+    """
+    Wraps an expression containing L()s so that they resolve to the values of
+    an instance's fields, leaving the expression itself untouched.
+    """
+
+    filterable = True
+
+    def __init__(self, expression, instance):
+        self.expression = expression
+        self.instance = instance
+
+    def get_source_expressions(self):
+        return [self.expression]
+
+    def resolve_expression(self, query=None, *args, **kwargs):
+        previous = getattr(query, "_relativity_instance", None)
+        query._relativity_instance = self.instance
+        try:
+            return self.expression.resolve_expression(query, *args, **kwargs)
+        finally:
+            query._relativity_instance = previous
+
+
+class RelatedInstanceLookup(object):
+    """
+    A lookup of the predicate made against the values of a related instance
+    rather than a column, e.g. size__gte=L("fsize") becomes 3 >= fsize for a
+    product of size 3, so that the local objects related to it can be selected
+    without a join. The L()s refer to the local model being queried.
+    """
+
+    conditional = True
+
+    def __init__(self, lookup_class, lhs, rhs):
+        self.lookup_class = lookup_class
+        self.lhs = lhs
+        self.rhs = rhs
+
+    @classmethod
+    def bind(cls, obj, lookup, value, parameterise=False):
+        """
+        Return the lookup, on obj's model, applied to obj, or None if it follows
+        a relation or its value refers to another of obj's fields. With
+        parameterise, obj may be the model itself, and the lookup is applied to
+        an InstanceParameter instead of obj's value.
+        """
+        if _contains_related_reference(value):
+            return None
+        parts = lookup.split(LOOKUP_SEP)
+        opts = obj._meta
+        try:
+            field = opts.pk if parts[0] == "pk" else opts.get_field(parts[0])
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete:
+            return None
+        output_field = field.target_field if field.is_relation else field
+        if parameterise:
+            lhs = InstanceParameter(operator.attrgetter(field.attname), output_field)
+        else:
+            lhs = Value(getattr(obj, field.attname), output_field=output_field)
+        lookup_name = "exact"
+        for i, part in enumerate(parts[1:], 2):
+            if i == len(parts) and lhs.get_lookup(part) is not None:
+                lookup_name = part
+            elif lhs.get_transform(part) is not None:
+                lhs = lhs.get_transform(part)(lhs)
+            else:
+                return None
+        if lookup_name == "exact" and value is None:
+            lookup_name, value = "isnull", True
+        return cls(lhs.get_lookup(lookup_name), lhs, value)
+
+    def resolve_expression(
+        self, query=None, allow_joins=True, reuse=None, summarize=False, **kwargs
+    ):
+        rhs = self.rhs
+        if hasattr(rhs, "resolve_expression"):
+            # Outside a join, L() would refer to an outer query.
+            previous = query.__dict__.get("_relationship_field_query")
+            query._relationship_field_query = query
+            try:
+                rhs = rhs.resolve_expression(query, allow_joins, reuse, summarize)
+            finally:
+                if previous is None:
+                    del query._relationship_field_query
+                else:
+                    query._relationship_field_query = previous
+        lhs = self.lhs.resolve_expression(query, allow_joins, reuse, summarize)
+        return self.lookup_class(lhs, rhs)
+
+
+class OuterCol(Col):
+    """
+    A column of the outer query, referred to from a subquery built while the
+    outer query is being compiled. It keeps its alias when the subquery's
+    aliases are relabelled, even if they clash.
+    """
+
+    def relabeled_clone(self, relabels):
+        return self
+
 
 class Restriction(object):
     def __init__(
@@ -24,6 +349,8 @@ class Restriction(object):
         local_alias,
         related_alias,
         predicate,
+        cache=None,
+        field=None,
     ):
         self.forward = forward
         self.local_model = local_model
@@ -31,20 +358,19 @@ class Restriction(object):
         self.related_alias = related_alias
         self.local_alias = local_alias
         self.predicate = predicate
+        self.cache = cache
+        self.field = field
 
-    def as_sql(self, compiler, connection):
+    def resolve_predicate(self, compiler, swap):
         local, related = self.local_alias, self.related_alias
         alias_map = compiler.query.alias_map
 
-        assert {local, related} <= set(alias_map)
-
         aliases_local = OrderedDict({local: alias_map[local]})
         aliases_local.update(alias_map)
         aliases_related = OrderedDict({related: alias_map[related]})
         aliases_related.update(alias_map)
 
-        alias_list = list(alias_map)
-        if (alias_list.index(local) < alias_list.index(related)) ^ self.forward:
+        if swap:
             aliases_local, aliases_related = aliases_related, aliases_local
 
         field_query = compiler.query.clone()
@@ -66,10 +392,162 @@ class Restriction(object):
         q = predicate.resolve_expression(
             query=lookup_query, allow_joins=True, reuse=compiler.query.used_aliases
         )
+
+        # Joins to other tables can't be added to the query while it's being
+        # compiled, so if the predicate needs any, test it in a subquery.
+        if set(lookup_query.alias_map) - set(alias_map):
+            related_alias = next(iter(aliases_related))
+            q = self.resolve_predicate_subquery(
+                compiler, field_query, related_alias, predicate
+            )
+            return q, False
+
+        # The resolved predicate can only be reused in another query if it
+        # refers to nothing but the two tables being joined.
+        referenced = _referenced_aliases(q)
+        cacheable = (
+            not callable(self.predicate)
+            and set(field_query.alias_map) == set(alias_map)
+            and set(lookup_query.alias_map) == set(alias_map)
+            and referenced is not None
+            and referenced <= {local, related}
+        )
+        return q, cacheable
+
+    def resolve_predicate_subquery(
+        self, compiler, field_query, related_alias, predicate
+    ):
+        """
+        Return an EXISTS subquery which tests the predicate against a copy of
+        the related row, joined to whatever else it refers to.
+        """
+        related_pk = self.related_model._meta.pk
+        inner = Query(self.related_model)
+        inner._relationship_field_query = field_query
+        inner._relativity_outer_columns = True
+        inner.add_q(predicate)
+        inner.add_q(Q(pk=OuterCol(related_alias, related_pk)))
+        del inner._relationship_field_query, inner._relativity_outer_columns
+        queryset = models.QuerySet(self.related_model, query=inner)
+        return Exists(queryset).resolve_expression(query=compiler.query)
+
+    def as_sql(self, compiler, connection):
+        instrumented = self.field is not None and signals.predicate_resolved.receivers
+        start = time.perf_counter() if instrumented else None
+
+        local, related = self.local_alias, self.related_alias
+        alias_map = compiler.query.alias_map
+
+        assert {local, related} <= set(alias_map)
+
+        alias_list = list(alias_map)
+        swap = (alias_list.index(local) < alias_list.index(related)) ^ self.forward
+
+        # Resolving the predicate means cloning the whole query, so we keep the
+        # resolved predicate for each alias layout and relabel it to fit
+        # whichever aliases this join has been given.
+        key = (
+            self.forward,
+            self.local_model,
+            self.related_model,
+            swap,
+            connection.vendor,
+        )
+        cached = self.cache is not None and key in self.cache
+        if cached:
+            cached_local, cached_related, cached_q = self.cache[key]
+            q = cached_q.relabeled_clone({cached_local: local, cached_related: related})
+        else:
+            q, cacheable = self.resolve_predicate(compiler, swap)
+            if cacheable and self.cache is not None:
+                self.cache[key] = (local, related, q.relabeled_clone({}))
+
         result = compiler.compile(q)
+        if instrumented:
+            signals.predicate_resolved.send(
+                sender=self.field.model,
+                field=self.field,
+                forward=self.forward,
+                cached=cached,
+                duration=time.perf_counter() - start,
+            )
         return result
 
 
+def _send_filter_fallback(field, obj, reason):
+    if signals.filter_fallback.receivers:
+        signals.filter_fallback.send(
+            sender=field.model, field=field, obj=obj, reason=reason
+        )
+
+
+def _filter_for_instance(queryset, rel, instance, manager_class, limit=None):
+    """
+    Filter queryset, of rel's related model, for the objects related to
+    instance, of which at most limit are fetched. If the relationship caches
+    statements, the filter is deferred so that, unless the queryset is
+    changed, its objects are fetched by the statement compiled for all
+    instances.
+    """
+    relationship = rel if isinstance(rel, Relationship) else rel.field
+    q = rel.field.get_instance_filter(instance)
+    if not relationship.cache_statements or not hasattr(queryset, "_deferred_filter"):
+        queryset = queryset.filter(q)
+        return queryset if limit is None else queryset.order_by()[:limit]
+    queryset._defer_next_filter = True
+    queryset = queryset.filter(q)
+    queryset._iterable_class = StatementIterable
+    queryset._relativity_statement = (
+        functools.partial(relationship._get_statement, rel, manager_class, limit),
+        instance,
+    )
+    return queryset
+
+
+def _count_prefetch_matches(field, instances, result, start):
+    """
+    Wrap the functions that prefetch_related_objects() uses to match up the
+    objects returned by get_prefetch_queryset() with instances, to count the
+    matches and send prefetch_matched once the last instance is looked up.
+    """
+    queryset, rel_obj_attr, instance_attr = result[:3]
+    rows = defaultdict(int)
+    state = {"remaining": len(instances), "matched": 0}
+
+    def counting_rel_obj_attr(rel_obj):
+        value = rel_obj_attr(rel_obj)
+        rows[value] += 1
+        return value
+
+    def counting_instance_attr(inst):
+        value = instance_attr(inst)
+        if value in rows:
+            state["matched"] += rows.pop(value)
+        state["remaining"] -= 1
+        if not state["remaining"]:
+            unmatched = sum(rows.values())
+            signals.prefetch_matched.send(
+                sender=field.model,
+                field=field,
+                instances=len(instances),
+                rows=state["matched"] + unmatched,
+                matched=state["matched"],
+                unmatched=unmatched,
+                duration=time.perf_counter() - start,
+            )
+        return value
+
+    return (queryset, counting_rel_obj_attr, counting_instance_attr) + tuple(result[3:])
+
+
+def _record_selected_key(rel, instance, key):
+    """
+    Remember the values which selected the object cached for rel on instance,
+    e.g. by select_related(), so that it's discarded once they change.
+    """
+    instance.__dict__["_relativity_selected_%s" % rel.get_cache_name()] = key
+
+
 def create_relationship_many_manager(base_manager, rel):
 
     # noinspection PyProtectedMember
@@ -79,7 +557,6 @@ def create_relationship_many_manager(base_manager, rel):
             self.instance = instance
             self.model = rel.related_model
             self.field = rel.field
-            self.core_filters = {self.field.name: instance}
 
         def __call__(self, **kwargs):
             manager = getattr(self.model, kwargs.pop("manager"))
@@ -95,8 +572,7 @@ def create_relationship_many_manager(base_manager, rel):
             queryset._add_hints(instance=self.instance)
             if self._db:
                 queryset = queryset.using(self._db)
-            queryset = queryset.filter(**self.core_filters)
-            return queryset
+            return _filter_for_instance(queryset, rel, self.instance, base_manager)
 
         def _remove_prefetched_objects(self):
             try:
@@ -115,35 +591,97 @@ def create_relationship_many_manager(base_manager, rel):
                 queryset = super(RelationshipManager, self).get_queryset()
                 return self._apply_rel_filters(queryset)
 
+        def _count_without_query(self):
+            prefetched = getattr(self.instance, "_prefetched_objects_cache", {})
+            if (
+                isinstance(rel, Relationship)
+                and self.field.relationship_related_query_name() not in prefetched
+                and not super(RelationshipManager, self).get_queryset().query.where
+            ):
+                return rel.get_count_for_instance(self.instance)
+            return None
+
+        def count(self):
+            count = self._count_without_query()
+            if count is not None:
+                return count
+            return super(RelationshipManager, self).count()
+
+        async def acount(self):
+            count = self._count_without_query()
+            if count is not None:
+                return count
+            return await sync_to_async(self.count)()
+
         def get_prefetch_queryset(self, instances, queryset=None):
+            if not signals.prefetch_matched.receivers:
+                return self._get_prefetch_queryset(instances, queryset)
+            start = time.perf_counter()
+            result = self._get_prefetch_queryset(instances, queryset)
+            relationship = rel if isinstance(rel, Relationship) else rel.field
+            return _count_prefetch_matches(relationship, instances, result, start)
+
+        def _get_prefetch_queryset(self, instances, queryset=None):
             if queryset is None:
                 queryset = super(RelationshipManager, self).get_queryset()
 
             queryset._add_hints(instance=instances[0])
             queryset = queryset.using(queryset._db or self._db)
 
-            query = {"%s__in" % self.field.name: instances}
-            queryset = queryset._next_is_sticky().filter(**query)
+            # If the predicate is just a set of equalities, this is the same as
+            # prefetching a foreign key and we can avoid the join altogether.
+            relationship = rel if isinstance(rel, Relationship) else rel.field
+            equalities = relationship._equality_predicate
+            if equalities is not None and (rel is relationship or not equalities[1]):
+                return self._get_prefetch_queryset_by_value(
+                    instances, queryset, rel is relationship, *equalities
+                )
+
+            if rel is relationship and not relationship.materialize:
+                nested_set = relationship.get_nested_set_fields()
+                if nested_set is not None:
+                    return self._get_prefetch_queryset_by_intervals(
+                        instances, queryset, *nested_set
+                    )
+
+            if getattr(rel, "enumerates_related_values", False):
+                return self._get_prefetch_queryset_by_enumeration(instances, queryset)
+
+            # The values of the local pks are read from the join.
+            if isinstance(queryset, RelationshipQuerySet):
+                queryset = queryset.filter_strategy("join")
 
             # For non-autocreated 'through' models, can't assume we are
             # dealing with PK values.
             pk = rel.model._meta.pk
-
-            # table_map here contains a map of tables to used aliases - in the case
-            # that this is a recursive relationship we want the most recent alias,
-            # i.e. the joined table, not the base table.
-            join_table = queryset.query.table_map[pk.model._meta.db_table][-1]
             connection = connections[queryset.db]
-            compiler = queryset.query.get_compiler(using=queryset.db)
-            qn = compiler.quote_name_unless_alias
-            queryset = queryset.extra(
-                select={
-                    "_prefetch_related_val_%s"
-                    % f.attname: "%s.%s"
-                    % (qn(join_table), qn(f.column))
-                    for f in [pk]
-                }
-            )
+
+            def filter_batch(batch):
+                query = {"%s__in" % self.field.name: batch}
+                batch_queryset = queryset._next_is_sticky().filter(**query)
+
+                # table_map here contains a map of tables to used aliases - in the
+                # case that this is a recursive relationship we want the most
+                # recent alias, i.e. the joined table, not the base table.
+                if relationship.materialize:
+                    # The filter is answered from the materialized table.
+                    through = relationship.through._meta
+                    db_table = through.db_table
+                    column = through.get_field(
+                        "local" if rel is relationship else "related"
+                    ).column
+                else:
+                    db_table, column = pk.model._meta.db_table, pk.column
+                join_table = batch_queryset.query.table_map[db_table][-1]
+                compiler = batch_queryset.query.get_compiler(using=queryset.db)
+                qn = compiler.quote_name_unless_alias
+                return batch_queryset.extra(
+                    select={
+                        "_prefetch_related_val_%s"
+                        % pk.attname: "%s.%s"
+                        % (qn(join_table), qn(column))
+                    }
+                )
 
             def rel_obj_attr(result):
                 return tuple(
@@ -157,6 +695,29 @@ def create_relationship_many_manager(base_manager, rel):
                     for f in [pk]
                 )
 
+            pairs = None
+            if not relationship.materialize:
+                pairs = relationship.get_prefetch_pairs(
+                    [getattr(inst, pk.attname) for inst in instances],
+                    rel is relationship,
+                    queryset.db,
+                )
+            if pairs is not None:
+                keys = defaultdict(list)
+                for local_pk, related_pk in pairs:
+                    keys[related_pk].append((local_pk,))
+                return self._get_prefetch_queryset_by_keys(
+                    instances, queryset, keys, instance_attr
+                )
+
+            strategy = getattr(queryset, "_relationship_prefetch_strategy", None)
+            if (strategy or relationship.prefetch_strategy) == "pairs":
+                return self._get_prefetch_queryset_by_pairs(
+                    instances, queryset, filter_batch, instance_attr
+                )
+
+            queryset = self._filter_in_batches(queryset, list(instances), filter_batch)
+
             if not self.field.multiple:
                 instances_dict = {instance_attr(inst): inst for inst in instances}
                 for rel_obj in queryset:
@@ -171,6 +732,330 @@ def create_relationship_many_manager(base_manager, rel):
                 self.field.relationship_related_query_name(),
             ) + ((False,) if django.VERSION[0] >= 2 else ())
 
+        def _filter_in_batches(
+            self, queryset, values, filter_batch, params_per_value=1
+        ):
+            """
+            Return filter_batch(values), or if that would exceed the database's
+            limit on query parameters, queryset with the combined results of
+            filter_batch() over batches of values already fetched.
+            """
+            connection = connections[queryset.db]
+            limits = []
+            max_in_list_size = connection.ops.max_in_list_size()
+            if max_in_list_size:
+                limits.append(max_in_list_size)
+            max_query_params = connection.features.max_query_params
+            if (
+                max_query_params
+                and len(values) * params_per_value > max_query_params // 2
+            ):
+                try:
+                    compiler = filter_batch(values[:1]).query.get_compiler(
+                        using=queryset.db
+                    )
+                    sql, params = compiler.as_sql()
+                    base_params = len(params) - params_per_value
+                except EmptyResultSet:
+                    base_params = 0
+                limits.append(
+                    max(1, (max_query_params - base_params) // params_per_value)
+                )
+
+            batch_size = min(limits) if limits else None
+            if batch_size is None or len(values) <= batch_size:
+                self._send_prefetch_batch(len(values), 1)
+                return filter_batch(values)
+
+            results = []
+            batches = -(-len(values) // batch_size)
+            for start in range(0, len(values), batch_size):
+                batch = values[start : start + batch_size]
+                self._send_prefetch_batch(len(batch), batches)
+                results.extend(filter_batch(batch).prefetch_related(None))
+            queryset = queryset._clone()
+            queryset._result_cache = results
+            return queryset
+
+        def _send_prefetch_batch(self, size, batches):
+            if signals.prefetch_batch.receivers:
+                relationship = rel if isinstance(rel, Relationship) else rel.field
+                signals.prefetch_batch.send(
+                    sender=relationship.model,
+                    field=relationship,
+                    size=size,
+                    batches=batches,
+                )
+
+        def _get_prefetch_queryset_by_value(
+            self, instances, queryset, forward, pairs, constants
+        ):
+            """
+            Select the related objects by the values of the local fields and
+            match them to instances in Python, as Django does for foreign keys.
+            Values are compared after conversion by the related model's field,
+            so matching may differ from the database's on case-insensitive
+            collations.
+            """
+            related_fields = [related_field for related_field, _ in pairs]
+            local_fields = [local_field for _, local_field in pairs]
+            if forward:
+                instance_fields, rel_obj_fields = local_fields, related_fields
+            else:
+                instance_fields, rel_obj_fields = related_fields, local_fields
+
+            def make_key(obj, fields):
+                return tuple(
+                    related_field.to_python(getattr(obj, f.attname))
+                    for related_field, f in zip(related_fields, fields)
+                )
+
+            def rel_obj_attr(result):
+                return make_key(result, rel_obj_fields)
+
+            def instance_attr(inst):
+                return make_key(inst, instance_fields)
+
+            def filter_batch(batch):
+                if len(rel_obj_fields) == 1:
+                    q = Q(**{"%s__in" % rel_obj_fields[0].name: [k[0] for k in batch]})
+                else:
+                    # Separate INs would select the cross product of the keys.
+                    q = Q()
+                    for key in batch:
+                        q |= Q(**{f.name: v for f, v in zip(rel_obj_fields, key)})
+                return queryset._next_is_sticky().filter(q).filter(**constants)
+
+            keys = {instance_attr(inst) for inst in instances}
+            keys = [key for key in keys if None not in key]
+            queryset = self._filter_in_batches(
+                queryset, keys, filter_batch, params_per_value=len(pairs)
+            )
+
+            if not self.field.multiple:
+                instances_dict = {instance_attr(inst): inst for inst in instances}
+                for rel_obj in queryset:
+                    # The database may match values which convert differently,
+                    # e.g. on a case-insensitive collation.
+                    instance = instances_dict.get(rel_obj_attr(rel_obj))
+                    if instance is not None:
+                        setattr(rel_obj, self.field.name, instance)
+
+            return (
+                queryset,
+                rel_obj_attr,
+                instance_attr,
+                False,
+                self.field.relationship_related_query_name(),
+            ) + ((False,) if django.VERSION[0] >= 2 else ())
+
+        def _get_prefetch_queryset_by_enumeration(self, instances, queryset):
+            """
+            Select the related objects by the values their predicate enumerates
+            for each instance, and attach a copy of each one to every instance
+            it's related to, just like the join would.
+            """
+            name = None
+            owners = defaultdict(list)
+            for inst in instances:
+                name, values = rel.predicate._relativity_related_values(inst)
+                for value in values:
+                    owners[value].append(inst)
+
+            attname = rel.related_model._meta.get_field(name).attname
+            pk = rel.model._meta.pk
+            prefetch_attr = "_prefetch_related_val_%s" % pk.attname
+
+            fetch_queryset = queryset.prefetch_related(None)
+
+            def filter_batch(batch):
+                return fetch_queryset.filter(**{"%s__in" % name: batch})
+
+            results = []
+            fetch_queryset = self._filter_in_batches(
+                fetch_queryset, list(owners), filter_batch
+            )
+            for rel_obj in fetch_queryset:
+                for inst in owners[getattr(rel_obj, attname)]:
+                    result = copy.copy(rel_obj)
+                    setattr(result, prefetch_attr, getattr(inst, pk.attname))
+                    if not self.field.multiple:
+                        setattr(result, self.field.name, inst)
+                    results.append(result)
+            queryset._result_cache = results
+
+            def rel_obj_attr(result):
+                return (getattr(result, prefetch_attr),)
+
+            def instance_attr(inst):
+                return (getattr(inst, pk.attname),)
+
+            return (
+                queryset,
+                rel_obj_attr,
+                instance_attr,
+                False,
+                self.field.relationship_related_query_name(),
+            ) + ((False,) if django.VERSION[0] >= 2 else ())
+
+        def _get_prefetch_queryset_by_intervals(
+            self, instances, queryset, tree_id, left, right, include_self
+        ):
+            """
+            Select the nodes in the outermost intervals of each tree once, and
+            hand each one to all of the instances whose interval contains it by
+            sweeping through both in order of their left values.
+            """
+            pk = rel.model._meta.pk
+            get_tree = operator.attrgetter(tree_id)
+            get_left = operator.attrgetter(left)
+            get_right = operator.attrgetter(right)
+            get_pk = operator.attrgetter(pk.attname)
+
+            trees = defaultdict(OrderedDict)
+            for inst in instances:
+                if None not in (get_tree(inst), get_left(inst)):
+                    trees[get_tree(inst)][get_pk(inst)] = inst
+            intervals = []
+            for tree, nodes in trees.items():
+                nodes = trees[tree] = sorted(nodes.values(), key=get_left)
+                # Nested sets either nest or are disjoint, so the intervals of
+                # the other nodes are covered by those of their ancestors.
+                end = None
+                for node in nodes:
+                    if end is None or get_left(node) > end:
+                        intervals.append((tree, get_left(node), get_right(node)))
+                        end = get_right(node)
+
+            lower = "%s__gte" if include_self else "%s__gt"
+            fetch_queryset = queryset.prefetch_related(None)
+
+            def filter_batch(batch):
+                q = Q()
+                for tree, start, end in batch:
+                    q |= Q(
+                        **{
+                            tree_id: tree,
+                            lower % left: start,
+                            "%s__lt" % left: end,
+                        }
+                    )
+                return fetch_queryset.filter(q)
+
+            rows = list(
+                self._filter_in_batches(
+                    fetch_queryset, intervals, filter_batch, params_per_value=3
+                )
+                if intervals
+                else fetch_queryset.none()
+            )
+
+            by_tree = defaultdict(list)
+            for row in rows:
+                by_tree[get_tree(row)].append(row)
+            owners = defaultdict(list)
+            for tree, tree_rows in by_tree.items():
+                tree_rows.sort(key=get_left)
+                nodes, i, stack = trees.get(tree, []), 0, []
+                for row in tree_rows:
+                    position = get_left(row)
+                    while i < len(nodes) and (
+                        get_left(nodes[i]) <= position
+                        if include_self
+                        else get_left(nodes[i]) < position
+                    ):
+                        while stack and get_right(stack[-1]) <= get_left(nodes[i]):
+                            stack.pop()
+                        stack.append(nodes[i])
+                        i += 1
+                    while stack and get_right(stack[-1]) <= position:
+                        stack.pop()
+                    owners[id(row)] = [(get_pk(n),) for n in stack]
+
+            def instance_attr(inst):
+                return (get_pk(inst),)
+
+            return self._get_shared_prefetch_queryset(
+                queryset, rows, owners, instance_attr
+            )
+
+        def _get_prefetch_queryset_by_pairs(
+            self, instances, queryset, filter_batch, instance_attr
+        ):
+            """
+            Select the pks of each pair of related objects through the join,
+            then each distinct related object once, to be shared between all
+            of the instances it's related to.
+            """
+            attr = "_prefetch_related_val_%s" % rel.model._meta.pk.attname
+
+            def filter_pairs(batch):
+                pairs = filter_batch(batch).order_by().values_list(attr, "pk")
+                return pairs.distinct()
+
+            keys = defaultdict(list)
+            for local_pk, related_pk in self._filter_in_batches(
+                queryset, list(instances), filter_pairs
+            ):
+                keys[related_pk].append((local_pk,))
+            return self._get_prefetch_queryset_by_keys(
+                instances, queryset, keys, instance_attr
+            )
+
+        def _get_prefetch_queryset_by_keys(
+            self, instances, queryset, keys, instance_attr
+        ):
+            """
+            Select each related object whose pk is in keys once, to be shared
+            between the instances it's related to. keys maps each related pk to
+            the values of instance_attr() for those instances.
+            """
+            fetch_queryset = queryset.prefetch_related(None)
+
+            def filter_batch_by_pk(batch):
+                return fetch_queryset.filter(pk__in=batch)
+
+            rows = list(
+                self._filter_in_batches(fetch_queryset, list(keys), filter_batch_by_pk)
+                if keys
+                else fetch_queryset.none()
+            )
+            owners = {id(row): keys[row.pk] for row in rows}
+
+            if not self.field.multiple:
+                instances_dict = {instance_attr(inst): inst for inst in instances}
+                for row in rows:
+                    for key in owners[id(row)]:
+                        setattr(row, self.field.name, instances_dict[key])
+
+            return self._get_shared_prefetch_queryset(
+                queryset, rows, owners, instance_attr
+            )
+
+        def _get_shared_prefetch_queryset(self, queryset, rows, owners, instance_attr):
+            """
+            Return the result of get_prefetch_queryset() in which each row
+            appears once for every instance it belongs to, as the same object
+            rather than a copy. owners maps the id() of each row to the values
+            of instance_attr() for those instances.
+            """
+            results = []
+            owners = {key: deque(value) for key, value in owners.items()}
+            for row in rows:
+                results.extend([row] * len(owners[id(row)]))
+            queryset._result_cache = results
+
+            def rel_obj_attr(result):
+                return owners[id(result)].popleft()
+
+            return (
+                queryset,
+                rel_obj_attr,
+                instance_attr,
+                False,
+                self.field.relationship_related_query_name(),
+            ) + ((False,) if django.VERSION[0] >= 2 else ())
+
         # All of the standard data-modifying methods are not supported by Relationship
         def add(self, *args, **kwargs):
             raise NotImplementedError
@@ -225,6 +1110,18 @@ class CustomForeignObjectRel(ForeignObjectRel):
     def relationship_related_query_name(self):
         return self.remote_field.name
 
+    def pairs(self, queryset=None, chunk_size=2000):
+        """
+        Like Relationship.pairs(), following the relationship in reverse.
+        """
+        return relationship_pairs(
+            self.model, self.field.related_query_name(), queryset, chunk_size
+        )
+
+    def set_cached_value(self, instance, value):
+        super(CustomForeignObjectRel, self).set_cached_value(instance, value)
+        _record_selected_key(self, instance, self.field._instance_key(instance, False))
+
     def _get_extra_restriction(self, alias, related_alias):
         return Restriction(
             forward=False,
@@ -233,6 +1130,8 @@ class CustomForeignObjectRel(ForeignObjectRel):
             local_alias=related_alias,
             related_alias=alias,
             predicate=self.field.predicate,
+            cache=self.field._restriction_cache,
+            field=self.field,
         )
 
     def _get_extra_restriction_legacy(self, where_class, alias, related_alias):
@@ -247,37 +1146,42 @@ class CustomForeignObjectRel(ForeignObjectRel):
     else:
         get_extra_restriction = _get_extra_restriction
 
-    @classmethod
-    def _resolve_expression_local_references(cls, expr, obj):
-        if isinstance(expr, L):
-            return expr._relativity_resolve_for_instance(obj)
-        elif hasattr(expr, "get_source_expressions"):
-            for source_expr in expr.get_source_expressions():
-                cls._resolve_expression_local_references(source_expr, obj)
-        else:
-            return expr
-        return expr
-
     def get_forward_related_filter(self, obj):
         """
         Return the filter arguments which select the instances of self.model
         that are related to obj.
         """
+        return _filter_arguments(self.model, self.get_instance_filter(obj))
+
+    def get_instance_filter(self, obj):
+        """
+        Return a Q which selects the instances of self.model that are related
+        to obj, with the predicate's L()s replaced by obj's values so that it
+        needs no join back to obj's table.
+        """
         q = self.field.predicate
-        q = q() if callable(q) else copy.deepcopy(q)
-
-        # If this is a simple restriction that can be expressed as an AND of
-        # two basic field lookups, we can return a dictionary of filters...
-        if q.connector == Q.AND and all(type(c) == tuple for c in q.children):
-            return {
-                lookup: self._resolve_expression_local_references(v, obj)
-                for lookup, v in q.children
-            }
-
-        # ...otherwise, we return this lookup and let the compiler figure it
-        # out. This will involve a join where the above method might not.
-        else:
-            return {self.name: obj}
+        if self.field.materialize:
+            _send_filter_fallback(self.field, obj, "materialize")
+            return Q(**{self.name: obj})
+        elif callable(q):
+            q = q()
+
+        # Some predicates can list the values of a related field that select
+        # the instances related to obj.
+        if hasattr(q, "_relativity_related_values"):
+            name, values = q._relativity_related_values(obj)
+            return Q(**{"%s__in" % name: values})
+
+        bound = _bind_predicate(
+            q, self.model, lambda lookup, value: (lookup, _bind_to_instance(value, obj))
+        )
+        if bound is None:
+            # This will involve a join where the above might not.
+            _send_filter_fallback(self.field, obj, "predicate")
+            return Q(**{self.name: obj})
+        if any(_follows_many(self.model, l) for l in _predicate_lookups(bound)):
+            return Q(pk__in=self.model._base_manager.filter(bound).values("pk"))
+        return bound
 
 
 # noinspection PyProtectedMember
@@ -290,24 +1194,147 @@ class MultipleRelationshipDescriptor(ReverseManyToOneDescriptor):
         )
         return manager
 
+    def pairs(self, queryset=None, chunk_size=2000):
+        return self.rel.pairs(queryset, chunk_size)
+
 
 class SingleRelationshipDescriptor(ReverseOneToOneDescriptor):
     def __get__(self, instance, cls=None):
-        try:
-            return super(SingleRelationshipDescriptor, self).__get__(instance, cls=None)
-        except self.RelatedObjectDoesNotExist:
-            if self.related.null:
-                return None
-            else:
-                raise
-        finally:
-            # TODO: figure out how to persuade Django to treat us a normal related_object
-            if django.VERSION < (2,):
-                if hasattr(instance, self.cache_name):
-                    delattr(instance, self.cache_name)
-            else:
-                if self.related.is_cached(instance):
-                    self.related.delete_cached_value(instance)
+        if instance is not None and self._is_selected(instance):
+            return self._get_selected(instance)
+        rel_obj = self._get_uncached(instance, cls)
+        if instance is not None and self._caches_related(instance):
+            # Kept alongside the values it was selected by, so that changing
+            # any of them invalidates it, and dropped by refresh_from_db().
+            self.related.set_cached_value(instance, rel_obj)
+        return rel_obj
+
+    async def aget(self, instance):
+        """
+        Return the object related to instance. Objects cached by cache_related
+        or select_related() are returned without leaving the event loop.
+        """
+        if self._is_selected(instance):
+            return self._get_selected(instance)
+        return await sync_to_async(self.__get__)(instance, type(instance))
+
+    def _get_relationship(self):
+        if isinstance(self.related, Relationship):
+            return self.related, True
+        return self.related.field, False
+
+    def _caches_related(self, instance):
+        relationship, forward = self._get_relationship()
+        if not relationship.cache_related:
+            return False
+        return relationship._cache_key_attnames(forward) is not None
+
+    def _is_selected(self, instance):
+        """
+        Whether the related object is cached, e.g. by select_related(), for
+        the values instance has now. If they've changed since, it's dropped.
+        """
+        if not self.related.is_cached(instance):
+            return False
+        key_attr = "_relativity_selected_%s" % self.related.get_cache_name()
+        if key_attr not in instance.__dict__:
+            return True
+        relationship, forward = self._get_relationship()
+        if instance.__dict__[key_attr] == relationship._instance_key(instance, forward):
+            return True
+        self.related.delete_cached_value(instance)
+        del instance.__dict__[key_attr]
+        return False
+
+    def _get_selected(self, instance):
+        """
+        Return the object loaded by select_related(), which is kept just like
+        a foreign key's related object.
+        """
+        rel_obj = self.related.get_cached_value(instance)
+        if rel_obj is None and not self.related.null:
+            raise self._does_not_exist(instance)
+        return rel_obj
+
+    def _get_uncached(self, instance, cls=None):
+        if instance is None:
+            return self
+        rel_obj = None
+        if instance.pk is not None:
+            related_model = self.related.related_model
+            queryset = _filter_for_instance(
+                self.get_queryset(instance=instance),
+                self.related,
+                instance,
+                type(related_model._base_manager),
+                limit=MAX_GET_RESULTS,
+            )
+            rel_objs = list(queryset)
+            if len(rel_objs) > 1:
+                raise related_model.MultipleObjectsReturned(
+                    "%s has more than one %s."
+                    % (type(instance).__name__, self.related.get_accessor_name())
+                )
+            if rel_objs:
+                rel_obj = rel_objs[0]
+        if rel_obj is None and not self.related.null:
+            raise self._does_not_exist(instance)
+        return rel_obj
+
+    def _does_not_exist(self, instance):
+        return self.RelatedObjectDoesNotExist(
+            "%s has no %s."
+            % (type(instance).__name__, self.related.get_accessor_name())
+        )
+
+
+class AsyncRelationshipDescriptor(object):
+    """
+    Provides an awaitable accessor, e.g. await cart_item.aproduct(), alongside
+    the attribute of a relationship with a single related object.
+    """
+
+    def __init__(self, descriptor):
+        self.descriptor = descriptor
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        return functools.partial(self.descriptor.aget, instance)
+
+
+def _add_async_descriptor(cls, name, descriptor):
+    """
+    Add the awaitable accessor of descriptor to cls as name, unless that would
+    replace an attribute other than an inherited awaitable accessor.
+    """
+    existing = getattr(cls, name, None)
+    if existing is not None and not isinstance(existing, AsyncRelationshipDescriptor):
+        raise ValueError(
+            "%s.%s already exists, so the awaitable accessor of %s can't be "
+            "added" % (cls.__name__, name, name[1:])
+        )
+    setattr(cls, name, AsyncRelationshipDescriptor(descriptor))
+
+
+def _clear_relationships_on_refresh(cls):
+    """
+    Make refresh_from_db() on cls drop the objects cached by its relationships,
+    as it does from Django 4.2, which clears every cached private field.
+    """
+    refresh_from_db = cls.refresh_from_db
+    if getattr(refresh_from_db, "_relativity_clears_relationships", False):
+        return
+
+    @functools.wraps(refresh_from_db)
+    def wrapper(self, *args, **kwargs):
+        refresh_from_db(self, *args, **kwargs)
+        for field in self._meta.private_fields:
+            if isinstance(field, Relationship) and field.is_cached(self):
+                field.delete_cached_value(self)
+
+    wrapper._relativity_clears_relationships = True
+    cls.refresh_from_db = wrapper
 
 
 # noinspection PyProtectedMember
@@ -325,9 +1352,38 @@ class Relationship(models.ForeignObject):
 
     rel_class = CustomForeignObjectRel
 
+    filter_strategies = ("join", "exists")
+    prefetch_strategies = ("join", "pairs")
+    cache_statements_choices = (False, True, "prepare")
+
     def __init__(self, to, predicate, **kwargs):
         self.multiple = kwargs.pop("multiple", True)
         self.reverse_multiple = kwargs.pop("reverse_multiple", True)
+        self.cache_related = kwargs.pop("cache_related", False)
+        self.filter_strategy = kwargs.pop("filter_strategy", "join")
+        self.prefetch_strategy = kwargs.pop("prefetch_strategy", "join")
+        self.materialize = kwargs.pop("materialize", False)
+        self.cache_statements = kwargs.pop("cache_statements", False)
+        self.through = None
+
+        if self.filter_strategy not in self.filter_strategies:
+            raise ValueError(
+                "filter_strategy must be one of %s, not %r"
+                % (", ".join(self.filter_strategies), self.filter_strategy)
+            )
+        if self.prefetch_strategy not in self.prefetch_strategies:
+            raise ValueError(
+                "prefetch_strategy must be one of %s, not %r"
+                % (", ".join(self.prefetch_strategies), self.prefetch_strategy)
+            )
+        if self.cache_statements not in self.cache_statements_choices:
+            raise ValueError(
+                "cache_statements must be one of %s, not %r"
+                % (
+                    ", ".join(map(repr, self.cache_statements_choices)),
+                    self.cache_statements,
+                )
+            )
 
         if self.multiple:
             self.accessor_class = MultipleRelationshipDescriptor
@@ -347,10 +1403,22 @@ class Relationship(models.ForeignObject):
         kwargs.setdefault("blank", True)
         super(Relationship, self).__init__(to, **kwargs)
         self.predicate = predicate
+        self._restriction_cache = {}
+        self._statement_cache = {}
 
     def deconstruct(self):
         name, path, args, kwargs = super(Relationship, self).deconstruct()
         kwargs["predicate"] = self.predicate
+        if self.filter_strategy != "join":
+            kwargs["filter_strategy"] = self.filter_strategy
+        if self.prefetch_strategy != "join":
+            kwargs["prefetch_strategy"] = self.prefetch_strategy
+        if self.cache_related:
+            kwargs["cache_related"] = True
+        if self.materialize:
+            kwargs["materialize"] = True
+        if self.cache_statements:
+            kwargs["cache_statements"] = self.cache_statements
         return name, path, args, kwargs
 
     @property
@@ -360,6 +1428,14 @@ class Relationship(models.ForeignObject):
         """
         return self.remote_field
 
+    @property
+    def unique(self):
+        """
+        Lets select_related() follow the relationship in reverse when there is
+        a single related object.
+        """
+        return not self.reverse_multiple
+
     def get_accessor_name(self):
         return self.name
 
@@ -371,6 +1447,8 @@ class Relationship(models.ForeignObject):
             local_alias=local_alias,
             related_alias=related_alias,
             predicate=self.predicate,
+            cache=self._restriction_cache,
+            field=self,
         )
 
     def _get_extra_restriction_legacy(self, where_class, alias, related_alias):
@@ -385,13 +1463,101 @@ class Relationship(models.ForeignObject):
     else:
         get_extra_restriction = _get_extra_restriction
 
-
     def get_forward_related_filter(self, obj):
         """
         Return the filter arguments which select the instances of self.model
         that are related to obj.
         """
-        return {self.name: obj}
+        return _filter_arguments(self.model, self.get_instance_filter(obj))
+
+    def get_instance_filter(self, obj):
+        """
+        Return a Q which selects the instances of self.model that are related
+        to obj, an instance of the related model. Each lookup of the predicate
+        is made against obj's values, so that it needs no join to obj's table.
+        """
+        q = self.predicate
+        if self.materialize:
+            _send_filter_fallback(self, obj, "materialize")
+            return Q(**{self.name: obj})
+        elif callable(q):
+            q = q()
+
+        bound = None
+        # Lookups can only be passed to filter() from Django 4.0.
+        if django.VERSION >= (4, 0):
+            bound = _bind_predicate(
+                q,
+                self.related_model,
+                functools.partial(RelatedInstanceLookup.bind, obj),
+            )
+        if bound is None:
+            _send_filter_fallback(self, obj, "predicate")
+            return Q(**{self.name: obj})
+        return bound
+
+    def _get_statement(self, rel, manager_class, limit, query, using):
+        """
+        Return the Statement selecting the objects related to any instance
+        through rel, this relationship or its reverse, from query, the query of
+        a manager_class queryset, fetching at most limit objects. It's compiled
+        once for each combination of these, the database and the SQL of query,
+        unless query has parameters of its own, which may change from one call
+        to the next. Return None if the predicate can't be compiled without the
+        instance's values.
+        """
+        forward = rel is self
+        base_key = query_key(query, using)
+        key = (forward, manager_class, limit, using, base_key)
+        if base_key is not None and key in self._statement_cache:
+            return self._statement_cache[key]
+        statement = None
+        q = self._parameterised_predicate(forward)
+        if q is not None:
+            query = query.chain()
+            if forward:
+                query._relativity_parameters = self.model
+            try:
+                query.add_q(q)
+            except FieldDoesNotExist:
+                q = None
+        if q is not None:
+            if limit is not None:
+                query.clear_ordering(True)
+                query.set_limits(high=limit)
+            statement = Statement(query, using, self.cache_statements == "prepare")
+        if base_key is not None:
+            self._statement_cache[key] = statement
+        return statement
+
+    def _parameterised_predicate(self, forward):
+        """
+        Return the predicate to filter the related model by, forward, or the
+        local model by, in reverse, with an InstanceParameter for each of the
+        instance's values, or None if that isn't possible. Forward, L()s
+        become parameters when the query is flagged with the local model.
+        """
+        q = self.predicate
+        if self.materialize or callable(q):
+            return None
+        if hasattr(q, "_relativity_related_values"):
+            return None
+        if forward:
+            q = _bind_predicate(q, self.related_model, lambda *child: child)
+            if q is None:
+                return None
+            if any(_follows_many(self.related_model, l) for l in _predicate_lookups(q)):
+                return None
+            return q
+        if django.VERSION < (4, 0):
+            return None
+        return _bind_predicate(
+            q,
+            self.related_model,
+            functools.partial(
+                RelatedInstanceLookup.bind, self.related_model, parameterise=True
+            ),
+        )
 
     def resolve_related_fields(self):
         return []
@@ -399,9 +1565,54 @@ class Relationship(models.ForeignObject):
     def contribute_to_class(self, cls, name, **kwargs):
         kwargs["private_only"] = True
         super(ForeignObject, self).contribute_to_class(cls, name, **kwargs)
-        setattr(cls, self.name, self.accessor_class(self))
+        descriptor = self.accessor_class(self)
+        setattr(cls, self.name, descriptor)
+        if not self.multiple:
+            _add_async_descriptor(cls, "a%s" % self.name, descriptor)
+            if django.VERSION < (4, 2):
+                _clear_relationships_on_refresh(cls)
+
+        if self.materialize and not cls._meta.abstract:
+            # The predicate is still evaluated to maintain the table, through
+            # an identical relationship which isn't materialized.
+            self.predicate_field = Relationship(
+                self.remote_field.model, self.predicate, related_name="+"
+            )
+            cls.add_to_class("_%s_predicate" % name, self.predicate_field)
+
+            def resolve_through_model(_, related_model, field):
+                field.through = create_materialized_model(field, cls)
+                connect_materialized_signals(field)
+
+            lazy_related_operation(
+                resolve_through_model, cls, self.remote_field.model, field=self
+            )
+
+    def contribute_to_related_class(self, cls, related):
+        super(Relationship, self).contribute_to_related_class(cls, related)
+        model = cls._meta.concrete_model
+        accessor = related.get_accessor_name()
+        descriptor = model.__dict__.get(accessor) if accessor else None
+        if isinstance(descriptor, SingleRelationshipDescriptor):
+            _add_async_descriptor(model, "a%s" % accessor, descriptor)
+
+    def _get_materialized_path_info(self, reverse, filtered_relation):
+        local_field = self.through._meta.get_field("local")
+        related_field = self.through._meta.get_field("related")
+        if reverse:
+            local_field, related_field = related_field, local_field
+        return local_field.get_reverse_path_info() + related_field.get_path_info(
+            filtered_relation
+        )
+
+    def get_reverse_path_info(self, filtered_relation=None):
+        if self.materialize:
+            return self._get_materialized_path_info(True, filtered_relation)
+        return super(Relationship, self).get_reverse_path_info(filtered_relation)
 
     def get_path_info(self, filtered_relation=None):
+        if self.materialize:
+            return self._get_materialized_path_info(False, filtered_relation)
         if django.VERSION < (2, 0):
             to_opts = self.rel.to._meta
             from_opts = self.model._meta
@@ -417,12 +1628,567 @@ class Relationship(models.ForeignObject):
     def relationship_related_query_name(self):
         return self.related_query_name()
 
+    def set_cached_value(self, instance, value):
+        super(Relationship, self).set_cached_value(instance, value)
+        _record_selected_key(self, instance, self._instance_key(instance, True))
+
+    def _instance_key(self, instance, forward):
+        """
+        Return the values of instance's fields which determine the objects
+        related to it, or None if they can't be determined.
+        """
+        attnames = self._cache_key_attnames(forward)
+        if attnames is None:
+            return None
+        return tuple(getattr(instance, a) for a in attnames)
+
+    def _cache_key_attnames(self, forward):
+        """
+        Return the attnames of the fields whose values determine which objects
+        are related to an instance: those referenced by L() when following the
+        relationship forward, or those on the left of each lookup when
+        following it in reverse. Return None if they can't be determined.
+        """
+        return self._forward_key_attnames if forward else self._reverse_key_attnames
+
+    @cached_property
+    def _forward_key_attnames(self):
+        return self._get_key_attnames(True)
+
+    @cached_property
+    def _reverse_key_attnames(self):
+        return self._get_key_attnames(False)
+
+    def _get_key_attnames(self, forward):
+        if callable(self.predicate):
+            return None
+        try:
+            lookup_names, local_names = _predicate_references(self.predicate)
+        except ValueError:
+            return None
+        model = self.model if forward else self.related_model
+        attnames = []
+        for name in sorted(local_names if forward else lookup_names):
+            try:
+                field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not field.concrete:
+                return None
+            attnames.append(field.attname)
+        return attnames
+
+    def _materialized_dependencies(self):
+        """
+        Return (model, path, forward) for each model whose fields the
+        predicate reads through a relation, followed along path by L() from
+        the local model if forward, or by a lookup from the related model if
+        not.
+        """
+        if callable(self.predicate) or type(self.predicate) is not Q:
+            return []
+        lookups = [
+            (self.model, name, True)
+            for _, value in _predicate_children(self.predicate)
+            for name in _local_lookups(value)
+        ]
+        lookups += [
+            (self.related_model, lookup, False)
+            for lookup, _ in _predicate_children(self.predicate)
+        ]
+        dependencies = []
+        for model, lookup, forward in lookups:
+            for path, related_model in _followed_relations(model, lookup):
+                if (related_model, path, forward) not in dependencies:
+                    dependencies.append((related_model, path, forward))
+        return dependencies
+
+    def get_nested_set_fields(self):
+        """
+        If this relates each node of a nested set to its descendants, return
+        the names of its tree id, left and right fields, and whether each node
+        is included. Prefetching then fetches each tree's nodes only once.
+        """
+        return None
+
+    def get_prefetch_pairs(self, pks, forward, using):
+        """
+        Return the pairs of pks of related objects on the database using, the
+        first of each being one of pks, of the local model if forward or else
+        of the related one, or None if they can only be found with the join.
+        Prefetching then fetches the related objects by their pks.
+        """
+        return None
+
+    def pairs(self, queryset=None, chunk_size=2000):
+        """
+        Return an iterator over a (local pk, related pk) tuple for each pair
+        of related objects, or only those whose local object is in queryset.
+        The pairs are read in chunks from a single query, on a server-side
+        cursor where the database supports it, without creating any models.
+        """
+        return relationship_pairs(self.model, self.name, queryset, chunk_size)
+
+    def resolve_many(self, instances, chunk_size=2000, pks=False):
+        """
+        Return an OrderedDict mapping the pk of each of instances, a QuerySet
+        or a list of instances of this field's model, to its related objects,
+        or their pks if pks is True. These are listed if multiple is True, and
+        otherwise are an object or None.
+
+        The objects are related chunk_size instances at a time, in the same
+        way they'd be prefetched, so equalities are looked up by value, trees
+        are swept through, the prefetch_strategy is followed and anything else
+        is joined.
+        """
+        return OrderedDict(self.iter_resolve_many(instances, chunk_size, pks))
+
+    def iter_resolve_many(self, instances, chunk_size=2000, pks=False):
+        """
+        Like resolve_many(), but yield a (pk, related) tuple for each of
+        instances, reading a QuerySet with iterator(), so that only one chunk
+        is held in memory at a time.
+        """
+        if isinstance(instances, models.QuerySet):
+            instances = instances.iterator(chunk_size=chunk_size)
+        instances = iter(instances)
+        manager_cls = create_relationship_many_manager(
+            self.related_model._default_manager.__class__, self
+        )
+        while True:
+            chunk = list(itertools.islice(instances, chunk_size))
+            if not chunk:
+                return
+            queryset = None
+            if pks:
+                # Only the fields the predicate compares are needed to match
+                # the related objects up with chunk.
+                attnames = self._cache_key_attnames(False)
+                if attnames is not None:
+                    pk = self.related_model._meta.pk.attname
+                    queryset = self.related_model._default_manager.only(pk, *attnames)
+            prefetch = manager_cls(chunk[0]).get_prefetch_queryset(chunk, queryset)
+            queryset, rel_obj_attr, instance_attr = prefetch[:3]
+            related = defaultdict(list)
+            for obj in queryset:
+                related[rel_obj_attr(obj)].append(obj.pk if pks else obj)
+            for obj in chunk:
+                objs = related.get(instance_attr(obj), [])
+                if self.multiple:
+                    yield obj.pk, objs
+                else:
+                    yield obj.pk, objs[0] if objs else None
+
+    def get_count_expression(self):
+        """
+        Return an expression which counts the objects related to a row from
+        that row's own columns, or None if they must be counted in a subquery.
+        """
+        return None
+
+    def get_count_for_instance(self, obj):
+        """
+        Return the number of objects related to obj, worked out without a
+        query, or None if they must be counted in the database.
+        """
+        return None
+
+    def match(self, local, related):
+        """
+        Return whether the predicate relates local, an instance of this
+        field's model, to related, evaluating it in Python.
+        """
+        return evaluate_predicate(self.predicate, local, related)
+
+    def resolve_in_memory(self, instances, candidates):
+        """
+        Match up instances of this field's model with the candidates related
+        to them without querying the database, returning an OrderedDict which
+        maps the pk of each instance to a list of its related objects.
+        """
+        return resolve_in_memory(
+            self.predicate, instances, candidates, model=self.related_model
+        )
+
+    @property
+    def enumerates_related_values(self):
+        """
+        Whether the predicate can list the values of a field on the related
+        model which select the objects related to a given instance, in which
+        case the relationship can be followed from instances without a join.
+        """
+        if self.materialize:
+            return False
+        return hasattr(self.predicate, "_relativity_related_values")
+
+    @cached_property
+    def _equality_predicate(self):
+        """
+        If the predicate is a plain AND of equalities between fields on the
+        related model and L() references to fields on this model, optionally
+        alongside constant filters on the related model, return a tuple of
+        ([(related_field, local_field), ...], {lookup: value, ...}). Otherwise
+        return None.
+        """
+        if self.materialize or callable(self.predicate):
+            return None
+        q = self.predicate
+        if q.connector != Q.AND or q.negated:
+            return None
+
+        def get_concrete_field(opts, lookup):
+            parts = lookup.split(LOOKUP_SEP)
+            if len(parts) == 2 and parts[1] == "exact":
+                parts = parts[:1]
+            if len(parts) != 1:
+                return None
+            try:
+                f = opts.pk if parts[0] == "pk" else opts.get_field(parts[0])
+            except FieldDoesNotExist:
+                return None
+            if not f.concrete or f.is_relation:
+                return None
+            return f
+
+        pairs, constants = [], {}
+        for child in q.children:
+            if type(child) != tuple:
+                return None
+            lookup, value = child
+            related_field = get_concrete_field(self.related_model._meta, lookup)
+            if related_field is None:
+                return None
+            if type(value) == L:
+                local_field = get_concrete_field(self.model._meta, value.name)
+                if local_field is None:
+                    return None
+                pairs.append((related_field, local_field))
+            elif hasattr(value, "resolve_expression"):
+                return None
+            else:
+                constants[lookup] = value
+
+        if not pairs:
+            return None
+        return pairs, constants
+
+
+async def aprefetch_related_objects(model_instances, *related_lookups):
+    """
+    Prefetch relationships, or any other related objects, for a list of model
+    instances from async code, like QuerySet.prefetch_related().
+    """
+    return await sync_to_async(models.prefetch_related_objects)(
+        model_instances, *related_lookups
+    )
+
+
+def create_materialized_model(field, klass):
+    """
+    Create the model of the table in which a Relationship with materialize=True
+    stores the pks of each pair of related objects.
+    """
+    to = field.remote_field.model
+    name = "%s_%s" % (klass._meta.object_name, field.name)
+    db_table = truncate_name(
+        "%s_%s" % (klass._meta.db_table, field.name),
+        connections["default"].ops.max_name_length(),
+    )
+    meta = type(
+        str("Meta"),
+        (),
+        {
+            "db_table": db_table,
+            "app_label": klass._meta.app_label,
+            "unique_together": ("local", "related"),
+            "verbose_name": "%s-%s relationship" % (klass._meta.model_name, field.name),
+            "apps": field.model._meta.apps,
+        },
+    )
+    return type(
+        str(name),
+        (models.Model,),
+        {
+            "Meta": meta,
+            "__module__": klass.__module__,
+            "local": models.ForeignKey(
+                klass, related_name="%s+" % name, on_delete=models.CASCADE
+            ),
+            "related": models.ForeignKey(
+                to, related_name="%s+" % name, on_delete=models.CASCADE
+            ),
+        },
+    )
+
+
+def relationship_pairs(model, name, queryset=None, chunk_size=2000):
+    """
+    Return an iterator over the pks of each object of model, or of queryset,
+    and the objects related to it by the relationship called name.
+    """
+    if queryset is None:
+        queryset = model._default_manager.all()
+    pairs = queryset.filter(**{"%s__isnull" % name: False}).order_by()
+    return pairs.values_list("pk", name).iterator(chunk_size=chunk_size)
+
+
+class IntegerDivision(Func):
+    """
+    Divides one integer expression by another, discarding the remainder, on
+    every database, rather than giving a decimal on MySQL and Oracle.
+    """
+
+    arity = 2
+    arg_joiner = " / "
+    template = "(%(expressions)s)"
+    output_field = models.IntegerField()
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, arg_joiner=" DIV ", **extra_context)
+
+    def as_oracle(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection, template="TRUNC(%(expressions)s)", **extra_context
+        )
+
+
+def nested_set_count(left, right, include_self=False):
+    """
+    Return an expression counting the nodes in the subtree of a nested set
+    node from its left and right columns, excluding the node itself unless
+    include_self.
+    """
+    width = F(right) - F(left)
+    width = width + 1 if include_self else width - 1
+    return IntegerDivision(width, Value(2))
+
+
+def correlated_queryset(field, using=None, filter_strategy=None):
+    """
+    Return a RelationshipQuerySet of the objects related by field, a relation
+    field or reverse relation, to the current row of an outer query. It can
+    be used in a subquery such as Exists() or Subquery().
+    """
+    inner = RelationshipQuerySet(model=field.related_model, using=using)
+    inner._relationship_filter_strategy = filter_strategy
+
+    if isinstance(field, Relationship) and not field.materialize:
+        # The predicate can be applied directly, with L() referring to the
+        # outer query.
+        predicate = field.predicate
+        predicate = predicate() if callable(predicate) else predicate
+        inner.query.where.add(
+            predicate.resolve_expression(query=inner.query, allow_joins=True),
+            Q.AND,
+        )
+        return inner
+    elif isinstance(field, (models.ManyToOneRel, models.OneToOneRel)):
+        # The foreign key may refer to a field other than the pk (to_field).
+        target = field.field.target_field
+        return inner.filter(**{field.field.name: OuterRef(target.attname)})
+    elif isinstance(field, ForeignObjectRel):
+        return inner.filter(**{field.field.name: OuterRef("pk")})
+    elif isinstance(field, models.ForeignObject) and (
+        field.many_to_one or field.one_to_one
+    ):
+        # Compare the fields the join would, so that the reverse relation
+        # isn't needed.
+        return inner.filter(
+            **{to.name: OuterRef(local.attname) for local, to in field.related_fields}
+        )
+    elif isinstance(field, models.ManyToManyField):
+        # Follow the through model, whose reverse relations may be hidden.
+        through = field.remote_field.through._meta
+        source = through.get_field(field.m2m_field_name())
+        target = through.get_field(field.m2m_reverse_field_name())
+        pairs = field.remote_field.through._base_manager.filter(
+            **{source.name: OuterRef(OuterRef(source.target_field.attname))}
+        )
+        return inner.filter(
+            **{"%s__in" % target.target_field.name: pairs.values(target.attname)}
+        )
+    elif field.remote_field.is_hidden():
+        raise ValueError(
+            "%s.%s can't be followed in a subquery, because its reverse relation "
+            "is hidden by related_name='+'." % (field.model._meta.label, field.name)
+        )
+    else:
+        return inner.filter(**{field.related_query_name(): OuterRef("pk")})
+
+
+class RelationshipQuerySet(models.QuerySet):
+    """
+    A QuerySet which compiles filters and excludes that cross a Relationship
+    with filter_strategy="exists" into correlated EXISTS subqueries instead of
+    joins, so that they don't multiply rows. Use filter_strategy() to choose a
+    strategy for every Relationship filtered through this QuerySet, and
+    prefetch_strategy() to choose one for Prefetch() objects using it.
+    """
+
+    _relationship_filter_strategy = None
+    _relationship_prefetch_strategy = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(RelationshipQuerySet, self)._clone(*args, **kwargs)
+        clone._relationship_filter_strategy = self._relationship_filter_strategy
+        clone._relationship_prefetch_strategy = self._relationship_prefetch_strategy
+        return clone
+
+    def filter_strategy(self, strategy):
+        if strategy not in Relationship.filter_strategies + (None,):
+            raise ValueError("Unknown filter strategy %r" % (strategy,))
+        clone = self._clone()
+        clone._relationship_filter_strategy = strategy
+        return clone
+
+    def prefetch_strategy(self, strategy):
+        if strategy not in Relationship.prefetch_strategies + (None,):
+            raise ValueError("Unknown prefetch strategy %r" % (strategy,))
+        clone = self._clone()
+        clone._relationship_prefetch_strategy = strategy
+        return clone
+
+    def filter(self, *args, **kwargs):
+        return super(RelationshipQuerySet, self).filter(
+            self._rewrite_q(Q(*args, **kwargs))
+        )
+
+    def exclude(self, *args, **kwargs):
+        return super(RelationshipQuerySet, self).exclude(
+            self._rewrite_q(Q(*args, **kwargs))
+        )
+
+    def _uses_exists(self, field):
+        if isinstance(field, ForeignObjectRel):
+            relationship = field.field
+        else:
+            relationship = field
+        strategy = self._relationship_filter_strategy
+        if strategy is None:
+            strategy = getattr(relationship, "filter_strategy", None)
+        return isinstance(relationship, Relationship) and strategy == "exists"
+
+    def _path_uses_exists(self, model, parts):
+        for part in parts:
+            try:
+                field = model._meta.get_field(part)
+            except FieldDoesNotExist:
+                return False
+            if not field.is_relation:
+                return False
+            if self._uses_exists(field):
+                return True
+            model = field.related_model
+        return False
+
+    def _rewrite_q(self, q):
+        """
+        Replace the lookups in q whose paths cross a Relationship filtered
+        with EXISTS. Lookups ANDed together which start with the same field
+        share a subquery, so that they have to match the same related row,
+        just as they would in a single filter() call.
+        """
+        children, groups = [], OrderedDict()
+        for child in q.children:
+            if isinstance(child, Q):
+                children.append(self._rewrite_q(child))
+                continue
+            elif not isinstance(child, tuple):
+                children.append(child)
+                continue
+            lookup, value = child
+            parts = lookup.split(LOOKUP_SEP)
+            rest = (LOOKUP_SEP.join(parts[1:]), value)
+            bound = self._instance_filter(parts, value)
+            if bound is not None:
+                children.append(bound)
+            elif not self._path_uses_exists(self.model, parts):
+                children.append(child)
+            elif q.connector == Q.AND and parts[0] in groups:
+                groups[parts[0]][1].append(rest)
+            else:
+                key = parts[0] if q.connector == Q.AND else len(children)
+                groups[key] = (len(children), [rest])
+                children.append(parts[0])
+
+        for index, lookups in groups.values():
+            children[index] = self._exists(children[index], lookups)
+
+        clone = copy.copy(q)
+        clone.children = children
+        return clone
+
+    def _instance_filter(self, parts, value):
+        """
+        If the lookup selects the objects related to a single instance, e.g.
+        filter(filters=product_filter), return a Q with the predicate bound to
+        the instance's values, which needs no join.
+        """
+        if parts[1:] not in ([], ["exact"]):
+            return None
+        try:
+            field = self.model._meta.get_field(parts[0])
+        except FieldDoesNotExist:
+            return None
+        if not isinstance(field, (Relationship, CustomForeignObjectRel)):
+            return None
+        if not isinstance(value, field.related_model):
+            return None
+        return field.get_instance_filter(value)
+
+    def _exists(self, name, lookups):
+        """
+        Return an EXISTS expression selecting the objects related by the field
+        called name which match all of the given (lookup, value) pairs.
+        """
+        field = self.model._meta.get_field(name)
+        inner = correlated_queryset(
+            field, using=self._db, filter_strategy=self._relationship_filter_strategy
+        )
+
+        negated = False
+        filters = {}
+        for lookup, value in lookups:
+            if isinstance(value, OuterRef):
+                value = OuterRef(value)
+            elif isinstance(value, F):
+                value = OuterRef(value.name)
+            if lookup == "isnull":
+                negated = negated or bool(value)
+                continue
+            try:
+                first = lookup.split(LOOKUP_SEP)[0]
+                if first != "pk":
+                    field.related_model._meta.get_field(first)
+            except FieldDoesNotExist:
+                # The lookup applies to the related object itself.
+                lookup = LOOKUP_SEP.join(["pk", lookup]) if lookup else "pk"
+                if isinstance(value, models.Model):
+                    value = value.pk
+                elif isinstance(value, (list, tuple, set)):
+                    value = [v.pk if isinstance(v, models.Model) else v for v in value]
+            filters[lookup] = value
+
+        exists = Exists(inner.filter(**filters))
+        return ~exists if negated else exists
+
 
 class L(F):
     def _relativity_resolve_for_instance(self, obj):
-        val = getattr(obj, self.name)
-        self._relativity_resolved_value = Value(val)
-        return val
+        return getattr(obj, self.name)
+
+    def _relativity_parameter(self, model):
+        """
+        Return the InstanceParameter of this reference for instances of model,
+        for statements compiled once for all of them.
+        """
+        opts = model._meta
+        field = opts.pk if self.name == "pk" else opts.get_field(self.name)
+        if field.is_relation:
+            return InstanceParameter(
+                operator.attrgetter(field.attname), field.target_field
+            )
+        return InstanceParameter(self._relativity_resolve_for_instance, field)
 
     def resolve_expression(
         self,
@@ -433,10 +2199,24 @@ class L(F):
         for_save=False,
         simple_col=False,
     ):
-        if hasattr(self, "_relativity_resolved_value"):
-            return self._relativity_resolved_value
+        instance = getattr(query, "_relativity_instance", None)
+        parameters = getattr(query, "_relativity_parameters", None)
+        if instance is not None:
+            return Value(self._relativity_resolve_for_instance(instance))
+        elif parameters is not None:
+            return self._relativity_parameter(parameters)
+        elif not hasattr(query, "_relationship_field_query"):
+            # Outside a join, the predicate is being applied in a subquery, so
+            # the local model is the outer query's.
+            return OuterRef(self.name).resolve_expression(
+                query, allow_joins, reuse, summarize, for_save
+            )
         else:
             # noinspection PyProtectedMember
-            return super(L, self).resolve_expression(
+            resolved = super(L, self).resolve_expression(
                 query._relationship_field_query, allow_joins, reuse, summarize, for_save
             )
+            if getattr(query, "_relativity_outer_columns", False):
+                if isinstance(resolved, Col):
+                    resolved = OuterCol(resolved.alias, resolved.target)
+            return resolved
@@ -0,0 +1,358 @@
+"""
+Works out which indexes the lookups in a Relationship's predicate can use, so
+that joins and filters on it don't have to scan whole tables.
+
+Each lookup is checked in the direction it's used: forward, the related
+model's column is compared against the local object's values, and in
+reverse, the local model's column (referred to with L()) is compared against
+the related object's. Whether an index can answer the lookup depends on the
+database, e.g. contains lookups need a trigram index on PostgreSQL, and
+can't use an index elsewhere.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, connections, models
+from django.db.backends.utils import names_digest
+from django.db.migrations.operations import AddIndex
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+
+from relativity.fields import L
+
+# Lookups that a B-tree index on the column can answer anywhere.
+BTREE_LOOKUPS = {"exact", "in", "gt", "gte", "lt", "lte", "range", "isnull"}
+
+# The lookup on the local column equivalent to comparing the related column
+# with it, for the lookups which can be turned around.
+REVERSED_LOOKUPS = {
+    "exact": "exact",
+    "gt": "lt",
+    "gte": "lte",
+    "lt": "gt",
+    "lte": "gte",
+}
+
+# The kinds of index which can answer each lookup on PostgreSQL, besides
+# BTREE_LOOKUPS. Case-insensitive lookups compare UPPER() of the column.
+POSTGRESQL_KINDS = {
+    "startswith": "pattern",
+    "contains": "trigram",
+    "endswith": "trigram",
+    "regex": "trigram",
+    "iregex": "trigram",
+    "iexact": "upper",
+    "istartswith": "upper_trigram",
+    "icontains": "upper_trigram",
+    "iendswith": "upper_trigram",
+}
+
+# MySQL compares case-insensitively using the column's collation, but
+# case-sensitive LIKEs are made with LIKE BINARY, which can't use an index.
+MYSQL_KINDS = {"iexact": "btree", "istartswith": "btree"}
+
+INDEX_DESCRIPTIONS = {
+    "btree": "a B-tree index",
+    "pattern": "an index with pattern_ops",
+    "trigram": "a trigram index",
+    "upper": "an index on UPPER()",
+    "upper_trigram": "a trigram index on UPPER()",
+}
+
+INDEX_SUFFIXES = {
+    "btree": "idx",
+    "pattern": "pat",
+    "trigram": "trg",
+    "upper": "upp",
+    "upper_trigram": "utg",
+}
+
+
+class IndexCheck(object):
+    """
+    Whether one lookup of a Relationship's predicate can use an index. status
+    is "ok" if the model has a suitable index, "missing" if it needs one, in
+    which case index is the Index to add, or "unusable" if no index can answer
+    the lookup on the database.
+    """
+
+    def __init__(self, field, model, column, lookup, direction, status, reason):
+        self.field = field
+        self.model = model
+        self.column = column
+        self.lookup = lookup
+        self.direction = direction
+        self.status = status
+        self.reason = reason
+        self.index = None
+        self.kind = None
+
+    @property
+    def operation(self):
+        if self.index is None:
+            return None
+        return AddIndex(model_name=self.model._meta.model_name, index=self.index)
+
+    def __str__(self):
+        return "%s.%s: %s.%s %s (%s): %s" % (
+            self.field.model._meta.label,
+            self.field.name,
+            self.model._meta.label,
+            self.column,
+            self.lookup,
+            self.direction,
+            self.reason,
+        )
+
+    def __repr__(self):
+        return "<IndexCheck: %s>" % self
+
+
+def check_indexes(field, using=DEFAULT_DB_ALIAS):
+    """
+    Return an IndexCheck for each lookup in the predicate of the Relationship
+    field, on the database using. Raise ValueError if the predicate can't be
+    inspected, e.g. if it's callable.
+    """
+    vendor = connections[using].vendor
+    checks = [
+        IndexCheck(field, model, column, lookup, direction, "unusable", reason)
+        for model, column, lookup, direction, reason in predicate_lookups(field)
+    ]
+    # Columns compared for equality can lead a multicolumn index.
+    equal = {
+        (check.model, check.direction, check.column)
+        for check in checks
+        if check.lookup == "exact" and check.reason is None
+    }
+    for check in checks:
+        if check.reason is None:
+            columns = {
+                c for m, d, c in equal if (m, d) == (check.model, check.direction)
+            }
+            _check_index(check, vendor, columns)
+    return checks
+
+
+def predicate_lookups(field):
+    """
+    Yield (model, field name, lookup, direction, reason) for each column the
+    predicate of the Relationship field compares. reason is None unless the
+    comparison can't use an index regardless of the database.
+    """
+    predicate = field.predicate
+    if hasattr(predicate, "translate"):
+        predicate = predicate.translate(field.related_model)
+    if type(predicate) is not Q:
+        raise ValueError("Can't inspect %r" % predicate)
+    for lookup, value in _leaves(predicate):
+        if hasattr(value, "_get_ref"):
+            value = value._get_ref(field.model)
+        local_names = _local_names(value)
+        if not local_names:
+            # Comparisons with constants only narrow down the rows found by
+            # the others.
+            continue
+        model, name, lookup_name, reason = _resolve_lookup(field.related_model, lookup)
+        if name is None:
+            continue
+        yield model, name, lookup_name, "forward", reason
+        reversed_name = REVERSED_LOOKUPS.get(lookup_name)
+        if reason is None and type(value) is not L:
+            reason = "the local column is part of an expression"
+        elif reason is None and reversed_name is None:
+            reason = "the local column is compared with %s" % lookup_name
+        for local_name in sorted(local_names):
+            model, name, _, _ = _resolve_lookup(field.model, local_name)
+            if name is not None:
+                yield model, name, reversed_name or lookup_name, "reverse", reason
+
+
+def _leaves(q):
+    for child in q.children:
+        if isinstance(child, Q):
+            if type(child) is not Q:
+                raise ValueError("Can't inspect %r" % child)
+            for leaf in _leaves(child):
+                yield leaf
+        else:
+            yield child
+
+
+def _local_names(expr):
+    if isinstance(expr, L):
+        return {expr.name}
+    names = set()
+    for source_expr in getattr(expr, "get_source_expressions", list)():
+        names |= _local_names(source_expr)
+    return names
+
+
+def _resolve_lookup(model, lookup):
+    """
+    Follow lookup from model, returning the model and name of the concrete
+    field it compares, the lookup's name and the reason it can't use an index,
+    if any. The name is None if the lookup doesn't end on a concrete field.
+    """
+    parts = lookup.split(LOOKUP_SEP)
+    field = None
+    while parts:
+        name = parts[0]
+        try:
+            field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        parts.pop(0)
+        if parts and field.is_relation and field.related_model is not None:
+            model = field.related_model
+            field = None
+    if field is None or not field.concrete:
+        return model, None, None, None
+    lookup_name = "exact"
+    if parts and parts[-1] in field.get_lookups():
+        lookup_name = parts.pop()
+    reason = None
+    if parts:
+        reason = "transformed by %s" % LOOKUP_SEP.join(parts)
+    return model, field.name, lookup_name, reason
+
+
+def _check_index(check, vendor, equal):
+    model_field = check.model._meta.get_field(check.column)
+    kind = None
+    if check.lookup in BTREE_LOOKUPS:
+        kind = "btree"
+    elif vendor == "postgresql":
+        kind = POSTGRESQL_KINDS.get(check.lookup)
+    elif vendor == "mysql":
+        kind = MYSQL_KINDS.get(check.lookup)
+    if kind is None:
+        check.reason = "%s can't use an index for %s lookups" % (vendor, check.lookup)
+        return
+    if vendor == "mysql" and model_field.get_internal_type() == "TextField":
+        check.reason = "mysql can't index TEXT columns without a prefix length"
+        return
+    check.kind = kind
+    if _has_index(check.model, model_field, kind, equal):
+        check.status, check.reason = "ok", "indexed"
+    else:
+        check.status, check.reason = "missing", "needs %s" % INDEX_DESCRIPTIONS[kind]
+        check.index = _make_index(check.model, model_field, kind)
+
+
+def _has_index(model, field, kind, equal=()):
+    name = field.name
+    opts = model._meta
+    if kind == "btree":
+        if field.primary_key or field.unique or field.db_index:
+            return True
+        field_lists = list(opts.unique_together)
+        field_lists.extend(getattr(opts, "index_together", ()))
+        field_lists.extend(
+            [f.lstrip("-") for f in index.fields]
+            for index in opts.indexes
+            if index.fields and not index.opclasses and index.condition is None
+        )
+        field_lists.extend(
+            constraint.fields
+            for constraint in opts.constraints
+            if isinstance(constraint, models.UniqueConstraint)
+            and constraint.fields
+            and constraint.condition is None
+        )
+        return any(
+            name in fields and set(fields[: fields.index(name)]) <= set(equal)
+            for fields in map(list, field_lists)
+        )
+    if kind == "pattern":
+        # Django adds a pattern_ops index for indexed text columns.
+        if field.get_internal_type() in ("CharField", "TextField") and (
+            field.unique or field.db_index
+        ):
+            return True
+        return any(
+            index.fields
+            and index.fields[0] == name
+            and index.opclasses
+            and index.opclasses[0].endswith("pattern_ops")
+            for index in opts.indexes
+        )
+    if kind == "trigram":
+        return any(
+            "trgm" in opclass and index_field.lstrip("-") == name
+            for index in opts.indexes
+            for index_field, opclass in zip(index.fields, index.opclasses)
+        ) or any(
+            "trgm" in (opclass or "") and _is_column(expression, name)
+            for expression, opclass in _index_expressions(opts.indexes)
+        )
+    from django.db.models.functions import Upper
+
+    return any(
+        isinstance(expression, Upper)
+        and _is_column(expression.get_source_expressions()[0], name)
+        and (kind == "upper" or "trgm" in (opclass or ""))
+        for expression, opclass in _index_expressions(opts.indexes)
+    )
+
+
+def _index_expressions(indexes):
+    """
+    Yield each expression of indexes with its operator class, or None, taking
+    the expression out of OpClass() and of ordering with desc().
+    """
+    try:
+        from django.contrib.postgres.indexes import OpClass
+    except ImportError:  # Django < 4.0
+        OpClass = ()
+
+    for index in indexes:
+        for expression in getattr(index, "expressions", ()):
+            opclass = None
+            if isinstance(expression, OpClass):
+                opclass = expression.extra["name"]
+                expression = expression.get_source_expressions()[0]
+            if isinstance(expression, models.OrderBy):
+                expression = expression.expression
+            yield expression, opclass
+
+
+def _is_column(expression, name):
+    return isinstance(expression, models.F) and expression.name == name
+
+
+def _make_index(model, field, kind):
+    name = _index_name(model, field.name, INDEX_SUFFIXES[kind])
+    if kind == "btree":
+        return models.Index(fields=[field.name], name=name)
+    if kind == "pattern":
+        opclass = (
+            "text_pattern_ops"
+            if field.get_internal_type() == "TextField"
+            else "varchar_pattern_ops"
+        )
+        return models.Index(fields=[field.name], name=name, opclasses=[opclass])
+    from django.db.models.functions import Upper
+
+    if kind == "upper":
+        return models.Index(Upper(field.name), name=name)
+
+    from django.contrib.postgres.indexes import GinIndex
+
+    if kind == "trigram":
+        return GinIndex(fields=[field.name], name=name, opclasses=["gin_trgm_ops"])
+    try:
+        from django.contrib.postgres.indexes import OpClass
+    except ImportError:  # Django < 3.2 has no expression indexes.
+        return None
+
+    return GinIndex(OpClass(Upper(field.name), name="gin_trgm_ops"), name=name)
+
+
+def _index_name(model, name, suffix):
+    # Like Index.set_name_with_model(), but with the kind of index in the
+    # digest, so that indexes of different kinds on a column don't clash.
+    table = model._meta.db_table
+    digest = names_digest(table, name, suffix, length=6)
+    return "%s_%s_%s_%s" % (table[:11], name[:7], digest, suffix)
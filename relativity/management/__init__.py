@@ -0,0 +1,12 @@
+def matches(field, labels):
+    """
+    Return whether the relationship field is named by any of labels, each of
+    which is an app label, optionally followed by a model and a field name,
+    e.g. "shop", "shop.product" or "shop.product.lookalikes".
+    """
+    parts = field.model._meta.label_lower.split(".") + [field.name.lower()]
+    for label in labels:
+        label_parts = label.lower().split(".")
+        if parts[: len(label_parts)] == label_parts:
+            return True
+    return False
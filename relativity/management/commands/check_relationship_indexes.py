@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.migrations.writer import OperationWriter
+
+from relativity.fields import Relationship
+from relativity.indexes import check_indexes
+from relativity.management import matches
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports the lookups in the predicates of relationships which have no "
+        "index, or can't use one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "labels",
+            nargs="*",
+            metavar="app_label[.ModelName[.field]]",
+            help="Restricts the relationships checked. Defaults to all of them.",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to check for. Defaults to the "default" '
+            "database.",
+        )
+        parser.add_argument(
+            "--operations",
+            action="store_true",
+            help="Prints the migration operations adding the missing indexes.",
+        )
+
+    def handle(self, **options):
+        labels = options["labels"]
+        fields = [
+            field
+            for model in apps.get_models()
+            for field in model._meta.private_fields
+            if isinstance(field, Relationship)
+        ]
+        # Materialized relationships are maintained through a copy, which
+        # would only repeat them.
+        copies = {getattr(field, "predicate_field", None) for field in fields}
+        fields = [field for field in fields if field not in copies]
+        if labels:
+            fields = [f for f in fields if matches(f, labels)]
+            if not fields:
+                raise CommandError("No relationships match %s." % ", ".join(labels))
+        operations = OrderedDict()
+        for field in fields:
+            try:
+                checks = check_indexes(field, options["database"])
+            except ValueError:
+                checks = []
+                if options["verbosity"] >= 1:
+                    self.stdout.write(
+                        "%s.%s: can't inspect the predicate"
+                        % (field.model._meta.label, field.name)
+                    )
+            for check in checks:
+                if options["verbosity"] >= (1 if check.status != "ok" else 2):
+                    self.stdout.write(str(check))
+                if check.index is not None:
+                    app_operations = operations.setdefault(
+                        check.model._meta.app_label, OrderedDict()
+                    )
+                    app_operations.setdefault(check.index.name, check)
+        if options["operations"]:
+            for app_label, checks in operations.items():
+                self.write_operations(app_label, list(checks.values()))
+
+    def write_operations(self, app_label, checks):
+        operations = [check.operation for check in checks]
+        if any("trigram" in check.kind for check in checks):
+            from django.contrib.postgres.operations import TrigramExtension
+
+            operations.insert(0, TrigramExtension())
+        lines, imports = [], {"from django.db import migrations"}
+        for operation in operations:
+            operation_string, operation_imports = OperationWriter(
+                operation, indentation=1
+            ).serialize()
+            lines.append(operation_string)
+            imports.update(operation_imports)
+        self.stdout.write("\n# Operations for %s:" % app_label)
+        for line in sorted(imports):
+            self.stdout.write(line)
+        self.stdout.write("\noperations = [")
+        for line in lines:
+            self.stdout.write(line)
+        self.stdout.write("]")
@@ -0,0 +1,47 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from relativity.fields import Relationship
+from relativity.management import matches
+from relativity.materialized import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the tables of relationships with materialize=True."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "labels",
+            nargs="*",
+            metavar="app_label[.ModelName[.field]]",
+            help="Restricts the relationships rebuilt. Defaults to all of them.",
+        )
+        parser.add_argument(
+            "--database",
+            default=DEFAULT_DB_ALIAS,
+            help='Nominates a database to rebuild. Defaults to the "default" '
+            "database.",
+        )
+
+    def handle(self, **options):
+        labels = options["labels"]
+        fields = [
+            field
+            for model in apps.get_models()
+            for field in model._meta.private_fields
+            if isinstance(field, Relationship) and field.materialize
+        ]
+        if labels:
+            fields = [f for f in fields if matches(f, labels)]
+            if not fields:
+                raise CommandError(
+                    "No materialized relationships match %s." % ", ".join(labels)
+                )
+        for field in fields:
+            count = rebuild(field, options["database"])
+            if options["verbosity"] >= 1:
+                self.stdout.write(
+                    "Rebuilt %s.%s: %d pairs"
+                    % (field.model._meta.label, field.name, count)
+                )
@@ -0,0 +1,167 @@
+"""
+Maintains the tables in which Relationships with materialize=True store the
+pks of each pair of related objects.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+
+
+def _predicate_field_name(field):
+    return field.predicate_field.name
+
+
+def _affected(model, attnames, update_fields):
+    """
+    Return whether saving the fields in update_fields may change the objects
+    that are related through the fields with the given attnames.
+    """
+    if update_fields is None or attnames is None:
+        return True
+    saved = set()
+    for f in model._meta.concrete_fields:
+        if f.name in update_fields or f.attname in update_fields:
+            saved.add(f.attname)
+    return bool(saved.intersection(attnames))
+
+
+def refresh_local(field, obj, using):
+    """
+    Re-evaluate the objects related to obj, an instance of field.model.
+    """
+    _refresh_local_pks(field, [obj.pk], using)
+
+
+def refresh_related(field, obj, using):
+    """
+    Re-evaluate the objects related to obj, an instance of field.related_model.
+    """
+    _refresh_related_pks(field, [obj.pk], using)
+
+
+def _refresh_local_pks(field, pks, using):
+    name = _predicate_field_name(field)
+    pairs = (
+        field.model._base_manager.using(using)
+        .filter(pk__in=pks, **{"%s__isnull" % name: False})
+        .values_list("pk", name)
+        .distinct()
+    )
+    through = field.through._base_manager.using(using)
+    with transaction.atomic(using=using):
+        through.filter(local__in=pks).delete()
+        through.bulk_create(
+            [
+                field.through(local_id=local, related_id=related)
+                for local, related in pairs
+            ]
+        )
+
+
+def _refresh_related_pks(field, pks, using):
+    name = _predicate_field_name(field)
+    pairs = (
+        field.model._base_manager.using(using)
+        .filter(**{"%s__in" % name: pks})
+        .values_list("pk", name)
+        .distinct()
+    )
+    through = field.through._base_manager.using(using)
+    with transaction.atomic(using=using):
+        through.filter(related__in=pks).delete()
+        through.bulk_create(
+            [
+                field.through(local_id=local, related_id=related)
+                for local, related in pairs
+            ]
+        )
+
+
+def rebuild(field, using):
+    """
+    Re-evaluate every pair of related objects, in a single INSERT ... SELECT.
+    Return the number of pairs.
+    """
+    name = _predicate_field_name(field)
+    pairs = (
+        field.model._base_manager.using(using)
+        .filter(**{"%s__isnull" % name: False})
+        .order_by()
+        .values_list("pk", name)
+        .distinct()
+    )
+    sql, params = pairs.query.get_compiler(using=using).as_sql()
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = field.through._meta
+    with transaction.atomic(using=using):
+        field.through._base_manager.using(using).all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO %s (%s, %s) %s"
+                % (
+                    qn(opts.db_table),
+                    qn(opts.get_field("local").column),
+                    qn(opts.get_field("related").column),
+                    sql,
+                ),
+                params,
+            )
+    return field.through._base_manager.using(using).count()
+
+
+def connect_materialized_signals(field):
+    """
+    Keep the table of a Relationship with materialize=True up to date as
+    objects on either side, or that its predicate reads through relations,
+    are saved. Deleted objects are removed from it by cascading.
+    """
+    model, related_model = field.model, field.remote_field.model
+
+    def saved(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+        if raw:
+            return
+        if sender is model and _affected(
+            model, field._cache_key_attnames(forward=True), update_fields
+        ):
+            refresh_local(field, instance, using)
+        if sender is related_model and _affected(
+            related_model, field._cache_key_attnames(forward=False), update_fields
+        ):
+            refresh_related(field, instance, using)
+
+    dispatch_uid = "relativity.materialized.%s.%s" % (model._meta.label, field.name)
+    post_save.connect(saved, sender=model, weak=False, dispatch_uid=dispatch_uid)
+    if related_model is not model:
+        post_save.connect(
+            saved, sender=related_model, weak=False, dispatch_uid=dispatch_uid
+        )
+
+    # The models reached through relations may not be loaded yet, so they're
+    # only looked up on the first save.
+    dependencies = []
+
+    def dependency_saved(sender, instance, raw=False, using=None, **kwargs):
+        if raw:
+            return
+        if not dependencies:
+            dependencies.append(field._materialized_dependencies())
+        for dependency, path, forward in dependencies[0]:
+            if sender is not dependency:
+                continue
+            if forward:
+                pks = model._base_manager.using(using).filter(**{path: instance})
+                _refresh_local_pks(field, list(pks.values_list("pk", flat=True)), using)
+            else:
+                pks = related_model._base_manager.using(using).filter(
+                    **{path: instance}
+                )
+                _refresh_related_pks(
+                    field, list(pks.values_list("pk", flat=True)), using
+                )
+
+    post_save.connect(
+        dependency_saved, weak=False, dispatch_uid="%s.dependencies" % dispatch_uid
+    )
@@ -0,0 +1,135 @@
+"""
+Receivers which forward the signals in relativity.signals to a metrics
+client, e.g.
+
+    StatsdCollector(statsd.StatsClient()).connect()
+
+The metrics recorded for each Relationship are:
+
+- compile: a count of the joins compiled.
+- compile.cached: a count of the joins which reused a resolved predicate.
+- compile.duration: the time taken to compile each join, in ms.
+- prefetch: a count of the prefetches.
+- prefetch.duration: the time taken to fetch and match each prefetch, in ms.
+- prefetch.batch_size: the number of instances in each prefetched batch.
+- prefetch.matched and prefetch.unmatched: counts of the prefetched objects
+  which were and weren't related to an instance.
+- filter_fallback: a count of the filters which join back to the local table.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from relativity import signals
+
+
+class MetricsCollector(object):
+    """
+    Records metrics for the signals sent by Relationships. Subclasses define
+    increment() and record(), which take the name of the metric, a value and
+    a dict of tags identifying the Relationship. Sizes are passed to
+    record_size(), which records them like durations unless overridden.
+    """
+
+    def __init__(self, prefix="relativity"):
+        self.prefix = prefix
+
+    def increment(self, name, value, tags):
+        raise NotImplementedError
+
+    def record(self, name, value, tags):
+        raise NotImplementedError
+
+    def record_size(self, name, value, tags):
+        self.record(name, value, tags)
+
+    def get_name(self, name):
+        return "%s.%s" % (self.prefix, name) if self.prefix else name
+
+    def get_tags(self, field, **tags):
+        tags["relationship"] = "%s.%s" % (field.model._meta.label, field.name)
+        return tags
+
+    def connect(self):
+        for signal, receiver in self.receivers():
+            signal.connect(receiver, weak=False, dispatch_uid=id(self))
+
+    def disconnect(self):
+        for signal, receiver in self.receivers():
+            signal.disconnect(dispatch_uid=id(self))
+
+    def receivers(self):
+        return [
+            (signals.predicate_resolved, self.predicate_resolved),
+            (signals.prefetch_batch, self.prefetch_batch),
+            (signals.prefetch_matched, self.prefetch_matched),
+            (signals.filter_fallback, self.filter_fallback),
+        ]
+
+    def predicate_resolved(self, field, forward, cached, duration, **kwargs):
+        tags = self.get_tags(field, direction="forward" if forward else "reverse")
+        self.increment(self.get_name("compile"), 1, tags)
+        if cached:
+            self.increment(self.get_name("compile.cached"), 1, tags)
+        self.record(self.get_name("compile.duration"), duration * 1000, tags)
+
+    def prefetch_batch(self, field, size, **kwargs):
+        tags = self.get_tags(field)
+        self.record_size(self.get_name("prefetch.batch_size"), size, tags)
+
+    def prefetch_matched(self, field, matched, unmatched, duration, **kwargs):
+        tags = self.get_tags(field)
+        self.increment(self.get_name("prefetch"), 1, tags)
+        self.record(self.get_name("prefetch.duration"), duration * 1000, tags)
+        self.increment(self.get_name("prefetch.matched"), matched, tags)
+        self.increment(self.get_name("prefetch.unmatched"), unmatched, tags)
+
+    def filter_fallback(self, field, reason, **kwargs):
+        tags = self.get_tags(field, reason=reason)
+        self.increment(self.get_name("filter_fallback"), 1, tags)
+
+
+class StatsdCollector(MetricsCollector):
+    """
+    Sends metrics to a client with the incr(), timing() and gauge() methods of
+    the statsd package, sending sizes as gauges. As plain statsd has no tags, the relationship is added to
+    the name of each metric, e.g. relativity.compile.tests.Page.descendants.
+    """
+
+    def __init__(self, client, prefix="relativity"):
+        super(StatsdCollector, self).__init__(prefix)
+        self.client = client
+
+    def stat(self, name, tags):
+        return "%s.%s" % (name, tags["relationship"])
+
+    def increment(self, name, value, tags):
+        self.client.incr(self.stat(name, tags), value)
+
+    def record(self, name, value, tags):
+        self.client.timing(self.stat(name, tags), value)
+
+    def record_size(self, name, value, tags):
+        self.client.gauge(self.stat(name, tags), value)
+
+
+class OpenTelemetryCollector(MetricsCollector):
+    """
+    Records metrics with the counters and histograms of an OpenTelemetry
+    Meter, with the relationship and other tags as attributes.
+    """
+
+    def __init__(self, meter, prefix="relativity"):
+        super(OpenTelemetryCollector, self).__init__(prefix)
+        self.meter = meter
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value, tags):
+        if name not in self.counters:
+            self.counters[name] = self.meter.create_counter(name)
+        self.counters[name].add(value, attributes=tags)
+
+    def record(self, name, value, tags):
+        if name not in self.histograms:
+            self.histograms[name] = self.meter.create_histogram(name)
+        self.histograms[name].record(value, attributes=tags)
@@ -1,9 +1,26 @@
 from django.db.models import Q
 
-from relativity.fields import L, Relationship
+from relativity.evaluate import evaluate_predicate
+from relativity.fields import L, Relationship, nested_set_count
 
 
 class MPTTRef(L):
+    """
+    Refers to one of the MPTT fields of the local model by its option name,
+    e.g. MPTTRef("left"). The field is looked up once per model.
+    """
+
+    def _get_ref(self, model):
+        refs = self.__dict__.setdefault("_refs", {})
+        try:
+            return refs[model]
+        except KeyError:
+            ref = refs[model] = L(getattr(model._mptt_meta, self.name + "_attr"))
+            return ref
+
+    def _relativity_resolve_for_instance(self, obj):
+        return getattr(obj, self._get_ref(type(obj)).name)
+
     def resolve_expression(
         self,
         query=None,
@@ -13,33 +30,75 @@ class MPTTRef(L):
         for_save=False,
         simple_col=False,
     ):
-        model = query._relationship_field_query.model
-        name = getattr(model._mptt_meta, self.name + "_attr")
-        return L(name).resolve_expression(
+        model = getattr(query, "_relationship_field_query", query).model
+        return self._get_ref(model).resolve_expression(
             query, allow_joins, reuse, summarize, for_save, simple_col
         )
 
 
 class MPTTQ(Q):
+    """
+    A Q whose lookups use MPTT option names, e.g. MPTTQ(left__gt=...), which
+    are translated to the model's field names once per model.
+    """
+
     def __init__(self, *args, **kwargs):
         super(MPTTQ, self).__init__(*args, **kwargs)
         self.filters = kwargs
 
+    def translate(self, model):
+        translated = self.__dict__.setdefault("_translated", {})
+        try:
+            return translated[model]
+        except KeyError:
+            translate_lookups = model._tree_manager._translate_lookups
+            q = translated[model] = Q(**translate_lookups(**self.filters))
+            return q
+
     def resolve_expression(
         self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False
     ):
-        translate_lookups = query.model._tree_manager._translate_lookups
-        translated_filters = translate_lookups(**self.filters)
-        clone_q = Q(**translated_filters)
         # We must promote any new joins to left outer joins so that when Q is
         # used as an expression, rows aren't filtered due to joins.
-        return clone_q.resolve_expression(
+        return self.translate(query.model).resolve_expression(
             query, allow_joins, reuse, summarize, for_save
         )
 
+    def _relativity_evaluate(self, local, related):
+        return evaluate_predicate(self.translate(type(related)), local, related)
+
+
+class MPTTCountMixin(object):
+    """
+    Counts and prefetches the nodes in a subtree using the node's left and
+    right values, as long as the relationship hasn't been customised.
+    """
 
-class MPTTDescendants(Relationship):
+    include_self = False
+
+    def get_nested_set_fields(self):
+        if self.closed_form_count:
+            opts = self.model._mptt_meta
+            return (
+                opts.tree_id_attr,
+                opts.left_attr,
+                opts.right_attr,
+                self.include_self,
+            )
+
+    def get_count_expression(self):
+        if self.closed_form_count:
+            opts = self.model._mptt_meta
+            return nested_set_count(opts.left_attr, opts.right_attr, self.include_self)
+
+    def get_count_for_instance(self, obj):
+        if self.closed_form_count:
+            return obj.get_descendant_count() + self.include_self
+
+
+class MPTTDescendants(MPTTCountMixin, Relationship):
     def __init__(self, **kwargs):
+        self.closed_form_count = "to" not in kwargs and "predicate" not in kwargs
         kwargs.setdefault("related_name", "ascendants")
         kwargs.setdefault("to", "self")
         kwargs.setdefault(
@@ -53,8 +112,11 @@ class MPTTDescendants(Relationship):
         super(MPTTDescendants, self).__init__(**kwargs)
 
 
-class MPTTSubtree(Relationship):
+class MPTTSubtree(MPTTCountMixin, Relationship):
+    include_self = True
+
     def __init__(self, **kwargs):
+        self.closed_form_count = "to" not in kwargs and "predicate" not in kwargs
         kwargs.setdefault("related_name", "rootpath")
         kwargs.setdefault("to", "self")
         kwargs.setdefault(
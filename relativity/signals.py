@@ -0,0 +1,32 @@
+"""
+Signals reporting how much work Relationships do. Each is sent with the
+Relationship's model as the sender and the Relationship itself as field.
+
+Nothing is measured unless a receiver is connected, so they cost nothing
+otherwise. relativity.metrics has receivers which forward them to statsd or
+OpenTelemetry.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+from django.dispatch import Signal
+
+# Sent whenever the join condition of a Relationship is compiled, with
+# forward, whether the join follows the relationship forwards, cached, whether
+# the resolved predicate was reused, and duration, in seconds.
+predicate_resolved = Signal()
+
+# Sent for each batch of instances a Relationship is prefetched for, with size,
+# the number of instances, and batches, the number of batches.
+prefetch_batch = Signal()
+
+# Sent once the prefetched objects have been matched to instances, with
+# instances, the number of instances, rows, the number of objects fetched,
+# matched and unmatched, the number of them which were and weren't related to
+# an instance, and duration, the seconds taken to fetch and match them.
+prefetch_matched = Signal()
+
+# Sent when the objects related to obj can't be selected by filtering on
+# their own fields, so the filter has to join back to obj's table. reason is
+# "materialize" for materialized relationships and "predicate" otherwise.
+filter_fallback = Signal()
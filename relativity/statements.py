@@ -0,0 +1,210 @@
+"""
+Statements compiled once and executed for any instance. The SQL selecting the
+objects related to an instance only differs between instances in the values
+it compares against, so a relationship with cache_statements compiles it once
+per direction, manager and database, with a placeholder for each of those
+values, and executes the same SQL for every instance. Besides skipping the
+compilation, the database always sees the same statement, which lets it reuse
+the plan.
+"""
+
+from __future__ import unicode_literals, absolute_import
+
+import copy
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections
+from django.db.models import Expression
+from django.db.models.query import ModelIterable
+
+
+class InstanceParameter(Expression):
+    """
+    A placeholder for a value of the instance a statement is executed for,
+    get_value(instance), which is prepared for the database by output_field.
+    """
+
+    def __init__(self, get_value, output_field):
+        super(InstanceParameter, self).__init__(output_field=output_field)
+        self.get_value = get_value
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.get_value)
+
+    def as_sql(self, compiler, connection):
+        return "%s", [self]
+
+    def get_db_prep_value(self, instance, connection):
+        return self.output_field.get_db_prep_value(self.get_value(instance), connection)
+
+
+def query_key(query, using):
+    """
+    Return a key which is the same for any two queries which compile to the
+    same SQL, or None if query has parameters, which a manager may compute
+    afresh for every queryset, e.g. from the current time. A query of every
+    row of its model's table, ordered by field names, is keyed without
+    compiling it.
+    """
+    if (
+        not query.where
+        and not query.annotations
+        and not query.extra
+        and all(isinstance(o, str) for o in query.order_by)
+        and not query.select_related
+        and not query.distinct
+        and not query.select
+        and query.combinator is None
+        and query.default_ordering
+        and query.deferred_loading == (frozenset(), True)
+        and query.low_mark == 0
+        and query.high_mark is None
+    ):
+        return query.model, tuple(query.order_by)
+    try:
+        sql, params = query.chain().get_compiler(using=using).as_sql()
+    except EmptyResultSet:
+        return query.model, None
+    if params:
+        return None
+    return query.model, sql
+
+
+class Statement(object):
+    """
+    The SQL of a query compiled with InstanceParameters, executed with the
+    values of an instance through compilers which skip compiling it again.
+    With prepare, it's prepared on the server when the database is PostgreSQL
+    and psycopg 3 binds the parameters on the server.
+    """
+
+    def __init__(self, query, using, prepare=False):
+        self.compiler = query.get_compiler(using=using)
+        try:
+            self.sql, self.params = self.compiler.as_sql()
+        except EmptyResultSet:
+            self.sql, self.params = None, ()
+        # Each execution sets the connection of its own thread.
+        self.compiler.connection = None
+        self.prepare = prepare
+
+    def get_compiler(self, instance, using):
+        """
+        Return a compiler of the query whose SQL has the values of instance
+        as its parameters.
+        """
+        connection = connections[using]
+        params = tuple(
+            (
+                param.get_db_prep_value(instance, connection)
+                if isinstance(param, InstanceParameter)
+                else param
+            )
+            for param in self.params
+        )
+        compiler = copy.copy(self.compiler)
+        compiler.__class__ = statement_compiler_class(type(self.compiler))
+        compiler.connection = connection
+        compiler.statement = self
+        compiler.statement_params = params
+        return compiler
+
+
+class StatementCompilerMixin(object):
+    """
+    Added to a backend's compiler class by statement_compiler_class(), to
+    return a Statement's SQL, with the parameters of one instance, instead of
+    compiling the query, and prepare it if the statement is to be prepared.
+    """
+
+    statement = None
+    statement_params = ()
+
+    def as_sql(self, *args, **kwargs):
+        if self.statement.sql is None:
+            raise EmptyResultSet
+        return self.statement.sql, self.statement_params
+
+    def execute_sql(self, *args, **kwargs):
+        execute_sql = super(StatementCompilerMixin, self).execute_sql
+        if not self.statement.prepare or self.connection.vendor != "postgresql":
+            return execute_sql(*args, **kwargs)
+        with self.connection.execute_wrapper(_execute_prepared):
+            return execute_sql(*args, **kwargs)
+
+
+_statement_compiler_classes = {}
+
+
+def statement_compiler_class(compiler_class):
+    """
+    Return the subclass of compiler_class, a backend's SQLCompiler, which
+    executes Statements.
+    """
+    try:
+        return _statement_compiler_classes[compiler_class]
+    except KeyError:
+        pass
+    cls = type(
+        str("Statement%s" % compiler_class.__name__),
+        (StatementCompilerMixin, compiler_class),
+        {},
+    )
+    _statement_compiler_classes[compiler_class] = cls
+    return cls
+
+
+def _execute_prepared(execute, sql, params, many, context):
+    try:
+        from psycopg import ClientCursor
+    except ImportError:  # psycopg2 can't prepare statements.
+        return execute(sql, params, many, context)
+    cursor = context["cursor"].cursor
+    if many or isinstance(cursor, ClientCursor):
+        return execute(sql, params, many, context)
+    with context["connection"].wrap_database_errors:
+        return cursor.execute(sql, params, prepare=True)
+
+
+class StatementIterable(ModelIterable):
+    """
+    Yields the objects of a relationship manager's queryset by executing its
+    statement, unless the queryset has been changed since the manager made
+    it, in which case it's evaluated like any other.
+    """
+
+    def __iter__(self):
+        queryset = self.queryset
+        get_statement, instance = queryset.__dict__.get(
+            "_relativity_statement", (None, None)
+        )
+        if get_statement is None or queryset._deferred_filter is None:
+            return super(StatementIterable, self).__iter__()
+        db = queryset.db
+        # The query without the deferred filter on the instance's values.
+        statement = get_statement(queryset._query, db)
+        if statement is None:
+            return super(StatementIterable, self).__iter__()
+        compiled = _CompiledQuerySet(queryset, statement.get_compiler(instance, db))
+        return ModelIterable(compiled, self.chunked_fetch, self.chunk_size).__iter__()
+
+
+class _CompiledQuerySet(object):
+    """
+    Stands in for a queryset whose query is already compiled.
+    """
+
+    def __init__(self, queryset, compiler):
+        self.queryset = queryset
+        self.query = _CompiledQuery(compiler)
+
+    def __getattr__(self, name):
+        return getattr(self.queryset, name)
+
+
+class _CompiledQuery(object):
+    def __init__(self, compiler):
+        self.compiler = compiler
+
+    def get_compiler(self, *args, **kwargs):
+        return self.compiler
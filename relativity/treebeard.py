@@ -1,29 +1,176 @@
-from django.db.models import Q
+from django.db.models import CharField, Q, Value
+from django.db.models.expressions import ExpressionList
+from django.db.models.functions import Concat, Substr
 
-from relativity.fields import Relationship, L
+from relativity.fields import Relationship, L, nested_set_count
+
+
+class MPPathLimit(L):
+    """
+    Refers to the upper bound of the paths in a materialised-path node's
+    subtree: the node's path followed by the last character of the tree's
+    alphabet, repeated enough times to sort after any descendant's path.
+    """
+
+    def __init__(self, name="path"):
+        super(MPPathLimit, self).__init__(name)
+
+    @staticmethod
+    def _suffix(model, name):
+        return model.alphabet[-1] * model._meta.get_field(name).max_length
+
+    def _relativity_resolve_for_instance(self, obj):
+        return getattr(obj, self.name) + self._suffix(type(obj), self.name)
+
+    def resolve_expression(
+        self,
+        query=None,
+        allow_joins=True,
+        reuse=None,
+        summarize=False,
+        for_save=False,
+        simple_col=False,
+    ):
+        instance = getattr(query, "_relativity_instance", None)
+        if instance is not None:
+            return Value(self._relativity_resolve_for_instance(instance))
+        parameters = getattr(query, "_relativity_parameters", None)
+        if parameters is not None:
+            return self._relativity_parameter(parameters)
+        model = getattr(query, "_relationship_field_query", query).model
+        limit = Concat(L(self.name), Value(self._suffix(model, self.name)))
+        return limit.resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+
+def mp_subtree_predicate(include_self, range_scan):
+    """
+    Return a predicate selecting the descendants of a materialised-path node.
+
+    With range_scan, the prefix match is expressed as a range of paths, which
+    databases can satisfy from an index on path whatever its collation.
+    """
+    if range_scan:
+        lower = "path__gte" if include_self else "path__gt"
+        return Q(**{lower: L("path"), "path__lte": MPPathLimit()})
+    elif include_self:
+        return Q(path__startswith=L("path"))
+    else:
+        return Q(path__startswith=L("path")) & ~Q(path=L("path"))
+
+
+class ExpressionTuple(ExpressionList):
+    """
+    A parenthesised list of expressions, for the right hand side of an IN
+    lookup. Unlike a Python list of expressions, it's relabelled along with
+    the rest of the query when used in a subquery.
+    """
+
+    template = "(%(expressions)s)"
+
+
+class MPAncestorsQ(Q):
+    """
+    Selects the ancestors of a materialised-path node, i.e. the nodes whose
+    paths are proper prefixes of its path. For an instance these are simply
+    enumerated; in a join, the related path is compared against each possible
+    prefix of the local path, which databases can answer from an index.
+    """
+
+    include_self = False
+
+    def _relativity_related_values(self, obj):
+        path, steplen = obj.path, type(obj).steplen
+        end = len(path) + steplen if self.include_self else len(path)
+        return "path", [path[:i] for i in range(steplen, end, steplen)]
+
+    def _relativity_evaluate(self, local, related):
+        return related.path in self._relativity_related_values(local)[1]
+
+    def resolve_expression(
+        self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False
+    ):
+        steplen = query.model.steplen
+        max_length = query.model._meta.get_field("path").max_length
+        prefixes = [
+            Substr(L("path"), 1, i) for i in range(steplen, max_length + 1, steplen)
+        ]
+        q = Q(path__in=ExpressionTuple(*prefixes, output_field=CharField()))
+        if not self.include_self:
+            q &= Q(path__lt=L("path"))
+        return q.resolve_expression(query, allow_joins, reuse, summarize, for_save)
+
+
+class MPRootPathQ(MPAncestorsQ):
+    include_self = True
 
 
 class MP_Descendants(Relationship):
-    def __init__(self, **kwargs):
+    def __init__(self, range_scan=True, **kwargs):
         kwargs.setdefault("related_name", "ascendants")
         kwargs.update(
             to="self",
-            predicate=Q(path__startswith=L("path"), path__ne=L("path")),
+            predicate=mp_subtree_predicate(include_self=False, range_scan=range_scan),
         )
         super(MP_Descendants, self).__init__(**kwargs)
+        self.range_scan = range_scan
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(MP_Descendants, self).deconstruct()
+        if not self.range_scan:
+            kwargs["range_scan"] = False
+        return name, path, args, kwargs
 
 
 class MP_Subtree(Relationship):
-    def __init__(self, **kwargs):
+    def __init__(self, range_scan=True, **kwargs):
         kwargs.setdefault("related_name", "rootpath")
         kwargs.update(
             to="self",
-            predicate=Q(path__startswith=L("path")),
+            predicate=mp_subtree_predicate(include_self=True, range_scan=range_scan),
         )
         super(MP_Subtree, self).__init__(**kwargs)
+        self.range_scan = range_scan
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(MP_Subtree, self).deconstruct()
+        if not self.range_scan:
+            kwargs["range_scan"] = False
+        return name, path, args, kwargs
+
+
+class MP_Ancestors(Relationship):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("related_name", "+")
+        kwargs.update(to="self", predicate=MPAncestorsQ())
+        super(MP_Ancestors, self).__init__(**kwargs)
+
 
+class MP_RootPath(Relationship):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("related_name", "+")
+        kwargs.update(to="self", predicate=MPRootPathQ())
+        super(MP_RootPath, self).__init__(**kwargs)
+
+
+class NSCountMixin(object):
+    """
+    Counts and prefetches the nodes in a nested set subtree using the node's
+    lft and rgt.
+    """
+
+    include_self = False
+
+    def get_nested_set_fields(self):
+        return "tree_id", "lft", "rgt", self.include_self
 
-class NS_Descendants(Relationship):
+    def get_count_expression(self):
+        return nested_set_count("lft", "rgt", self.include_self)
+
+    def get_count_for_instance(self, obj):
+        return (obj.rgt - obj.lft - 1) // 2 + self.include_self
+
+
+class NS_Descendants(NSCountMixin, Relationship):
     def __init__(self, **kwargs):
         kwargs.setdefault("related_name", "ascendants")
         kwargs.update(
@@ -37,7 +184,9 @@ class NS_Descendants(Relationship):
         super(NS_Descendants, self).__init__(**kwargs)
 
 
-class NS_Subtree(Relationship):
+class NS_Subtree(NSCountMixin, Relationship):
+    include_self = True
+
     def __init__(self, **kwargs):
         kwargs.setdefault("related_name", "rootpath")
         kwargs.update(
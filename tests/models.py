@@ -9,9 +9,22 @@ from mptt.models import MPTTModel
 from treebeard.mp_tree import MP_Node
 from treebeard.ns_tree import NS_Node
 
-from relativity.fields import L, Relationship
+from relativity.adjacency import (
+    AdjacencyAncestors,
+    AdjacencyDescendants,
+    AdjacencyRootPath,
+    AdjacencySubtree,
+)
+from relativity.fields import L, Relationship, RelationshipQuerySet
 from relativity.mptt import MPTTDescendants, MPTTSubtree
-from relativity.treebeard import MP_Descendants, NS_Descendants, MP_Subtree, NS_Subtree
+from relativity.treebeard import (
+    MP_Ancestors,
+    MP_Descendants,
+    MP_RootPath,
+    MP_Subtree,
+    NS_Descendants,
+    NS_Subtree,
+)
 
 
 class LinkedNode(models.Model):
@@ -26,6 +39,8 @@ class LinkedNode(models.Model):
         related_name="prev",
     )
 
+    following = AdjacencyDescendants(parent="prev_id", related_name="preceding")
+
 
 @Field.register_lookup
 class NotEqual(Lookup):
@@ -63,6 +78,16 @@ class TBMPPage(MP_Node, BasePage):
     descendants = MP_Descendants()
     subtree = MP_Subtree()
 
+    prefix_descendants = MP_Descendants(
+        range_scan=False, related_name="prefix_ascendants"
+    )
+    ancestors = MP_Ancestors()
+    path_to_root = MP_RootPath()
+
+    statement_descendants = MP_Descendants(
+        cache_statements=True, related_name="statement_ascendants"
+    )
+
 
 class TBNSPage(NS_Node, BasePage):
 
@@ -70,6 +95,19 @@ class TBNSPage(NS_Node, BasePage):
     subtree = NS_Subtree()
 
 
+class AdjacencyPage(BasePage):
+    parent = models.ForeignKey(
+        "self", on_delete=models.CASCADE, null=True, blank=True, related_name="children"
+    )
+
+    descendants = AdjacencyDescendants()
+    subtree = AdjacencySubtree()
+    ancestors = AdjacencyAncestors()
+    path_to_root = AdjacencyRootPath()
+
+    near_descendants = AdjacencyDescendants(max_depth=2, related_name="near_ascendants")
+
+
 class PageBase(BasePage):
     descendants = Relationship(
         "self",
@@ -112,7 +150,12 @@ class CategoryBase(models.Model):
 
 
 class Category(CategoryBase):
-    pass
+    materialized_members = Relationship(
+        Categorised,
+        Q(category_codes__contains=L("code")),
+        materialize=True,
+        related_name="materialized_categories",
+    )
 
 
 class Product(models.Model):
@@ -122,6 +165,18 @@ class Product(models.Model):
     size = models.IntegerField()
     deleted = models.BooleanField(default=False)
 
+    lookalikes = Relationship(
+        "self",
+        Q(colour=L("colour"), shape=L("shape")),
+        related_name="lookalike_of",
+    )
+
+    similar = Relationship(
+        "self",
+        Q(colour=L("colour")) | Q(shape=L("shape")),
+        related_name="similar_to",
+    )
+
     def __str__(self):
         return "Product #%s: a %s %s, size %s" % (
             self.sku,
@@ -143,6 +198,24 @@ class CartItem(models.Model):
         null=False,
     )
 
+    cached_product = Relationship(
+        Product,
+        Q(deleted=False, sku=L("product_code")),
+        related_name="cached_cart_items",
+        multiple=False,
+        null=False,
+        cache_related=True,
+    )
+
+    statement_product = Relationship(
+        Product,
+        Q(deleted=False, sku=L("product_code")),
+        related_name="statement_cart_items",
+        multiple=False,
+        null=False,
+        cache_statements="prepare",
+    )
+
     def __str__(self):
         return "Cart item #%s: product code %s" % (self.pk, self.product_code)
 
@@ -152,7 +225,15 @@ class ProductFilter(models.Model):
     fsize = models.IntegerField()
 
     products = Relationship(
-        Product, Q(colour=L("fcolour"), size__gte=L("fsize")), related_name="filters"
+        Product,
+        Q(colour=L("fcolour"), size__gte=L("fsize")),
+        related_name="filters",
+    )
+    paired_products = Relationship(
+        Product,
+        Q(colour=L("fcolour"), size__gte=L("fsize")),
+        related_name="paired_filters",
+        prefetch_strategy="pairs",
     )
 
     cartitems = Relationship(
@@ -160,14 +241,50 @@ class ProductFilter(models.Model):
         Q(product__colour=L("fcolour"), product__size__gte=L("fsize")),
         related_name="filters",
     )
+    materialized_cartitems = Relationship(
+        CartItem,
+        Q(product__colour=L("fcolour")),
+        materialize=True,
+        related_name="materialized_filters",
+    )
 
     def __str__(self):
         return "ProductFilter #%d: %s size %s" % (self.pk, self.fcolour, self.fsize)
 
 
+class Pair(models.Model):
+    a = models.IntegerField()
+    b = models.IntegerField()
+
+
+class PairHolder(models.Model):
+    x = models.IntegerField()
+    y = models.IntegerField()
+
+    pairs = Relationship(
+        Pair, Q(a=L("x"), b=L("y")), reverse_multiple=False, related_name="holder"
+    )
+    pair = Relationship(
+        Pair, Q(a=L("x"), b=L("y")), multiple=False, related_name="holders"
+    )
+
+
+class Supplier(models.Model):
+    code = models.CharField(max_length=10, unique=True)
+    products = models.ManyToManyField(Product, related_name="+")
+
+
+class Delivery(models.Model):
+    supplier = models.ForeignKey(
+        Supplier, on_delete=models.CASCADE, to_field="code", related_name="deliveries"
+    )
+
+
 class User(models.Model):
     username = models.CharField(primary_key=True, max_length=255)
 
+    objects = RelationshipQuerySet.as_manager()
+
     def __str__(self):
         return self.username
 
@@ -177,6 +294,8 @@ class Chemical(models.Model):
     chemical_name = models.TextField()
     common_name = models.TextField(blank=True)
 
+    objects = RelationshipQuerySet.as_manager()
+
     def __str__(self):
         return self.formula
 
@@ -185,6 +304,20 @@ class SavedFilter(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     search_regex = models.TextField()
     chemicals = Relationship(Chemical, Q(formula__regex=L("search_regex")))
+    exists_chemicals = Relationship(
+        Chemical,
+        Q(formula__regex=L("search_regex")),
+        filter_strategy="exists",
+        related_name="exists_filters",
+    )
+    materialized_chemicals = Relationship(
+        Chemical,
+        Q(formula__regex=L("search_regex")),
+        materialize=True,
+        related_name="materialized_filters",
+    )
+
+    objects = RelationshipQuerySet.as_manager()
 
 
 class UserGenerator(models.Model):
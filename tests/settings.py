@@ -10,7 +10,7 @@ import environ
 env = environ.Env()
 DATABASES = {"default": env.db(default="sqlite:///")}
 
-INSTALLED_APPS = ["tests"]
+INSTALLED_APPS = ["relativity", "tests"]
 
 SECRET_KEY = "test_secret_key"
 
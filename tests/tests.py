@@ -1,20 +1,55 @@
 from __future__ import unicode_literals
 
-from unittest import expectedFailure
+import io
+import operator
+import sys
+import types
+from collections import OrderedDict, defaultdict
+from unittest import expectedFailure, mock, skipIf
 
+import django
+from django.core.management import CommandError, call_command
+from django.db import connection, models
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, isolate_apps
+
+from django.db.models import Count, Prefetch, Q, Sum
+
+from relativity.aggregates import (
+    RelationshipAggregate,
+    RelationshipCount,
+    RelationshipExists,
+)
+from relativity.evaluate import python_lookups
+from relativity.indexes import _has_index, check_indexes
+from relativity.metrics import OpenTelemetryCollector, StatsdCollector
+from relativity.fields import (
+    L,
+    Relationship,
+    RelationshipQuerySet,
+    aprefetch_related_objects,
+    correlated_queryset,
+    nested_set_count,
+)
+from relativity.statements import _execute_prepared
 
 from .models import (
+    AdjacencyPage,
     CartItem,
     Categorised,
     Category,
+    Chemical,
+    Delivery,
     MPTTPage,
     Page,
+    Pair,
+    PairHolder,
     Product,
     ProductFilter,
     TBMPPage,
     TBNSPage,
     SavedFilter,
+    Supplier,
     User,
     LinkedNode,
     UserGenerator,
@@ -25,6 +60,11 @@ class RelationshipTests(TestCase):
     def assertSeqEqual(self, seq1, seq2):
         self.assertSequenceEqual(list(seq1), list(seq2))
 
+    def setUp(self):
+        # NotEqual in tests.models is evaluated in Python with operator.ne.
+        python_lookups["ne"] = operator.ne
+        self.addCleanup(python_lookups.pop, "ne")
+
     @classmethod
     def setUpTestData(cls):
         slugs = [
@@ -43,6 +83,7 @@ class RelationshipTests(TestCase):
             "Top.Science.Astronomy.Cosmology",
         ]
 
+        adjacency_cache = {}
         mptt_cache = {}
         tbmp_cache = {}
         tbns_cache = {}
@@ -71,6 +112,9 @@ class RelationshipTests(TestCase):
             )
 
             Page.objects.create(**kwargs)
+            adjacency_cache[slug] = AdjacencyPage.objects.create(
+                parent=adjacency_cache.get(slug[:-1]), **kwargs
+            )
 
         CartItem.objects.bulk_create(
             [
@@ -254,6 +298,45 @@ class RelationshipTests(TestCase):
         test_for(TBMPPage)
         test_for(TBNSPage)
 
+    def test_nested_set_prefetch_related(self):
+        MPTTPage.objects.create(name="Other", slug="Other")
+        MPTTPage.objects.create(
+            name="Child", slug="Other.Child", parent=MPTTPage.objects.get(slug="Other")
+        )
+        for page_model in [MPTTPage, TBNSPage]:
+            for name, reverse in [
+                ("descendants", "ascendants"),
+                ("subtree", "rootpath"),
+            ]:
+                with CaptureQueriesContext(connection) as queries:
+                    pages = list(page_model.objects.prefetch_related(name))
+                self.assertEqual(len(queries), 2)
+                self.assertNotIn("JOIN", queries[1]["sql"])
+
+                related = {}
+                for page in pages:
+                    objs = list(getattr(page, name).all())
+                    self.assertEqual(
+                        objs, list(page_model.objects.filter(**{reverse: page}))
+                    )
+                    for obj in objs:
+                        # Each node is shared between its ancestors.
+                        self.assertIs(related.setdefault(obj.pk, obj), obj)
+
+        top = TBNSPage.objects.get(slug="Top")
+        science = TBNSPage.objects.get(slug="Top.Science")
+        pages = TBNSPage.objects.filter(pk__in=[top.pk, science.pk])
+        pages = pages.order_by("lft").prefetch_related(
+            Prefetch("descendants", TBNSPage.objects.filter(name="Astronomy"))
+        )
+        self.assertEqual(
+            [[p.slug for p in page.descendants.all()] for page in pages],
+            [
+                ["Top.Collections.Pictures.Astronomy", "Top.Science.Astronomy"],
+                ["Top.Science.Astronomy"],
+            ],
+        )
+
     def test_m2m_recursive_prefetch_related_reverse(self):
         def test_for(page_model):
             qs = page_model.objects.filter(slug__startswith="Top.Science")
@@ -270,6 +353,132 @@ class RelationshipTests(TestCase):
         test_for(TBMPPage)
         test_for(TBNSPage)
 
+    def test_mp_range_scan(self):
+        p = TBMPPage.objects.get(slug="Top.Collections.Pictures")
+        self.assertNotIn("LIKE", str(TBMPPage.objects.filter(ascendants=p).query))
+        self.assertSeqEqual(
+            p.descendants.order_by("path"), p.prefix_descendants.order_by("path")
+        )
+        self.assertSeqEqual(
+            TBMPPage.objects.filter(ascendants=p).order_by("path"),
+            TBMPPage.objects.filter(prefix_ascendants=p).order_by("path"),
+        )
+        self.assertSeqEqual(
+            p.descendants.order_by("path"), p.get_descendants().order_by("path")
+        )
+
+    def test_mp_ancestors(self):
+        p = TBMPPage.objects.get(slug="Top.Science.Astronomy")
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertSeqEqual(
+                p.ancestors.values_list("slug", flat=True),
+                ["Top", "Top.Science"],
+            )
+            self.assertSeqEqual(
+                p.path_to_root.values_list("slug", flat=True),
+                ["Top", "Top.Science", "Top.Science.Astronomy"],
+            )
+        for query in ctx.captured_queries:
+            self.assertNotIn("JOIN", query["sql"])
+
+        self.assertSeqEqual(
+            TBMPPage.objects.filter(ancestors__slug="Top.Science").order_by("path"),
+            p.get_parent().get_descendants().order_by("path"),
+        )
+        self.assertSeqEqual(
+            TBMPPage.objects.filter(path_to_root__slug="Top.Science").order_by(
+                "path"
+            ),
+            TBMPPage.get_tree(p.get_parent()).order_by("path"),
+        )
+
+        # The predicate resolved for the joins above is relabelled with the
+        # rest of a subquery.
+        for name, slugs in [
+            ("ancestors", ["Top", "Top.Science"]),
+            ("path_to_root", ["Top", "Top.Science", "Top.Science.Astronomy"]),
+        ]:
+            self.assertSeqEqual(
+                TBMPPage.objects.filter(
+                    pk__in=TBMPPage.objects.filter(pk=p.pk).values(name)
+                ).values_list("slug", flat=True),
+                slugs,
+            )
+
+    def test_mp_ancestors_prefetch_related(self):
+        qs = TBMPPage.objects.filter(slug__startswith="Top.Science")
+        with self.assertNumQueries(3):
+            pages = qs.prefetch_related("ancestors", "path_to_root")
+            page_dict = {
+                p: (list(p.ancestors.all()), list(p.path_to_root.all()))
+                for p in pages
+            }
+        self.assertDictEqual(
+            page_dict,
+            {
+                p: (list(p.get_ancestors()), list(p.get_ancestors()) + [p])
+                for p in qs
+            },
+        )
+
+    def test_batched_prefetch_related(self):
+        def test_for(qs, name):
+            expected = {obj: set(getattr(obj, name).all()) for obj in qs}
+            with mock.patch.object(connection.features, "max_query_params", 6):
+                with CaptureQueriesContext(connection) as ctx:
+                    objs = qs.prefetch_related(name)
+                    result = {obj: set(getattr(obj, name).all()) for obj in objs}
+            self.assertGreater(len(ctx.captured_queries), 2)
+            self.assertDictEqual(result, expected)
+
+        test_for(Page.objects.all(), "descendants")
+        test_for(Product.objects.all(), "lookalikes")
+        test_for(TBMPPage.objects.all(), "ancestors")
+
+    def test_prefetch_pairs(self):
+        for colour, size in [("red", 1), ("red", 2), ("blue", 1), ("green", 1)]:
+            ProductFilter.objects.create(fcolour=colour, fsize=size)
+        user = User.objects.create(username="u")
+        SavedFilter.objects.create(user=user, search_regex="a")
+        SavedFilter.objects.create(user=user, search_regex="Cl")
+        Chemical.objects.create(formula="NaCl", chemical_name="sodium chloride")
+
+        def test_for(qs, name, lookup=None):
+            expected = {obj: set(getattr(obj, name).all()) for obj in qs}
+            for max_query_params in [None, 6]:
+                with mock.patch.object(
+                    connection.features, "max_query_params", max_query_params
+                ):
+                    with CaptureQueriesContext(connection) as ctx:
+                        objs = list(qs.prefetch_related(lookup or name))
+                if max_query_params is None:
+                    # The objects, the pairs of pks and the related objects.
+                    self.assertEqual(len(ctx.captured_queries), 3)
+                shared = {}
+                for obj in objs:
+                    related = list(getattr(obj, name).all())
+                    self.assertEqual(set(related), expected[obj])
+                    for related_obj in related:
+                        self.assertIs(
+                            shared.setdefault(related_obj.pk, related_obj), related_obj
+                        )
+            # Some related objects are shared by several objects.
+            self.assertLess(len(shared), sum(map(len, expected.values())))
+
+        # By default, each object gets its own copies in a single query.
+        with self.assertNumQueries(2):
+            filters = list(ProductFilter.objects.prefetch_related("products"))
+        products = [p for f in filters for p in f.products.all()]
+        self.assertEqual(len({id(p) for p in products}), len(products))
+
+        test_for(ProductFilter.objects.all(), "paired_products")
+        test_for(Product.objects.all(), "paired_filters")
+        test_for(
+            SavedFilter.objects.all(),
+            "chemicals",
+            Prefetch("chemicals", Chemical.objects.prefetch_strategy("pairs")),
+        )
+
     def test_m2o_accessor_forward(self):
         self.assertEqual(CartItem.objects.get(pk=1).product, Product.objects.get(pk=1))
 
@@ -302,6 +511,42 @@ class RelationshipTests(TestCase):
                 for cart_item in product.cart_items.all():
                     self.assertEqual(cart_item.product, product)
 
+    def test_equality_prefetch_related(self):
+        def test_for(name):
+            qs = Product.objects.filter(size__lte=3).order_by("pk")
+            with CaptureQueriesContext(connection) as ctx:
+                products = list(qs.prefetch_related(name))
+                product_dict = {p: set(getattr(p, name).all()) for p in products}
+            self.assertEqual(len(ctx.captured_queries), 2)
+            self.assertNotIn("JOIN", ctx.captured_queries[1]["sql"])
+            self.assertDictEqual(
+                product_dict,
+                {p: set(getattr(p, name).all()) for p in qs},
+            )
+
+        test_for("lookalikes")
+        test_for("lookalike_of")
+
+    def test_equality_prefetch_related_pairs(self):
+        # Each pair of values is matched on its own, rather than each field
+        # against all of the values, which would also select the pair (1, 2).
+        first = PairHolder.objects.create(x=1, y=1)
+        second = PairHolder.objects.create(x=2, y=2)
+        Pair.objects.create(a=1, b=2)
+        one, two = Pair.objects.create(a=1, b=1), Pair.objects.create(a=2, b=2)
+
+        holders = PairHolder.objects.order_by("pk").prefetch_related("pairs")
+        self.assertEqual([list(h.pairs.all()) for h in holders], [[one], [two]])
+        self.assertEqual([h.pairs.get().holder for h in holders], [first, second])
+        pairs = Pair.objects.order_by("pk").prefetch_related("holders")
+        self.assertEqual(
+            [[h.pair for h in p.holders.all()] for p in pairs], [[], [one], [two]]
+        )
+        self.assertEqual(
+            PairHolder._meta.get_field("pairs").resolve_many(holders, pks=True),
+            {first.pk: [one.pk], second.pk: [two.pk]},
+        )
+
     def test_m2o_reverse_select_related(self):
         with self.assertNumQueries(1):
             for cart_item in CartItem.objects.select_related("product").all():
@@ -373,10 +618,50 @@ class RelationshipTests(TestCase):
         with self.assertRaises(Product.DoesNotExist):
             item.product
 
+    def test_select_related(self):
+        node_1 = LinkedNode.objects.create(name="first node")
+        node_2 = LinkedNode.objects.create(name="last node", prev_id=node_1.id)
+        with self.assertNumQueries(1):
+            nodes = list(LinkedNode.objects.select_related("next", "prev"))
+            for node in nodes:
+                self.assertEqual(node.next, node_2 if node == node_1 else None)
+                self.assertEqual(node.prev, node_1 if node == node_2 else None)
+                # The selected objects are kept, like a foreign key's.
+                node.next, node.prev
+
+        CartItem.objects.create(pk=4, product_code="nonexistent")
+        with self.assertNumQueries(1):
+            items = {i.pk: i for i in CartItem.objects.select_related("product")}
+        self.assertEqual(len(items), CartItem.objects.count())
+        with self.assertNumQueries(0):
+            for pk, item in items.items():
+                if pk == 4:
+                    with self.assertRaises(Product.DoesNotExist):
+                        item.product
+                else:
+                    self.assertEqual(item.product.sku, item.product_code)
+        self.assertEqual(
+            CartItem.objects.select_related("product").get(pk=4).product_code,
+            "nonexistent",
+        )
+
+    def test_select_related_invalidated(self):
+        for name in ("product", "cached_product"):
+            item = CartItem.objects.select_related(name).get(pk=1)
+            self.assertEqual(getattr(item, name).sku, "11")
+            item.product_code = "22"
+            with self.assertNumQueries(1):
+                self.assertEqual(getattr(item, name).sku, "22")
+
     def test_complex_expression(self):
         ug = UserGenerator.objects.create()
         self.assertEqual(ug.user, User.objects.get(username="generated_for_%d" % ug.id))
 
+    def test_complex_expression_multiple_instances(self):
+        generators = [UserGenerator.objects.create() for _ in range(3)]
+        for ug in generators:
+            self.assertEqual(ug.user.username, "generated_for_%d" % ug.id)
+
     def test_descriptor_not_cached(self):
         item = CartItem.objects.first()
         self.assertIsNotNone(item.product)
@@ -385,6 +670,35 @@ class RelationshipTests(TestCase):
         with self.assertRaises(Product.DoesNotExist):
             item.product
 
+    def test_descriptor_cached(self):
+        item = CartItem.objects.get(pk=1)
+        red_circle, blue_triangle = Product.objects.filter(pk__in=[1, 2])
+        with self.assertNumQueries(1):
+            self.assertEqual(item.cached_product, red_circle)
+            self.assertEqual(item.cached_product, red_circle)
+
+        item.product_code = "22"
+        with self.assertNumQueries(1):
+            self.assertEqual(item.cached_product, blue_triangle)
+
+        # refresh_from_db() drops it, like a foreign key's related object.
+        item.product_code = "11"
+        self.assertEqual(item.cached_product.size, 4)
+        Product.objects.filter(pk=1).update(size=9)
+        item.refresh_from_db()
+        with self.assertNumQueries(1):
+            self.assertEqual(item.cached_product.size, 9)
+        item = CartItem.objects.select_related("product").get(pk=1)
+        Product.objects.filter(pk=1).update(size=4)
+        item.refresh_from_db()
+        with self.assertNumQueries(1):
+            self.assertEqual(item.product.size, 4)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                CartItem._meta.get_field("cached_product")._cache_key_attnames(True),
+                ["product_code"],
+            )
+
     def test_primitive_in_predicate(self):
         product = Product.objects.filter(deleted=True).first()
         item = CartItem.objects.create(
@@ -394,3 +708,1049 @@ class RelationshipTests(TestCase):
         )
         with self.assertRaises(Product.DoesNotExist):
             item.product
+
+    def test_restriction_cache(self):
+        field = Page._meta.get_field("subtree")
+        field._restriction_cache.clear()
+
+        qs = Page.objects.filter(subtree__subtree__slug__contains="Stars")
+        sql = str(qs.query)
+        self.assertTrue(field._restriction_cache)
+        self.assertEqual(str(qs.query), sql)
+        self.assertSeqEqual(
+            qs.values_list("slug", flat=True).distinct().order_by("slug"),
+            [
+                "Top",
+                "Top.Collections",
+                "Top.Collections.Pictures",
+                "Top.Collections.Pictures.Astronomy",
+                "Top.Collections.Pictures.Astronomy.Stars",
+            ],
+        )
+
+    def test_exists_filter_strategy(self):
+        alex, anne, bob = User.objects.bulk_create(
+            User(username=username) for username in ["alex", "anne", "bob"]
+        )
+        SavedFilter.objects.bulk_create(
+            [
+                SavedFilter(user=alex, search_regex="Cl"),
+                SavedFilter(user=alex, search_regex="O"),
+                SavedFilter(user=anne, search_regex="Si"),
+            ]
+        )
+        for formula in ["NaHCO3", "CF2Cl2", "C2H5OH", "SiO2", "NaCl"]:
+            Chemical.objects.create(formula=formula, chemical_name=formula)
+        salt = Chemical.objects.get(formula="NaCl")
+
+        qs = User.objects.filter(savedfilter__exists_chemicals__formula__contains="O")
+        self.assertNotIn("JOIN", str(qs.query))
+        self.assertSeqEqual(qs, [alex, anne])
+        self.assertSeqEqual(
+            User.objects.filter(savedfilter__exists_chemicals=salt), [alex]
+        )
+        self.assertSeqEqual(
+            User.objects.exclude(savedfilter__exists_chemicals=salt).order_by("pk"),
+            [anne, bob],
+        )
+        self.assertSeqEqual(
+            SavedFilter.objects.filter(exists_chemicals__isnull=False)
+            .values_list("search_regex", flat=True)
+            .order_by("pk"),
+            ["Cl", "O", "Si"],
+        )
+        self.assertSeqEqual(
+            Chemical.objects.filter(exists_filters__user=anne),
+            [Chemical.objects.get(formula="SiO2")],
+        )
+
+        # The same relationship with the default strategy joins, and repeats
+        # each user once for every match.
+        qs = User.objects.filter(savedfilter__chemicals__formula__contains="O")
+        self.assertIn("JOIN", str(qs.query))
+        self.assertSeqEqual(qs.order_by("pk"), [alex, alex, alex, anne])
+        self.assertSeqEqual(
+            Chemical.objects.filter(savedfilter__user=anne),
+            [Chemical.objects.get(formula="SiO2")],
+        )
+
+    def test_exists_filter_strategy_queryset(self):
+        qs = RelationshipQuerySet(Category).filter_strategy("exists")
+        self.assertNotIn("JOIN", str(qs.filter(members__pk__in=[4, 6]).query))
+        self.assertSeqEqual(
+            qs.filter(members__pk__in=[4, 6]).order_by("pk"),
+            Category.objects.filter(pk__in=[2, 3]).order_by("pk"),
+        )
+        self.assertSeqEqual(
+            qs.exclude(members__pk__in=[4, 6]).order_by("pk"),
+            Category.objects.exclude(pk__in=[2, 3]).order_by("pk"),
+        )
+
+    def test_exists_filter_strategy_prefetch(self):
+        # The prefetch reads each local pk from the join, whatever the strategy.
+        user = User.objects.create(username="alex")
+        SavedFilter.objects.create(user=user, search_regex="Cl")
+        SavedFilter.objects.create(user=user, search_regex="O")
+        for formula in ["NaCl", "H2O", "SiO2"]:
+            Chemical.objects.create(formula=formula, chemical_name=formula)
+        chemicals = Chemical.objects.filter_strategy("exists").order_by("pk")
+        filters = SavedFilter.objects.order_by("pk").prefetch_related(
+            Prefetch("chemicals", queryset=chemicals)
+        )
+        self.assertEqual(
+            [[c.formula for c in f.chemicals.all()] for f in filters],
+            [["NaCl"], ["H2O", "SiO2"]],
+        )
+        filters = SavedFilter.objects.filter_strategy("exists").order_by("pk")
+        chemicals = Chemical.objects.order_by("pk").prefetch_related(
+            Prefetch("savedfilter_set", queryset=filters)
+        )
+        self.assertEqual(
+            [[f.search_regex for f in c.savedfilter_set.all()] for c in chemicals],
+            [["Cl"], ["O"], ["O"]],
+        )
+
+    def test_relationship_count(self):
+        qs = Page.objects.annotate(n=RelationshipCount("descendants"))
+        sql = str(qs.query)
+        self.assertNotIn("JOIN", sql)
+        self.assertNotIn("GROUP BY", sql)
+        for page in qs:
+            self.assertEqual(page.n, page.descendants.count())
+
+        qs = Page.objects.annotate(
+            n=RelationshipCount("descendants", filter=Q(name="Astronomy"))
+        )
+        self.assertEqual(qs.get(slug="Top").n, 2)
+        self.assertEqual(qs.get(slug="Top.Hobbies").n, 0)
+
+        qs = Page.objects.annotate(RelationshipCount("ascendants"))
+        self.assertEqual(qs.get(slug="Top.Science").ascendants__count, 1)
+
+    def test_relationship_count_django_relations(self):
+        # Correlated on the foreign key's to_field, and through the through
+        # model of a many-to-many field whose reverse relation is hidden.
+        first = Supplier.objects.create(code="A")
+        first.products.set(Product.objects.filter(pk__in=[1, 2]))
+        Supplier.objects.create(code="B")
+        Delivery.objects.bulk_create(
+            [Delivery(supplier=first), Delivery(supplier=first)]
+        )
+        qs = Supplier.objects.annotate(
+            RelationshipCount("deliveries"),
+            RelationshipCount("products"),
+            deliveries_exist=RelationshipExists("deliveries"),
+        ).order_by("pk")
+        self.assertEqual(
+            [(s.deliveries__count, s.products__count, s.deliveries_exist) for s in qs],
+            [(2, 2, True), (0, 0, False)],
+        )
+
+    @isolate_apps("tests")
+    def test_correlated_queryset_hidden_relation(self):
+        class Owner(models.Model):
+            code = models.CharField(max_length=10, unique=True)
+
+        class Owned(models.Model):
+            owner_code = models.CharField(max_length=10)
+            owner = models.ForeignObject(
+                Owner,
+                on_delete=models.CASCADE,
+                from_fields=["owner_code"],
+                to_fields=["code"],
+                related_name="+",
+            )
+            owners = Relationship(
+                Owner, Q(code=L("owner_code")), materialize=True, related_name="+"
+            )
+
+        # The forward hop compares the fields of the join.
+        qs = Owned.objects.annotate(RelationshipCount("owner"))
+        self.assertRegex(str(qs.query), r'U0\."code" = \(?"tests_owned"\."owner_code"')
+        with self.assertRaisesMessage(
+            ValueError, "tests.Owned.owners can't be followed"
+        ):
+            correlated_queryset(Owned._meta.get_field("owners"))
+
+    def test_relationship_count_combined(self):
+        qs = Page.objects.annotate(
+            RelationshipCount("descendants"), RelationshipCount("ascendants")
+        )
+        page = qs.get(slug="Top.Collections")
+        self.assertEqual(page.descendants__count, 5)
+        self.assertEqual(page.ascendants__count, 1)
+
+    def test_relationship_aggregate(self):
+        qs = Product.objects.annotate(
+            total=RelationshipAggregate("lookalikes", Sum("size"))
+        )
+        self.assertNotIn("GROUP BY", str(qs.query))
+        for product in qs:
+            self.assertEqual(
+                product.total, sum(p.size for p in product.lookalikes.all())
+            )
+
+    def test_relationship_exists(self):
+        qs = Page.objects.annotate(RelationshipExists("descendants"))
+        self.assertNotIn("JOIN", str(qs.query))
+        self.assertSeqEqual(
+            qs.filter(descendants__exists=False).values_list("slug", flat=True),
+            Page.objects.filter(descendants__isnull=True)
+            .values_list("slug", flat=True)
+            .order_by("pk"),
+        )
+
+    def test_mptt_translation_cached(self):
+        field = MPTTPage._meta.get_field("descendants")
+        page = MPTTPage.objects.get(slug="Top.Science")
+        expected = list(MPTTPage.objects.filter(ascendants=page))
+        field._restriction_cache.clear()
+        with mock.patch.object(
+            type(MPTTPage._tree_manager), "_translate_lookups"
+        ) as translate_lookups:
+            self.assertEqual(list(MPTTPage.objects.filter(ascendants=page)), expected)
+            self.assertEqual(list(page.descendants.all()), expected)
+            self.assertTrue(field.match(page, expected[0]))
+        translate_lookups.assert_not_called()
+
+    def test_pairs(self):
+        expected = [
+            (category.pk, member.pk)
+            for category in Category.objects.all()
+            for member in category.members.all()
+        ]
+        with self.assertNumQueries(1):
+            pairs = list(Category.members.pairs(chunk_size=2))
+        self.assertEqual(sorted(pairs), sorted(expected))
+        self.assertSeqEqual(
+            sorted(Categorised.categories.pairs()),
+            sorted((member, category) for category, member in expected),
+        )
+        self.assertSeqEqual(
+            sorted(Category.members.pairs(Category.objects.filter(code="AAA"))),
+            sorted(pair for pair in expected if pair[0] == 1),
+        )
+        field = CartItem._meta.get_field("product")
+        self.assertSeqEqual(
+            sorted(field.pairs()),
+            sorted(
+                (item.pk, item.product.pk)
+                for item in CartItem.objects.all()
+                if Product.objects.filter(cart_items=item).exists()
+            ),
+        )
+
+    def test_resolve_many(self):
+        ProductFilter.objects.create(fcolour="red", fsize=1)
+        ProductFilter.objects.create(fcolour="blue", fsize=2)
+        fields = [
+            (Page, "descendants", 4),
+            (MPTTPage, "subtree", 4),
+            (TBNSPage, "descendants", 4),
+            (AdjacencyPage, "descendants", 4),
+            (Category, "members", 2),
+            (Product, "lookalikes", 2),
+            (ProductFilter, "products", 2),
+            (ProductFilter, "paired_products", 2),
+            (CartItem, "product", 2),
+            (SavedFilter, "materialized_chemicals", 2),
+        ]
+        for model, name, chunk_size in fields:
+            field = model._meta.get_field(name)
+            instances = model.objects.order_by("pk")
+            expected = OrderedDict()
+            for obj in instances:
+                related = field.related_model.objects.filter(
+                    pk__in=model.objects.filter(pk=obj.pk).values(name)
+                )
+                expected[obj.pk] = sorted(related, key=lambda o: o.pk)
+            if not field.multiple:
+                expected = {k: v[0] if v else None for k, v in expected.items()}
+
+            for queryset in [instances, list(instances)]:
+                result = field.resolve_many(queryset, chunk_size=chunk_size)
+                self.assertEqual(list(result), list(expected))
+                if field.multiple:
+                    result = {
+                        k: sorted(v, key=lambda o: o.pk) for k, v in result.items()
+                    }
+                self.assertEqual(result, expected)
+
+            result = field.resolve_many(instances, chunk_size=chunk_size, pks=True)
+            if field.multiple:
+                result = {k: sorted(v) for k, v in result.items()}
+                expected = {k: [o.pk for o in v] for k, v in expected.items()}
+            else:
+                expected = {k: v and v.pk for k, v in expected.items()}
+            self.assertEqual(result, expected)
+
+        # Prefetched with the equality of the product code and SKU.
+        with self.assertNumQueries(2):
+            CartItem._meta.get_field("product").resolve_many(CartItem.objects.all())
+        # pks are found in the same way, reading only the compared fields.
+        field = CartItem._meta.get_field("product")
+        with CaptureQueriesContext(connection) as queries:
+            field.resolve_many(CartItem.objects.all(), pks=True)
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn(" JOIN ", queries[1]["sql"])
+        self.assertNotIn('"colour"', queries[1]["sql"])
+        with self.assertNumQueries(2):
+            field = TBNSPage._meta.get_field("descendants")
+            field.resolve_many(TBNSPage.objects.all(), pks=True)
+        # With prefetch_strategy="pairs", the pairs are selected first.
+        field = ProductFilter._meta.get_field("paired_products")
+        with self.assertNumQueries(3):
+            field.resolve_many(ProductFilter.objects.all(), pks=True)
+
+    def test_nested_set_count(self):
+        for model in [MPTTPage, TBNSPage]:
+            for name in ["descendants", "subtree"]:
+                qs = model.objects.annotate(
+                    n=RelationshipCount(name),
+                    expected=RelationshipAggregate(name, Count("pk")),
+                )
+                sql = str(model.objects.annotate(RelationshipCount(name)).query)
+                self.assertEqual(sql.count("SELECT"), 1)
+                for page in qs:
+                    self.assertEqual(page.n, page.expected)
+                    with self.assertNumQueries(0):
+                        self.assertEqual(getattr(page, name).count(), page.n)
+
+        # The count is divided as an integer on every database.
+        query = TBNSPage.objects.all().query
+        count = nested_set_count("lft", "rgt").resolve_expression(query)
+        compiler = query.get_compiler(connection=connection)
+        sql, params = count.as_mysql(compiler, connection)
+        self.assertIn(" DIV ", sql)
+        sql, params = count.as_oracle(compiler, connection)
+        self.assertTrue(sql.startswith("TRUNC("))
+
+    def test_resolve_in_memory(self):
+        ProductFilter.objects.create(fcolour="red", fsize=3)
+        ProductFilter.objects.create(fcolour="blue", fsize=1)
+        fields = [
+            (Page, "descendants"),
+            (Page, "subtree"),
+            (MPTTPage, "descendants"),
+            (MPTTPage, "subtree"),
+            (TBMPPage, "descendants"),
+            (TBMPPage, "prefix_descendants"),
+            (TBMPPage, "ancestors"),
+            (TBNSPage, "descendants"),
+            (TBNSPage, "subtree"),
+            (Category, "members"),
+            (Product, "lookalikes"),
+            (ProductFilter, "products"),
+            (CartItem, "product"),
+        ]
+        for model, name in fields:
+            field = model._meta.get_field(name)
+            locals = list(model.objects.all())
+            candidates = list(field.related_model.objects.all())
+            expected = {
+                obj.pk: set(
+                    field.related_model.objects.filter(
+                        pk__in=list(
+                            model.objects.filter(pk=obj.pk).values_list(name, flat=True)
+                        )
+                    )
+                )
+                for obj in locals
+            }
+            with self.assertNumQueries(0):
+                resolved = field.resolve_in_memory(locals, candidates)
+                for obj in locals:
+                    for candidate in candidates:
+                        self.assertEqual(
+                            field.match(obj, candidate),
+                            candidate in expected[obj.pk],
+                            (name, obj, candidate),
+                        )
+            self.assertEqual(
+                {pk: set(related) for pk, related in resolved.items()}, expected
+            )
+
+    def test_match_lookups(self):
+        field = SavedFilter._meta.get_field("chemicals")
+        saved_filter = SavedFilter(search_regex="^Na")
+        self.assertTrue(field.match(saved_filter, Chemical(formula="NaCl")))
+        self.assertFalse(field.match(saved_filter, Chemical(formula="CNa")))
+
+        field = Relationship(
+            Product,
+            Q(size__in=[1, 2], colour__startswith=L("colour"))
+            | ~Q(shape__contains="ang"),
+        )
+        item = Product(colour="gr")
+        self.assertTrue(field.match(item, Product(size=1, colour="green")))
+        self.assertFalse(
+            field.match(item, Product(size=3, colour="green", shape="triangle"))
+        )
+        self.assertTrue(field.match(item, Product(size=3, shape="square")))
+        self.assertFalse(field.match(item, Product(size=3, shape="triangle")))
+
+    def test_materialized(self):
+        alex = User.objects.create(username="alex")
+        cl = SavedFilter.objects.create(user=alex, search_regex="Cl")
+        oh = SavedFilter.objects.create(user=alex, search_regex="OH")
+        for formula in ["NaHCO3", "CF2Cl2", "C2H5OH", "NaCl"]:
+            Chemical.objects.create(formula=formula, chemical_name=formula)
+        salt = Chemical.objects.get(formula="NaCl")
+        ethanol = Chemical.objects.get(formula="C2H5OH")
+
+        through = SavedFilter._meta.get_field("materialized_chemicals").through
+        qs = SavedFilter.objects.filter(materialized_chemicals=salt)
+        self.assertIn(through._meta.db_table, str(qs.query))
+        self.assertNotIn("REGEXP", str(qs.query))
+        self.assertSeqEqual(qs, [cl])
+        self.assertSeqEqual(
+            cl.materialized_chemicals.order_by("pk").values_list("formula", flat=True),
+            ["CF2Cl2", "NaCl"],
+        )
+        self.assertSeqEqual(salt.materialized_filters.all(), [cl])
+
+        oh.search_regex = "Na"
+        oh.save(update_fields=["search_regex"])
+        self.assertSeqEqual(salt.materialized_filters.order_by("pk"), [cl, oh])
+        salt.formula = "KCl"
+        salt.save()
+        self.assertSeqEqual(salt.materialized_filters.all(), [cl])
+        ethanol.delete()
+        self.assertEqual(through.objects.count(), 3)
+
+        with self.assertNumQueries(2):
+            filters = list(
+                SavedFilter.objects.order_by("pk").prefetch_related(
+                    "materialized_chemicals"
+                )
+            )
+        self.assertSeqEqual(
+            [{c.formula for c in f.materialized_chemicals.all()} for f in filters],
+            [{"CF2Cl2", "KCl"}, {"NaHCO3"}],
+        )
+
+    def test_materialized_multi_hop(self):
+        mauve = ProductFilter.objects.create(fcolour="mauve", fsize=0)
+        teal = ProductFilter.objects.create(fcolour="teal", fsize=0)
+        ball = Product.objects.create(sku="ball", colour="mauve", shape="round", size=1)
+        item = CartItem.objects.create(product_code="ball", description="")
+        self.assertSeqEqual(item.materialized_filters.all(), [mauve])
+
+        # Saving the product re-evaluates the cart items it's related to.
+        ball.colour = "teal"
+        ball.save(update_fields=["colour"])
+        self.assertSeqEqual(item.materialized_filters.all(), [teal])
+        self.assertSeqEqual(teal.materialized_cartitems.all(), [item])
+        self.assertSeqEqual(mauve.materialized_cartitems.all(), [])
+
+    def test_rebuild_relationships(self):
+        alex = User.objects.create(username="alex")
+        SavedFilter.objects.create(user=alex, search_regex="Cl")
+        Chemical.objects.create(formula="NaCl", chemical_name="salt")
+        through = SavedFilter._meta.get_field("materialized_chemicals").through
+        other = Category._meta.get_field("materialized_members").through
+        through.objects.all().delete()
+        other.objects.all().delete()
+        stdout = io.StringIO()
+        call_command("rebuild_relationships", "tests.savedfilter", stdout=stdout)
+        self.assertEqual(through.objects.count(), 1)
+        self.assertIn("1 pairs", stdout.getvalue())
+        # Only the relationships matching the labels are rebuilt.
+        self.assertEqual(other.objects.count(), 0)
+        self.assertNotIn("Category", stdout.getvalue())
+
+        call_command(
+            "rebuild_relationships",
+            "tests.category.materialized_members",
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(
+            other.objects.count(),
+            Category.objects.filter(members__isnull=False).count(),
+        )
+        with self.assertRaises(CommandError):
+            call_command("rebuild_relationships", "tests.product")
+
+    def test_check_relationship_indexes(self):
+        field = Product._meta.get_field("lookalikes")
+        checks = {(c.column, c.direction): c for c in check_indexes(field)}
+        self.assertEqual(len(checks), 4)
+        colour = checks["colour", "forward"]
+        self.assertEqual((colour.lookup, colour.status), ("exact", "missing"))
+        self.assertEqual(colour.index.fields, ["colour"])
+        self.assertEqual(colour.operation.model_name, "product")
+
+        # The composite index MPTT adds on tree_id and lft is usable when
+        # tree_id is compared for equality.
+        field = MPTTPage._meta.get_field("descendants")
+        statuses = {(c.column, c.direction): c.status for c in check_indexes(field)}
+        self.assertEqual(statuses["lft", "forward"], "ok")
+        self.assertEqual(statuses["rght", "reverse"], "missing")
+
+        field = Category._meta.get_field("members")
+        [contains, reverse] = check_indexes(field)
+        self.assertEqual(contains.status, "unusable")
+        self.assertEqual(reverse.reason, "the local column is compared with contains")
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            [contains, reverse] = check_indexes(field)
+            [startswith, _] = check_indexes(Page._meta.get_field("subtree"))
+        self.assertEqual(contains.status, "missing")
+        self.assertEqual(contains.index.opclasses, ["gin_trgm_ops"])
+        self.assertEqual(reverse.status, "unusable")
+        # A pattern_ops index is created for unique text columns.
+        self.assertEqual(startswith.status, "ok")
+
+        with self.assertRaises(ValueError):
+            check_indexes(TBMPPage._meta.get_field("ancestors"))
+
+        stdout = io.StringIO()
+        call_command(
+            "check_relationship_indexes",
+            "tests.product",
+            operations=True,
+            stdout=stdout,
+        )
+        output = stdout.getvalue()
+        self.assertIn(
+            "tests.Product.lookalikes: tests.Product.colour exact (forward): "
+            "needs a B-tree index",
+            output,
+        )
+        self.assertEqual(output.count("migrations.AddIndex("), 2)
+
+    @isolate_apps("tests")
+    def test_check_relationship_indexes_upper_trigram(self):
+        from django.contrib.postgres import indexes
+
+        class Search(models.Model):
+            term = models.CharField(max_length=20)
+            products = Relationship(Product, Q(colour__icontains=L("term")))
+
+        field = Search._meta.get_field("products")
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            [icontains, _] = check_indexes(field)
+            # Without OpClass, the index can only be described.
+            without_opclass = types.SimpleNamespace(GinIndex=indexes.GinIndex)
+            with mock.patch.dict(
+                sys.modules, {"django.contrib.postgres.indexes": without_opclass}
+            ):
+                [described, _] = check_indexes(field)
+        self.assertEqual(icontains.status, "missing")
+        self.assertEqual(icontains.reason, "needs a trigram index on UPPER()")
+        self.assertIsInstance(icontains.index.expressions[0], indexes.OpClass)
+        self.assertEqual(icontains.operation.model_name, "product")
+        self.assertEqual(described.status, "missing")
+        self.assertEqual(described.reason, "needs a trigram index on UPPER()")
+        self.assertIsNone(described.index)
+        self.assertIsNone(described.operation)
+
+    def test_check_relationship_indexes_expressions(self):
+        from django.contrib.postgres.indexes import GinIndex, OpClass
+        from django.db.models.functions import Lower, Upper
+
+        field = Product._meta.get_field("colour")
+
+        def has_index(kind, *expressions, **kwargs):
+            index = GinIndex(*expressions, name="expression_index", **kwargs)
+            with mock.patch.object(Product._meta, "indexes", [index]):
+                return _has_index(Product, field, kind)
+
+        self.assertTrue(has_index("upper", Upper("colour")))
+        self.assertTrue(has_index("upper", Upper("colour").desc()))
+        self.assertFalse(has_index("upper", Upper("colour_name")))
+        self.assertFalse(has_index("upper", Lower("colour")))
+        self.assertFalse(has_index("upper", Upper("shape")))
+        self.assertFalse(has_index("upper_trigram", Upper("colour")))
+        trigram = OpClass(Upper("colour"), name="gin_trgm_ops")
+        self.assertTrue(has_index("upper_trigram", trigram))
+        self.assertFalse(
+            has_index("upper_trigram", OpClass(Upper("shape"), name="gin_trgm_ops"))
+        )
+        self.assertTrue(has_index("trigram", OpClass("colour", name="gin_trgm_ops")))
+        self.assertTrue(
+            has_index("trigram", fields=["colour"], opclasses=["gin_trgm_ops"])
+        )
+        self.assertFalse(has_index("trigram", OpClass("colour", name="jsonb_ops")))
+
+    @skipIf(django.VERSION < (4, 1), "Async querysets need Django 4.1")
+    async def test_async(self):
+        page = await Page.objects.aget(slug="Top.Collections")
+        self.assertEqual(await page.descendants.acount(), 5)
+        slugs = [p.slug async for p in page.descendants.order_by("slug")]
+        self.assertEqual(slugs[0], "Top.Collections.Pictures")
+        self.assertEqual(len(slugs), 5)
+
+        # These don't need to leave the event loop.
+        no_thread = mock.patch("relativity.fields.sync_to_async", None)
+        node = await TBNSPage.objects.aget(slug="Top.Collections")
+        with no_thread:
+            self.assertEqual(await node.descendants.acount(), 5)
+
+        item = await CartItem.objects.aget(pk=1)
+        self.assertEqual((await item.aproduct()).sku, "11")
+        self.assertEqual((await item.acached_product()).sku, "11")
+        with no_thread:
+            self.assertEqual((await item.acached_product()).sku, "11")
+        item = await CartItem.objects.select_related("product").aget(pk=1)
+        item.product_code = "22"
+        self.assertEqual((await item.aproduct()).sku, "22")
+
+        generator = await UserGenerator.objects.acreate()
+        user = await generator.auser()
+        self.assertEqual(user.username, "generated_for_%d" % generator.pk)
+        self.assertEqual((await user.ausergenerator()).pk, generator.pk)
+
+    @isolate_apps("tests")
+    def test_async_accessor_clash(self):
+        with self.assertRaisesMessage(ValueError, "Clash.anext already exists"):
+
+            class Clash(models.Model):
+                anext = models.IntegerField()
+                next = Relationship(
+                    "self", Q(pk=L("anext")), multiple=False, related_name="+"
+                )
+
+    @skipIf(django.VERSION < (4, 1), "Async querysets need Django 4.1")
+    async def test_aprefetch_related_objects(self):
+        pages = [p async for p in Page.objects.filter(slug__startswith="Top.S")]
+        await aprefetch_related_objects(pages, "descendants")
+        # Querying here would raise SynchronousOnlyOperation.
+        self.assertEqual(
+            {p.slug: len(p.descendants.all()) for p in pages},
+            {
+                "Top.Science": 3,
+                "Top.Science.Astronomy": 2,
+                "Top.Science.Astronomy.Astrophysics": 0,
+                "Top.Science.Astronomy.Cosmology": 0,
+            },
+        )
+
+    def test_multi_hop_predicate(self):
+        red = ProductFilter.objects.create(fcolour="red", fsize=1)
+        big_blue = ProductFilter.objects.create(fcolour="blue", fsize=3)
+        items = CartItem.objects.filter(pk__in=[1, 3])
+        self.assertSeqEqual(red.cartitems.order_by("pk"), items)
+        self.assertSeqEqual(big_blue.cartitems.all(), [])
+        self.assertSeqEqual(
+            ProductFilter.objects.filter(cartitems__description__contains="red")
+            .distinct()
+            .order_by("pk"),
+            [red],
+        )
+        self.assertSeqEqual(CartItem.objects.filter(filters=red).order_by("pk"), items)
+        filters = ProductFilter.objects.order_by("pk").prefetch_related("cartitems")
+        self.assertSeqEqual([len(f.cartitems.all()) for f in filters], [2, 0])
+
+    def test_multi_hop_predicate_subquery(self):
+        # The predicate's join to Product can't be added while the join to
+        # CartItem is compiled, so it's tested in an EXISTS subquery, which
+        # keeps working when the whole query is nested in another.
+        red = ProductFilter.objects.create(fcolour="red", fsize=1)
+        big_blue = ProductFilter.objects.create(fcolour="blue", fsize=2)
+        qs = ProductFilter.objects.filter(cartitems__description="blue triangle")
+        self.assertIn("EXISTS", str(qs.query))
+        self.assertSeqEqual(qs, [big_blue])
+        self.assertSeqEqual(
+            ProductFilter.objects.filter(
+                pk__in=CartItem.objects.filter(pk=2).values("filters")
+            ),
+            [big_blue],
+        )
+        self.assertSeqEqual(
+            CartItem.objects.filter(
+                filters__in=ProductFilter.objects.filter(cartitems__pk=1)
+            ).order_by("pk"),
+            CartItem.objects.filter(pk__in=[1, 3]).order_by("pk"),
+        )
+        self.assertSeqEqual(
+            RelationshipQuerySet(ProductFilter)
+            .filter_strategy("exists")
+            .exclude(cartitems__description="red circle"),
+            [big_blue],
+        )
+
+    def test_instance_filter(self):
+        red_circle = Product.objects.get(pk=1)
+        node = TBMPPage.objects.get(slug="Top.Collections")
+        salt = Chemical.objects.create(formula="NaCl", chemical_name="salt")
+        saved_filter = SavedFilter.objects.create(
+            user=User.objects.create(username="alex"), search_regex="^Na"
+        )
+        with CaptureQueriesContext(connection) as queries:
+            similar = set(red_circle.similar.all())
+            similar_to = set(red_circle.similar_to.all())
+            prefix_descendants = set(node.prefix_descendants.all())
+            prefix_ascendants = set(node.prefix_ascendants.all())
+            # RelationshipQuerySet binds filters against a single instance.
+            chemicals = list(Chemical.objects.filter(savedfilter=saved_filter))
+            saved_filters = list(SavedFilter.objects.filter(chemicals=salt))
+        joins = ["JOIN" in query["sql"] for query in queries]
+        if django.VERSION >= (4, 0):
+            self.assertEqual(joins, [False] * 6)
+        else:
+            # Lookups can't be passed to filter() before Django 4.0, so the
+            # filters made from the related side still join back.
+            self.assertEqual(joins, [False, True, False, True, False, True])
+
+        expected = set(Product.objects.filter(Q(colour="red") | Q(shape="circle")))
+        self.assertEqual(similar, expected)
+        self.assertEqual(similar_to, expected)
+        self.assertEqual(prefix_descendants, set(node.descendants.all()))
+        self.assertEqual(prefix_ascendants, set(node.ancestors.all()))
+        self.assertEqual((chemicals, saved_filters), ([salt], [saved_filter]))
+
+        # A filter that isn't a plain AND is given to filter() as a subquery.
+        rel = Product._meta.get_field("similar").remote_field
+        filters = rel.get_forward_related_filter(red_circle)
+        self.assertEqual(set(Product.objects.filter(**filters)), expected)
+
+    def test_cache_statements(self):
+        node = TBMPPage.objects.get(slug="Top.Collections")
+        leaf = TBMPPage.objects.get(slug="Top.Collections.Pictures.Astronomy.Stars")
+        items = list(CartItem.objects.order_by("pk"))
+        red_circle = Product.objects.get(pk=1)
+        field = TBMPPage._meta.get_field("statement_descendants")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                set(node.statement_descendants.all()), set(node.descendants.all())
+            )
+            self.assertEqual(
+                set(leaf.statement_ascendants.all()), set(leaf.ascendants.all())
+            )
+            self.assertEqual(
+                [item.statement_product for item in items],
+                [item.product for item in items],
+            )
+            self.assertEqual(
+                set(red_circle.statement_cart_items.all()),
+                set(red_circle.cart_items.all()),
+            )
+        self.assertEqual(len(queries), 12)
+        self.assertEqual(len(field._statement_cache), 2)
+
+        # Other instances execute the same SQL, without compiling it again.
+        parent = leaf.get_parent()
+        siblings = set(parent.descendants.all())
+        with mock.patch(
+            "django.db.models.sql.query.Query.get_compiler"
+        ) as get_compiler, CaptureQueriesContext(connection) as statement_queries:
+            children = set(parent.statement_descendants.all())
+            products = [items[1].statement_product, items[2].statement_product]
+        get_compiler.assert_not_called()
+        self.assertEqual(children, siblings)
+        self.assertEqual([p.sku for p in products], ["22", "11"])
+        self.assertEqual(len(statement_queries), 3)
+
+        # Changing the queryset compiles it as usual.
+        self.assertEqual(
+            list(node.statement_descendants.filter(depth=3).order_by("path")),
+            list(node.descendants.filter(depth=3).order_by("path")),
+        )
+        self.assertEqual(node.statement_descendants.count(), 5)
+
+        # A manager's queryset may depend on the state at the time, such as
+        # the current user, so queries with parameters aren't cached.
+        manager_class = type(TBMPPage.objects)
+        get_queryset = manager_class.get_queryset
+        hidden = []
+
+        def visible(manager):
+            return get_queryset(manager).exclude(slug__in=hidden)
+
+        with mock.patch.object(manager_class, "get_queryset", visible):
+            for slug in [
+                "Top.Collections.Pictures",
+                "Top.Collections.Pictures.Astronomy",
+            ]:
+                hidden[:] = [slug]
+                self.assertEqual(
+                    set(node.statement_descendants.all()),
+                    set(node.descendants.all()),
+                )
+                self.assertNotIn(slug, {p.slug for p in node.descendants.all()})
+        self.assertEqual(len(field._statement_cache), 2)
+
+        item = CartItem.objects.create(pk=4, product_code="nonexistent")
+        with self.assertRaises(Product.DoesNotExist):
+            item.statement_product
+        with self.assertRaises(ValueError):
+            Relationship(Product, Q(), cache_statements="always")
+
+    def test_cache_statements_prepare(self):
+        item = CartItem.objects.get(pk=1)
+        self.assertEqual(item.statement_product.sku, "11")
+
+        # On PostgreSQL, the statement is executed through _execute_prepared.
+        with mock.patch.object(connection, "vendor", "postgresql"), mock.patch(
+            "relativity.statements._execute_prepared",
+            side_effect=lambda execute, *args: execute(*args),
+        ) as execute_prepared:
+            self.assertEqual(item.statement_product.sku, "11")
+        execute_prepared.assert_called_once()
+
+        class ClientCursor(object):
+            pass
+
+        execute = mock.Mock()
+        cursor = mock.Mock()
+        context = {"cursor": mock.Mock(cursor=cursor), "connection": connection}
+        psycopg = mock.Mock(ClientCursor=ClientCursor)
+        with mock.patch.dict(sys.modules, {"psycopg": psycopg}):
+            _execute_prepared(execute, "SQL", (1,), False, context)
+            cursor.execute.assert_called_once_with("SQL", (1,), prepare=True)
+            # Parameters bound on the client can't be prepared.
+            context["cursor"].cursor = ClientCursor()
+            _execute_prepared(execute, "SQL", (1,), False, context)
+            execute.assert_called_once_with("SQL", (1,), False, context)
+        # Neither can psycopg2's.
+        with mock.patch.dict(sys.modules, {"psycopg": None}):
+            _execute_prepared(execute, "SQL", (2,), False, context)
+            execute.assert_called_with("SQL", (2,), False, context)
+
+    @skipIf(connection.vendor != "postgresql", "Only PostgreSQL prepares statements")
+    def test_cache_statements_prepare_postgresql(self):
+        try:
+            from psycopg import ClientCursor
+        except ImportError:
+            self.skipTest("psycopg2 can't prepare statements")
+        with connection.cursor() as cursor:
+            server_side = not isinstance(cursor.cursor, ClientCursor)
+        items = list(CartItem.objects.order_by("pk"))
+        self.assertEqual(
+            [item.statement_product.sku for item in items], ["11", "22", "11"]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT statement FROM pg_prepared_statements")
+            prepared = [s for (s,) in cursor.fetchall() if "tests_product" in s]
+        self.assertEqual(len(prepared), 1 if server_side else 0)
+
+    def test_adjacency_list(self):
+        def slugs(pages):
+            return {page.slug for page in pages}
+
+        pages = {page.slug: page for page in Page.objects.all()}
+        for node in AdjacencyPage.objects.all():
+            page = pages[node.slug]
+            with self.assertNumQueries(1):
+                descendants = slugs(node.descendants.all())
+            self.assertEqual(descendants, slugs(page.descendants.all()))
+            self.assertEqual(slugs(node.subtree.all()), slugs(page.subtree.all()))
+            self.assertEqual(slugs(node.ascendants.all()), slugs(page.ascendants.all()))
+            self.assertEqual(slugs(node.ancestors.all()), slugs(page.ascendants.all()))
+            self.assertEqual(slugs(node.path_to_root.all()), slugs(page.rootpath.all()))
+            self.assertEqual(
+                slugs(node.near_descendants.all()),
+                {
+                    slug
+                    for slug in descendants
+                    if slug.count(".") <= node.slug.count(".") + 2
+                },
+            )
+
+        # Filtering across the relationship joins on the recursive query.
+        self.assertEqual(
+            slugs(AdjacencyPage.objects.filter(descendants__name="Astrophysics")),
+            {"Top", "Top.Science", "Top.Science.Astronomy"},
+        )
+        self.assertEqual(
+            slugs(AdjacencyPage.objects.filter(ancestors__slug="Top.Collections")),
+            slugs(Page.objects.filter(ascendants__slug="Top.Collections")),
+        )
+        top = AdjacencyPage.objects.get(slug="Top")
+        self.assertEqual(
+            AdjacencyPage.objects.annotate(count=RelationshipCount("descendants"))
+            .get(pk=top.pk)
+            .count,
+            12,
+        )
+
+        # A recursive query for each relationship, then the nodes found.
+        with self.assertNumQueries(5):
+            nodes = list(
+                AdjacencyPage.objects.order_by("pk").prefetch_related(
+                    "descendants", "ascendants"
+                )
+            )
+        expected = {
+            slug: (slugs(page.descendants.all()), slugs(page.ascendants.all()))
+            for slug, page in pages.items()
+        }
+        with self.assertNumQueries(0):
+            for node in nodes:
+                self.assertEqual(
+                    (slugs(node.descendants.all()), slugs(node.ascendants.all())),
+                    expected[node.slug],
+                )
+
+        # The parent can be any field holding the parent's pk.
+        first = LinkedNode.objects.create(name="first")
+        second = LinkedNode.objects.create(name="second", prev_id=first.pk)
+        third = LinkedNode.objects.create(name="third", prev_id=second.pk)
+        self.assertEqual(list(first.following.order_by("pk")), [second, third])
+        self.assertEqual(list(third.preceding.order_by("pk")), [first, second])
+
+        # Nodes found already aren't followed again, so cycles end.
+        first.prev_id = third.pk
+        first.save()
+        nodes = [first, second, third]
+        for node in nodes:
+            self.assertEqual(list(node.following.order_by("pk")), nodes)
+            self.assertEqual(list(node.preceding.order_by("pk")), nodes)
+        nodes = LinkedNode.objects.filter(pk__in=[first.pk, second.pk, third.pk])
+        for node in nodes.prefetch_related("following", "preceding"):
+            self.assertEqual(len(node.following.all()), 3)
+            self.assertEqual(len(node.preceding.all()), 3)
+
+    def test_adjacency_list_batched_prefetch(self):
+        names = ["descendants", "path_to_root", "near_descendants"]
+        nodes = AdjacencyPage.objects.order_by("pk")
+        expected = {
+            node.pk: [set(getattr(node, name).all()) for name in names]
+            for node in nodes
+        }
+        # Each batch of pks leaves room for max_depth.
+        with mock.patch.object(connection.features, "max_query_params", 5):
+            with CaptureQueriesContext(connection) as queries:
+                nodes = list(nodes.prefetch_related(*names))
+        recursive = [q for q in queries if q["sql"].startswith("WITH RECURSIVE")]
+        self.assertEqual(len(recursive), len(names) * -(-len(nodes) // 4))
+        for node in nodes:
+            self.assertEqual(
+                [set(getattr(node, name).all()) for name in names], expected[node.pk]
+            )
+
+    def test_benchmarks(self):
+        from benchmarks.cases import get_cases
+        from benchmarks.data import generate
+
+        for model in [
+            Page,
+            AdjacencyPage,
+            MPTTPage,
+            TBMPPage,
+            TBNSPage,
+            SavedFilter,
+            User,
+        ]:
+            model.objects.all().delete()
+        for model in [Chemical, Product, CartItem, ProductFilter, UserGenerator]:
+            model.objects.all().delete()
+        generate(rows=120)
+        self.assertEqual(
+            TBNSPage.objects.get(pk=2).descendants.count(),
+            Page.objects.get(pk=2).descendants.count(),
+        )
+        self.assertEqual(
+            TBMPPage.objects.get(pk=2).get_descendant_count(),
+            MPTTPage.objects.get(pk=2).get_descendant_count(),
+        )
+        for case in get_cases():
+            case.run()
+
+    def test_signals(self):
+        class StubStatsClient(object):
+            def __init__(self):
+                self.counts = defaultdict(int)
+                self.timings = defaultdict(list)
+                self.gauges = defaultdict(list)
+
+            def incr(self, stat, count=1):
+                self.counts[stat] += count
+
+            def timing(self, stat, delta):
+                self.timings[stat].append(delta)
+
+            def gauge(self, stat, value):
+                self.gauges[stat].append(value)
+
+        Page._meta.get_field("descendants")._restriction_cache.clear()
+        client = StubStatsClient()
+        collector = StatsdCollector(client)
+        collector.connect()
+        try:
+            top = Page.objects.get(slug="Top")
+            list(Page.objects.filter(ascendants=top))
+            list(Page.objects.filter(ascendants=top))
+            pages = list(Page.objects.prefetch_related("descendants"))
+            list(top.ascendants.all())
+        finally:
+            collector.disconnect()
+
+        # The filters and the prefetch join, but the reverse accessor filters
+        # on top's values instead, from Django 4.0.
+        compiles = 3 if django.VERSION >= (4, 0) else 4
+        self.assertEqual(
+            client.counts["relativity.compile.tests.Page.descendants"], compiles
+        )
+        self.assertEqual(
+            client.counts["relativity.compile.cached.tests.Page.descendants"], 2
+        )
+        self.assertEqual(
+            len(client.timings["relativity.compile.duration.tests.Page.descendants"]),
+            compiles,
+        )
+        self.assertEqual(client.counts["relativity.prefetch.tests.Page.descendants"], 1)
+        self.assertEqual(
+            client.gauges["relativity.prefetch.batch_size.tests.Page.descendants"],
+            [len(pages)],
+        )
+        self.assertEqual(
+            client.counts["relativity.prefetch.matched.tests.Page.descendants"],
+            sum(len(p.descendants.all()) for p in pages),
+        )
+        self.assertEqual(
+            client.counts["relativity.prefetch.unmatched.tests.Page.descendants"], 0
+        )
+
+        # Once disconnected, nothing is recorded.
+        list(Page.objects.prefetch_related("descendants"))
+        self.assertEqual(client.counts["relativity.prefetch.tests.Page.descendants"], 1)
+
+    def test_signals_opentelemetry(self):
+        class StubInstrument(object):
+            def __init__(self):
+                self.values = []
+
+            def add(self, amount, attributes=None):
+                self.values.append((amount, attributes))
+
+            record = add
+
+        class StubMeter(object):
+            def __init__(self):
+                self.instruments = {}
+
+            def create_counter(self, name):
+                return self.instruments.setdefault(name, StubInstrument())
+
+            create_histogram = create_counter
+
+        field = SavedFilter._meta.get_field("materialized_chemicals")
+        saved_filter = SavedFilter.objects.create(
+            user=User.objects.create(username="alex"), search_regex="Cl"
+        )
+        meter = StubMeter()
+        collector = OpenTelemetryCollector(meter)
+        collector.connect()
+        try:
+            field.remote_field.get_forward_related_filter(saved_filter)
+            list(Page.objects.filter(descendants__slug="Top.Science"))
+        finally:
+            collector.disconnect()
+
+        self.assertEqual(
+            meter.instruments["relativity.filter_fallback"].values,
+            [
+                (
+                    1,
+                    {
+                        "relationship": "tests.SavedFilter.materialized_chemicals",
+                        "reason": "materialize",
+                    },
+                )
+            ],
+        )
+        self.assertEqual(
+            meter.instruments["relativity.compile"].values,
+            [(1, {"relationship": "tests.Page.descendants", "direction": "forward"})],
+        )